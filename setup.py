@@ -1,4 +1,5 @@
 #!/usr/bin/env python
+import os
 import setuptools
 
 version = '1.0.0b5'
@@ -13,6 +14,17 @@ with open("test_requirements.txt", "r") as fh:
 with open("README.rst", "r") as fh:
     long_description = fh.read()
 
+# Set SYNTREENET_USE_MYPYC=1 to compile the core modules with mypyc.
+ext_modules = []
+if os.environ.get('SYNTREENET_USE_MYPYC') == '1':
+    from mypyc.build import mypycify
+    ext_modules = mypycify([
+        'src/syntreenet/grammar.py',
+        'src/syntreenet/factset.py',
+        'src/syntreenet/ruleset.py',
+        '--ignore-missing-imports',
+    ])
+
 setuptools.setup(
     name='syntreenet',
     version=version,
@@ -30,6 +42,7 @@ setuptools.setup(
     ],
     packages=setuptools.find_packages('src'),
     package_dir={'':'src'},
+    ext_modules=ext_modules,
     install_requires=install_requires,
     extras_require={
         'testing': testing_extras,
@@ -0,0 +1,237 @@
+# Copyright (c) 2019 by Enrique Pérez Arnaud <enrique@cazalla.net>
+#
+# This file is part of the syntreenet project.
+# https://syntree.net
+#
+# The syntreenet project is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The syntreenet project is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with any part of the terms project.
+# If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import annotations
+
+from dataclasses import dataclass, field, replace
+from typing import List, Dict, Set, Optional, Any
+
+from .grammar import Segment, Fact, Matching
+from .ruleset import RuleSet
+
+FUNCTIONS = ('count', 'sum', 'min', 'max')
+
+
+@dataclass
+class Group:
+    '''
+    The state of an aggregate for one group: the number of facts, the sum of
+    their values, and, for min and max, the number of facts with each value,
+    to find the new extreme when the last fact with it is removed.
+    '''
+    count : int = 0
+    total : float = 0.0
+    values : Dict[float, int] = field(default_factory=dict)
+    extreme : Optional[float] = None
+
+
+@dataclass(eq=False)
+class Aggregate:
+    '''
+    A count, sum, min or max of the values of a variable in the facts that
+    match a pattern, for each of the groups of facts that have the same
+    values for the variables in group_by. It is kept up to date as facts are
+    added to and removed from the knowledge base, and each group is read in
+    constant time. Facts whose value is not a number are not counted in sums,
+    minimums or maximums.
+
+    The groups are shared with the snapshots taken by transactions: owner is
+    the token of the aggregate that can change the dictionary of groups in
+    place, and otherwise it is copied on the first change; each group is
+    copied the first time it is changed after that (owned has the keys of
+    the groups already copied).
+    '''
+    pattern : Fact
+    function : str
+    value : Optional[Segment] = None
+    group_by : tuple = ()  # Tuple[Segment...]
+    number : int = 0
+    groups : Dict[tuple, Group] = field(default_factory=dict)
+    key : str = ''
+    owned : Set[tuple] = field(default_factory=set)
+    token : Any = field(default_factory=object)
+    owner : Any = None
+
+    def __post_init__(self):
+        self.owner = self.token
+
+    def __str__(self) -> str:
+        return f'aggregate {self.number}: {self.function} of {self.pattern}'
+
+    def get(self, *values : str) -> Optional[float]:
+        '''
+        Return the aggregate for the group with the given values of the
+        variables in group_by (0 for counts of empty groups, and None for
+        the rest of functions).
+        '''
+        group = self.groups.get(values)
+        if group is None:
+            return 0 if self.function == 'count' else None
+        return self._result(group)
+
+    def to_dict(self) -> dict:
+        '''
+        Return a dict from the tuples of values of the variables in group_by
+        to the aggregates of the non empty groups.
+        '''
+        return {k: self._result(g) for k, g in self.groups.items()}
+
+    def _result(self, group : Group) -> Optional[float]:
+        if self.function == 'count':
+            return group.count
+        elif self.function == 'sum':
+            return group.total
+        return group.extreme
+
+    def update(self, matching : Matching, delta : int):
+        '''
+        Add (delta 1) or remove (delta -1) the fact matched to the pattern
+        with the matching.
+        '''
+        value = 0.0
+        if self.value is not None:
+            try:
+                value = float(matching[self.value].text)
+            except ValueError:
+                return
+        key = tuple(matching[v].text for v in self.group_by)
+        if key not in self.groups and delta < 0:
+            return
+        group = self._own_group(key)
+        group.count += delta
+        if group.count == 0:
+            del self.groups[key]
+            self.owned.discard(key)
+            return
+        group.total += delta * value
+        if self.function in ('min', 'max'):
+            self._update_extreme(group, value, delta)
+
+    def _update_extreme(self, group : Group, value : float, delta : int):
+        values = group.values
+        count = values.get(value, 0) + delta
+        choose = min if self.function == 'min' else max
+        if count > 0:
+            values[value] = count
+            if group.extreme is None:
+                group.extreme = value
+            else:
+                group.extreme = choose(group.extreme, value)
+        else:
+            values.pop(value, None)
+            if value == group.extreme:
+                group.extreme = choose(values) if values else None
+
+    def recount(self, kb : Any):
+        '''
+        Compute the aggregate from scratch, from the facts in the knowledge
+        base.
+        '''
+        self.groups = {}
+        self.owned = set()
+        self.owner = self.token
+        for matching in kb.ask(self.pattern):
+            self.update(matching, 1)
+
+    def _own_group(self, key : tuple) -> Group:
+        '''
+        Return the group with the key, creating it if there is none, and
+        copying it (along with the dictionary of groups) if it is shared
+        with a snapshot.
+        '''
+        if self.owner is not self.token:
+            self.groups = dict(self.groups)
+            self.owned = set()
+            self.owner = self.token
+        group = self.groups.get(key)
+        if group is None:
+            group = self.groups[key] = Group()
+            self.owned.add(key)
+        elif key not in self.owned:
+            group = self.groups[key] = replace(group, values=dict(group.values))
+            self.owned.add(key)
+        return group
+
+    def snapshot(self) -> Dict[tuple, Group]:
+        '''
+        Return the current groups, which can later be restored. The
+        aggregate gets a new token, so that from then on the groups are
+        copied before being changed.
+        '''
+        self.token = object()
+        return self.groups
+
+    def restore(self, snapshot : Dict[tuple, Group]):
+        self.groups = snapshot
+        self.token = object()
+        self.owner = None
+
+
+@dataclass
+class AggregateSet(RuleSet):
+    '''
+    The tree of the patterns of the aggregates in a knowledge base, built
+    and matched as the tree of conditions, through which the facts added and
+    removed are passed to the aggregates whose patterns they match.
+    '''
+    aggregates : List[Aggregate] = field(default_factory=list)
+
+    def get_cons(self, aggregate):
+        return (aggregate.pattern,)
+
+    def add_activation(self, act):
+        pass
+
+    def add_aggregate(self, aggregate : Aggregate):
+        aggregate.key = self.add_condition(aggregate.pattern, aggregate)
+        self.aggregates.append(aggregate)
+
+    def remove_aggregate(self, aggregate : Aggregate):
+        self.remove_continuation(aggregate.pattern, aggregate.key)
+        self.aggregates.remove(aggregate)
+
+    def snapshot_groups(self) -> Dict[Aggregate, Dict[tuple, Group]]:
+        '''
+        Return the current groups of the aggregates, which can later be
+        restored.
+        '''
+        return {agg: agg.snapshot() for agg in self.aggregates}
+
+    def restore_groups(self, snapshot : Dict[Aggregate, Dict[tuple, Group]],
+                       kb : Any):
+        '''
+        Restore the groups of the aggregates to the given snapshot.
+        Aggregates declared after it was taken are kept, and are computed
+        again from the facts in the knowledge base.
+        '''
+        for agg in self.aggregates:
+            if agg in snapshot:
+                agg.restore(snapshot[agg])
+            else:
+                agg.recount(kb)
+
+    def update(self, fact : Fact, delta : int):
+        '''
+        Pass a fact added (delta 1) or removed (delta -1) to the aggregates
+        whose patterns match it.
+        '''
+        for endnode, matching in self.matches(fact.layout, Matching(origin=fact)):
+            for _, varmap, aggregate in endnode.continuations.values():
+                aggregate.update(matching.get_real_matching(varmap), delta)
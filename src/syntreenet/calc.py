@@ -0,0 +1,174 @@
+# Copyright (c) 2019 by Enrique Pérez Arnaud <enrique@cazalla.net>
+#
+# This file is part of the syntreenet project.
+# https://syntree.net
+#
+# The syntreenet project is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The syntreenet project is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with any part of the terms project.
+# If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import annotations
+
+import operator
+from dataclasses import dataclass, field
+from typing import List, Dict, Set, Tuple, Callable, Union, Optional, Any
+
+from parsimonious.nodes import Node
+
+from .grammar import Segment, Matching
+
+Operand = Callable[[Dict[str, Any]], Any]
+
+OPERATORS : Dict[str, Callable[[Any, Any], Any]] = {
+    '+': operator.add,
+    '-': operator.sub,
+    '*': operator.mul,
+    '/': operator.truediv,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    '==': operator.eq,
+    '!=': operator.ne,
+}
+
+
+def to_value(text : str) -> Any:
+    '''
+    The value of the text of a segment in a calculation: a float if it
+    reads as a number, and otherwise the text itself.
+    '''
+    try:
+        return float(text)
+    except ValueError:
+        return text
+
+
+@dataclass
+class Calculation:
+    '''
+    An extra condition with comparisons and arithmetic, compiled from its
+    parse tree (the __calc__ production in _base.peg) into closures that are
+    evaluated directly on the values in the matching, with no eval.
+
+    A calculation is a sequence of statements separated by semicolons, each
+    of which is either a comparison, that must hold, or an assignment, that
+    binds a new variable to the value of an arithmetic expression (or, if
+    the variable is already bound, must give its value). As in the python
+    extra conditions, the values that read as numbers are floats, and the
+    new values are given as their str.
+    '''
+    statements : List[Tuple[Optional[str], Operand]] = field(default_factory=list)
+    names : Set[str] = field(default_factory=set)
+
+    def __call__(self, matching : Matching) -> Union[bool, List[Matching]]:
+        '''
+        Return False if the calculation fails for the matching, True if it
+        holds and binds no new variable, or a list with a matching with the
+        new variables.
+        '''
+        names = self.names
+        env = {k.text: to_value(v.text) for k, v in matching.mapping
+               if k.text in names}
+        new = []
+        try:
+            for target, expr in self.statements:
+                if target is None:
+                    if not expr(env):
+                        return False
+                elif target in env:
+                    if env[target] != expr(env):
+                        return False
+                else:
+                    value = env[target] = expr(env)
+                    new.append((Segment(target, '__var__'), Segment(str(value))))
+        except (KeyError, TypeError, ArithmeticError):
+            return False
+        if not new:
+            return True
+        return [Matching(tuple(new))]
+
+
+def compile_calc(tree : Node) -> Calculation:
+    '''
+    Build a calculation from the parse tree of its text.
+    '''
+    calc = Calculation()
+    for stmt in _named(tree, ('__calc_stmt__',)):
+        node = stmt.children[0]
+        if node.expr.name == '__calc_assign__':
+            var = _named(node, ('__var__',))[0].text
+            expr = _compile_expr(_named(node, ('__calc_sum__',))[0], calc.names)
+            calc.names.add(var)
+            calc.statements.append((var, expr))
+        else:
+            left, right = (_compile_expr(n, calc.names)
+                           for n in _named(node, ('__calc_sum__',)))
+            compare = OPERATORS[_named(node, ('__calc_cmp__',))[0].text]
+            calc.statements.append((None, _binary(compare, left, right)))
+    return calc
+
+
+def _named(node : Node, names : tuple) -> List[Node]:
+    '''
+    Return the outermost descendants of node with the given production
+    names, in document order.
+    '''
+    found = []
+    stack = list(reversed(node.children))
+    while stack:
+        child = stack.pop()
+        if child.expr.name in names:
+            found.append(child)
+        else:
+            stack.extend(reversed(child.children))
+    return found
+
+
+def _compile_expr(node : Node, names : Set[str]) -> Operand:
+    '''
+    Compile an arithmetic expression (a __calc_sum__, __calc_term__, or
+    __calc_atom__ node) into a function of the values of the variables,
+    adding to names the variables used.
+    '''
+    name = node.expr.name
+    if name == '__calc_sum__':
+        return _fold(_named(node, ('__calc_term__', '__calc_addop__')), names)
+    elif name == '__calc_term__':
+        return _fold(_named(node, ('__calc_atom__', '__calc_mulop__')), names)
+    node = node.children[0]
+    name = node.expr.name
+    if name == '__var__':
+        var = node.text
+        names.add(var)
+        return lambda env: env[var]
+    elif name == '__calc_num__':
+        value = float(node.text)
+        return lambda env: value
+    return _compile_expr(_named(node, ('__calc_sum__',))[0], names)
+
+
+def _fold(nodes : List[Node], names : Set[str]) -> Operand:
+    expr = _compile_expr(nodes[0], names)
+    for i in range(1, len(nodes), 2):
+        expr = _binary(OPERATORS[nodes[i].text], expr,
+                       _compile_expr(nodes[i + 1], names))
+    return expr
+
+
+def _binary(op : Callable[[Any, Any], Any], left : Operand,
+            right : Operand) -> Operand:
+    def binary(env : Dict[str, Any]) -> Any:
+        return op(left(env), right(env))
+    return binary
@@ -0,0 +1,146 @@
+# Copyright (c) 2019 by Enrique Pérez Arnaud <enrique@cazalla.net>
+#
+# This file is part of the syntreenet project.
+# https://syntree.net
+#
+# The syntreenet project is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The syntreenet project is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with any part of the terms project.
+# If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from typing import List, Dict, Callable, Sequence, Optional, Any
+
+from .grammar import Path, Matching
+
+# Python refuses to compile more than 20 nested blocks, and each free
+# variable in a query opens a loop in its walker.
+MAX_FREE = 16
+
+
+@dataclass
+class Walkers:
+    '''
+    Python functions generated to walk the fact set for queries of each
+    shape, as FactSet.query_paths does, kept in a cache.
+
+    The shape of a query has, for each of its leaf paths, whether it is a
+    constant in or out of the range of the logical variables, a free
+    variable, a variable bound by the matching given to the query, or a
+    variable that is free before an earlier path binds it. For each shape,
+    the source of a walker is generated with a statement or a loop per path,
+    so the walk does not look up the kind of each path nor push nodes on a
+    stack, and only builds the matchings found, rather than one for each
+    node visited. The cache is emptied when it reaches size.
+    '''
+    size : int = 1000
+    functions : Dict[tuple, Optional[Callable]] = field(default_factory=dict)
+    compiled : int = 0
+
+    def walker(self, paths : Sequence[Path], matching : Matching,
+               kb : Any) -> Optional[Callable]:
+        '''
+        Return the walker for queries with the shape of the paths given the
+        matching, or None if it has too many free variables to be compiled.
+        The walker is called with the node from which to match the paths,
+        the paths, the matching, and the list to which to append the
+        matchings found.
+        '''
+        shape = self.shape(paths, matching, kb)
+        try:
+            return self.functions[shape]
+        except KeyError:
+            pass
+        if len(self.functions) >= self.size:
+            self.functions.clear()
+        function = None
+        if paths and shape.count('F') <= MAX_FREE:
+            namespace : Dict[str, Any] = {'Matching': Matching}
+            exec(generate(shape), namespace)
+            function = namespace['walk']
+            self.compiled += 1
+        self.functions[shape] = function
+        return function
+
+    @staticmethod
+    def shape(paths : Sequence[Path], matching : Matching, kb : Any) -> tuple:
+        '''
+        Return the shape of the paths given the matching: for each, 'L' or
+        'N' for a constant in the range of the logical variables or not, 'F'
+        for a free variable, 'BL' or 'BN' for a variable bound in the
+        matching to a value in the range or not, and the index of the path
+        that binds it for a variable that is free before that path.
+        '''
+        shape : List[Any] = []
+        first : Dict[Any, int] = {}
+        for i, path in enumerate(paths):
+            if not path.is_var():
+                shape.append('L' if kb.in_var_range(path) else 'N')
+                continue
+            syn = path.value
+            value = matching.get(syn)
+            if value is not None:
+                shape.append('BL' if kb.in_var_range((value,)) else 'BN')
+            elif syn in first:
+                shape.append(first[syn])
+            else:
+                first[syn] = i
+                shape.append('F')
+        return tuple(shape)
+
+
+def generate(shape : tuple) -> str:
+    '''
+    Return the source of the walker for queries with the given shape.
+    '''
+    head = ['def walk(node, paths, matching, response):',
+            '    mapping = matching.mapping',
+            '    origin = matching.origin']
+    body : List[str] = []
+    bound : List[str] = []
+    indent = '    '
+    miss = 'return'
+    parent = 'node'
+    for i, kind in enumerate(shape):
+        child = f'n{i}'
+        if kind == 'F':
+            head.append(f'    s{i} = paths[{i}].value')
+            body.append(f'{indent}for {child} in {parent}.logic_children.values():')
+            indent += '    '
+            body.append(f'{indent}v{i} = {child}.path.value')
+            bound.append(f'(s{i}, v{i})')
+            miss = 'continue'
+        else:
+            if kind in ('L', 'N'):
+                head.append(f'    k{i} = paths[{i}].identity_tuple')
+                key = f'k{i}'
+            elif kind in ('BL', 'BN'):
+                head.append(f'    k{i} = (paths[{i}].identity_tuple[:-2] + '
+                            f'matching.get(paths[{i}].value).identity_tuple)')
+                key = f'k{i}'
+            else:
+                head.append(f'    p{i} = paths[{i}].identity_tuple[:-2]')
+                key = f'p{i} + v{kind}.identity_tuple'
+            children = 'nonlogic_children' if kind in ('N', 'BN') else 'logic_children'
+            body.append(f'{indent}{child} = {parent}.{children}.get({key})')
+            body.append(f'{indent}if {child} is None:')
+            body.append(f'{indent}    {miss}')
+        parent = child
+    body.append(f'{indent}if {parent}.ends:')
+    if bound:
+        found = f'Matching(mapping + ({", ".join(bound)},), origin)'
+    else:
+        found = 'matching'
+    body.append(f'{indent}    response.append({found})')
+    return '\n'.join(head + body) + '\n'
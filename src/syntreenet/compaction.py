@@ -0,0 +1,261 @@
+# Copyright (c) 2019 by Enrique Pérez Arnaud <enrique@cazalla.net>
+#
+# This file is part of the syntreenet project.
+# https://syntree.net
+#
+# The syntreenet project is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The syntreenet project is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with any part of the terms project.
+# If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from typing import List, Dict, Set, Tuple, Any
+
+from .grammar import Fact
+from .ruleset import Rule
+
+
+@dataclass
+class PartialRules:
+    '''
+    The partial rules in a knowledge base, i.e., the rules that result from
+    matching some of the conditions of a rule with facts, and that wait for
+    facts that match the rest.
+
+    rules maps the text of each partial rule to the rule, and derivations
+    maps it to the ways in which it was derived: for each, the text of the
+    rule it was derived from and the fact that matched the condition of
+    that rule. children maps the text of each rule to the texts of the
+    partial rules derived from it, and supports the text of each fact to
+    the texts of the partial rules derived with it.
+
+    A partial rule is an orphan when, in every derivation, the fact has been
+    removed or the rule it was derived from is an orphan; it would then not
+    have been derived from the facts in the knowledge base. The knowledge
+    base forgets the derivations with a fact when it removes it (see
+    remove_fact), so orphans are only left by changes not made through it.
+
+    The dictionaries are shared with forks and snapshots, as the nodes of
+    the trees are: they are copied on the first change after the record gets
+    a new token, and each set of derivations, of children or of supports the
+    first time it is changed after that.
+    '''
+    rules : Dict[str, Rule] = field(default_factory=dict)
+    derivations : Dict[str, Dict[Tuple[str, str], Fact]] = field(default_factory=dict)
+    children : Dict[str, Set[str]] = field(default_factory=dict)
+    supports : Dict[str, Set[str]] = field(default_factory=dict)
+    owned_derivations : Set[str] = field(default_factory=set)
+    owned_children : Set[str] = field(default_factory=set)
+    owned_supports : Set[str] = field(default_factory=set)
+    token : Any = field(default_factory=object)
+    owner : Any = None
+
+    def __post_init__(self):
+        self.owner = self.token
+
+    def add(self, rule : Rule, parent : Rule, support : Fact):
+        '''
+        Record that rule was derived from parent by matching one of its
+        conditions with the fact support.
+        '''
+        text = str(rule)
+        parent_text = str(parent)
+        self._own()
+        if text not in self.derivations:
+            self.rules[text] = rule
+        self._own_derivations(text)[(parent_text, support.text)] = support
+        self._own_children(parent_text).add(text)
+        self._own_supports(support.text).add(text)
+
+    def orphans(self, kb : Any) -> List[Rule]:
+        '''
+        Forget the orphan partial rules, and return them. Derivations that
+        go through orphans are also forgotten.
+        '''
+        present : Dict[str, bool] = {}
+        alive : Dict[str, bool] = {}
+        # parents have more conditions than the rules derived from them.
+        texts = sorted(self.rules,
+                       key=lambda t: -len(self.rules[t].conditions))
+        orphans = []
+        self._own()
+        for text in texts:
+            derivations = self.derivations[text]
+            for key, support in list(derivations.items()):
+                parent, fact = key
+                if alive.get(parent, parent not in self.rules):
+                    if fact not in present:
+                        present[fact] = bool(kb.fset.ask_fact(support))
+                    if present[fact]:
+                        continue
+                derivations = self._drop(text, key)
+            alive[text] = bool(derivations)
+            if not derivations:
+                orphans.append(self._forget(text))
+        return orphans
+
+    def retract(self, rule : Rule) -> List[Rule]:
+        '''
+        Forget the derivations that go through the rule, and return the
+        partial rules left without derivations, that are forgotten. Only
+        the rules derived from the rule are visited.
+        '''
+        text = str(rule)
+        if text not in self.children:
+            return []
+        self._own()
+        return self._cascade([text])
+
+    def remove_fact(self, fact : str) -> List[Rule]:
+        '''
+        Forget the derivations with the fact, given its text, and return the
+        partial rules left without derivations, along with those derived
+        only from them, that are forgotten. Only the rules derived with the
+        fact are visited.
+        '''
+        if fact not in self.supports:
+            return []
+        self._own()
+        retracted : List[Rule] = []
+        pending : List[str] = []
+        for text in list(self.supports[fact]):
+            if text not in self.derivations:
+                continue
+            derivations = self.derivations[text]
+            for key in [k for k in derivations if k[1] == fact]:
+                derivations = self._drop(text, key)
+            if not derivations:
+                retracted.append(self._forget(text))
+                pending.append(text)
+        return retracted + self._cascade(pending)
+
+    def _cascade(self, pending : List[str]) -> List[Rule]:
+        '''
+        Forget the derivations from the rules with the texts in pending,
+        that must be forgotten or retracted, and return the partial rules
+        left without derivations, that are forgotten in turn.
+        '''
+        retracted : List[Rule] = []
+        while pending:
+            parent = pending.pop()
+            self.owned_children.discard(parent)
+            for text in self.children.pop(parent, ()):
+                if text not in self.derivations:
+                    continue
+                derivations = self.derivations[text]
+                for key in [k for k in derivations if k[0] == parent]:
+                    derivations = self._drop(text, key)
+                if not derivations:
+                    retracted.append(self._forget(text))
+                    pending.append(text)
+        return retracted
+
+    def _drop(self, text : str, key : Tuple[str, str]
+              ) -> Dict[Tuple[str, str], Fact]:
+        '''
+        Forget the derivation of the partial rule with the text that has the
+        given key, unlinking the rule from the parent and from the fact in
+        it if it has no other derivation with them, and return the
+        derivations left.
+        '''
+        derivations = self._own_derivations(text)
+        del derivations[key]
+        parent, fact = key
+        self._unlink(parent, text)
+        if fact in self.supports and not any(f == fact for _, f in derivations):
+            supports = self._own_supports(fact)
+            supports.discard(text)
+            if not supports:
+                del self.supports[fact]
+                self.owned_supports.discard(fact)
+        return derivations
+
+    def _unlink(self, parent : str, text : str):
+        '''
+        Drop text from the children of parent, unless it still has a
+        derivation from it.
+        '''
+        if any(p == parent for p, _ in self.derivations[text]):
+            return
+        if parent in self.children:
+            children = self._own_children(parent)
+            children.discard(text)
+            if not children:
+                del self.children[parent]
+                self.owned_children.discard(parent)
+
+    def _forget(self, text : str) -> Rule:
+        del self.derivations[text]
+        self.owned_derivations.discard(text)
+        return self.rules.pop(text)
+
+    def _own(self):
+        '''
+        Make sure that the dictionaries are the record's own, copying them
+        if they are shared with a fork or a snapshot.
+        '''
+        if self.owner is not self.token:
+            self.rules = dict(self.rules)
+            self.derivations = dict(self.derivations)
+            self.children = dict(self.children)
+            self.supports = dict(self.supports)
+            self.owned_derivations = set()
+            self.owned_children = set()
+            self.owned_supports = set()
+            self.owner = self.token
+
+    def _own_derivations(self, text : str) -> Dict[Tuple[str, str], Fact]:
+        derivations = self.derivations.get(text)
+        if derivations is None or text not in self.owned_derivations:
+            derivations = self.derivations[text] = dict(derivations or ())
+            self.owned_derivations.add(text)
+        return derivations
+
+    def _own_children(self, text : str) -> Set[str]:
+        children = self.children.get(text)
+        if children is None or text not in self.owned_children:
+            children = self.children[text] = set(children or ())
+            self.owned_children.add(text)
+        return children
+
+    def _own_supports(self, fact : str) -> Set[str]:
+        supports = self.supports.get(fact)
+        if supports is None or fact not in self.owned_supports:
+            supports = self.supports[fact] = set(supports or ())
+            self.owned_supports.add(fact)
+        return supports
+
+    def fork(self) -> PartialRules:
+        '''
+        Return a record that shares everything with this one. Both get new
+        tokens, so from then on each of them copies what it changes.
+        '''
+        self.token = object()
+        record = PartialRules(self.rules, self.derivations, self.children,
+                              self.supports)
+        record.owner = None
+        return record
+
+    def snapshot(self) -> tuple:
+        '''
+        Return the current state of the record, which can later be restored.
+        '''
+        self.token = object()
+        return self.rules, self.derivations, self.children, self.supports
+
+    def restore(self, snapshot : tuple):
+        self.rules, self.derivations, self.children, self.supports = snapshot
+        self.token = object()
+        self.owner = None
@@ -18,6 +18,7 @@
 # If not, see <http://www.gnu.org/licenses/>.
 
 from .grammar import Segment, Matching
+from .calc import compile_calc
 
 
 class ec_handlers:
@@ -54,3 +55,8 @@ class ec_handlers:
             new_mapping = tuple((Segment(k, '__var__'), Segment(str(v)))
                     for k, v in exec_locals.items() if k not in pre_exec_locals)
             return [Matching(new_mapping)]
+
+    @staticmethod
+    def calc(text, matching, kb):
+        tree = kb.grammar['__calc__'].parse(text.strip())
+        return compile_calc(tree)(matching)
@@ -19,11 +19,17 @@
 
 from __future__ import annotations
 
-from copy import copy
-from dataclasses import dataclass, field
-from typing import List, Dict, Optional, Any, cast
+from dataclasses import dataclass, field, replace
+from itertools import islice
+from typing import List, Dict, Set, Tuple, Sequence, Iterator, Optional, Any, cast
 
-from .grammar import Fact, Path, Matching
+from .grammar import Segment, Fact, Path, Layout, Matching
+
+try:
+    from mypy_extensions import trait
+except ImportError:  # pragma: no cover
+    def trait(cls):  # type: ignore
+        return cls
 
 
 @dataclass
@@ -31,101 +37,244 @@ class BaseSSNode:
     '''
     Base class for fact set nodes. Nodes have a parent that is either the
     fact set or another node, and children, which is a dictionary of paths
-    to nodes.
+    to nodes. Nodes can be shared among forks of a knowledge base; owner is
+    the token of the fact set that can change the node in place.
     '''
     parent : Optional[BaseSSNode]
-    logic_children : Dict[Path, 'SSNode'] = field(default_factory=dict)
-    nonlogic_children : Dict[Path, 'SSNode'] = field(default_factory=dict)
+    logic_children : Dict[tuple, 'SSNode'] = field(default_factory=dict)
+    nonlogic_children : Dict[tuple, 'SSNode'] = field(default_factory=dict)
+    count : int = 0
+    owner : Any = None
 
     def get_fact_leaf(self, paths : List[Path]) -> Optional[SSNode]:
         parent = self
         for i, path in enumerate(paths):
-            node = parent.nonlogic_children.get(path)
+            node = parent.nonlogic_children.get(path.identity_tuple)
             if node is None:
-                node = parent.logic_children.get(path)
+                node = parent.logic_children.get(path.identity_tuple)
             if node is None:
                 return None
             parent = node
         return cast(SSNode, parent)
 
-    def follow_paths(self, paths : List[Path], kb : Any):
+    def follow_paths(self, layout : Layout, kb : Any,
+                     nodes : Dict[int, SSNode], ends : List[SSNode]) -> SSNode:
         '''
         Used while adding new facts, to find the sequence of already
-        existing nodes that correpond to its list of paths.
+        existing nodes that correpond to its list of paths, creating the
+        nodes that did not exist previously. Non-leaf logical paths open new
+        branches, that continue after the sub-expression they correspond to;
+        these are kept in a stack of pending work, each with the index in the
+        layout of the fact where it starts. All the nodes followed or created
+        are collected in nodes, after making sure that they are owned by the
+        fact set, and the nodes at which the branches end, in ends. Return
+        the node for the last leaf of the fact.
         '''
-        parent = self
-        for i, path in enumerate(paths):
-            if kb.in_var_range(path):
-                node = parent.logic_children.get(path)
-                if not path.is_leaf():
-                    new_paths = path.paths_after(paths)
-                    if node:
-                        node.follow_paths(new_paths, kb)
+        paths = layout.paths
+        skips = layout.skips
+        num_paths = len(paths)
+        work : List[Tuple[BaseSSNode, int, bool]] = [(self, 0, False)]
+        end : Optional[BaseSSNode] = None
+        while work:
+            parent, j, creating = work.pop()
+            while j < num_paths:
+                path = paths[j]
+                logic = kb.in_var_range(path)
+                node : Optional[SSNode] = None
+                if not creating:
+                    if logic:
+                        node = parent.logic_children.get(path.identity_tuple)
+                    else:
+                        node = parent.nonlogic_children.get(path.identity_tuple)
+                    if node is not None:
+                        node = parent._own_child(node, logic, kb)
+                if logic and not path.is_leaf():
+                    if node is None:
+                        node = parent._new_child(path, logic, kb)
+                        work.append((node, skips[j], True))
                     else:
-                        parent._create_paths([path] + new_paths, kb)
+                        work.append((node, skips[j], False))
+                    nodes[id(node)] = node
+                    j += 1
                     continue
+                if node is None:
+                    creating = True
+                    node = parent._new_child(path, logic, kb)
+                nodes[id(node)] = node
+                parent = node
+                j += 1
+            ends.append(cast(SSNode, parent))
+            if end is None:
+                end = parent
+        return cast(SSNode, end)
+
+    def _new_child(self, path : Path, logic : bool, kb : Any) -> SSNode:
+        new_node = SSNode(path=path,
+                          var=path.is_var(),
+                          parent=self,
+                          owner=kb.fset.token)
+        if logic:
+            self.logic_children[path.identity_tuple] = new_node
+        else:
+            self.nonlogic_children[path.identity_tuple] = new_node
+        if path.value.name in kb.fset.indexed and path.is_leaf():
+            kb.fset.index_node(new_node)
+        return new_node
+
+    def _own_child(self, node : SSNode, logic : bool, kb : Any) -> SSNode:
+        '''
+        Return the child node if the fact set owns it, or otherwise (if it
+        is shared with other forks of the knowledge base) replace it with a
+        copy that the fact set owns, and return the copy. Its children are
+        still shared.
+        '''
+        fset = kb.fset
+        if node.owner is fset.token:
+            return node
+        new_node = replace(node, parent=self,
+                           logic_children=dict(node.logic_children),
+                           nonlogic_children=dict(node.nonlogic_children),
+                           owner=fset.token)
+        if logic:
+            self.logic_children[node.path.identity_tuple] = new_node
+        else:
+            self.nonlogic_children[node.path.identity_tuple] = new_node
+        if node.path in fset.index:
+            fset.unindex_node(node)
+            fset.index_node(new_node)
+        return new_node
+
+    def collect_nodes(self, layout : Layout, kb : Any,
+                      nodes : Dict[int, SSNode], ends : List[SSNode]):
+        '''
+        Collect in nodes all the existing nodes that correspond to the paths
+        in the layout of a fact, in all the branches that follow_paths would
+        have followed, making sure that they are owned by the fact set, and
+        in ends the nodes at which those branches end.
+        '''
+        paths = layout.paths
+        num_paths = len(paths)
+        work : List[Tuple[BaseSSNode, int]] = [(self, 0)]
+        while work:
+            parent, j = work.pop()
+            while j < num_paths:
+                path = paths[j]
+                j += 1
+                logic = kb.in_var_range(path)
+                if logic:
+                    node = parent.logic_children.get(path.identity_tuple)
+                    if not path.is_leaf():
+                        if node:
+                            node = parent._own_child(node, logic, kb)
+                            nodes[id(node)] = node
+                            work.append((node, layout.skips[j - 1]))
+                        continue
+                else:
+                    node = parent.nonlogic_children.get(path.identity_tuple)
+                if node is None:
+                    break
+                node = parent._own_child(node, logic, kb)
+                nodes[id(node)] = node
+                parent = node
             else:
-                node = parent.nonlogic_children.get(path)
-            if node is None:
-                parent._create_paths(paths[i:], kb)
-                return
-            parent = node
+                ends.append(cast(SSNode, parent))
 
-    def _create_paths(self, paths : List[Path], kb : Any):
+    def count_paths(self, paths : Sequence[Path], i : int, free_from : int,
+                    matching : Matching, kb : Any) -> int:
         '''
-        Used while adding new facts, to create the sequence of
-        nodes that correpond to its list of paths and did not exist previously.
+        Count the facts that match the paths from the i-th on. Once the rest
+        of the paths (from free_from on) are distinct free variables, the
+        count kept in the node is used, rather than enumerating the
+        matchings; this assumes that all the facts under the node have the
+        same structure, which is the case when the variables range over
+        leaf productions.
         '''
-        parent = self
-        for path in paths:
-            new_node = SSNode(path=path,
-                              var=path.is_var(),
-                              parent=parent)
-            if kb.in_var_range(path):
-                parent.logic_children[path] = new_node
-                if not path.is_leaf():
-                    new_paths = path.paths_after(paths)
-                    new_node._create_paths(new_paths, kb)
+        total = 0
+        num_paths = len(paths)
+        keys, logic, variables = self._compile(paths, kb)
+        stack : List[Tuple[BaseSSNode, int, Matching]] = [(self, i, matching)]
+        while stack:
+            node, i, matching = stack.pop()
+            if i >= free_from:
+                if i < num_paths:
+                    total += node.count
+                elif cast(SSNode, node).ends:
+                    total += 1
+                continue
+            syn = variables[i]
+            if syn is not None:
+                if syn not in matching:
+                    for child in node.logic_children.values():
+                        new_matching = matching.setitem(syn, child.path.value)
+                        stack.append((child, i + 1, new_matching))
                     continue
+                path, _ = paths[i].substitute(matching)
+                if kb.in_var_range(path):
+                    next_node = node.logic_children.get(path.identity_tuple)
+                else:
+                    next_node = node.nonlogic_children.get(path.identity_tuple)
+            elif logic[i]:
+                next_node = node.logic_children.get(keys[i])
             else:
-                parent.nonlogic_children[path] = new_node
-            parent = new_node
+                next_node = node.nonlogic_children.get(keys[i])
+            if next_node is not None:
+                stack.append((next_node, i + 1, matching))
+        return total
 
-    def query_paths(self, paths : List[Path], matching : Matching, kb : Any):
+    def query_paths(self, paths : Sequence[Path], matching : Matching, kb : Any):
         '''
         Match the paths corresponding to a query (possibly containing
-        variables) with the paths in the nodes of the fact set.
+        variables) with the paths in the nodes of the fact set. The tree is
+        walked with an explicit stack of nodes, each with the index of the
+        next path to match, and the matchings found are appended to the
+        response of the fact set, in the same order as a depth first
+        traversal.
         '''
-        if paths:
-            path = paths.pop(0)
-            syn = path.value
-            child : Optional[SSNode]
-            if path.is_var():
+        num_paths = len(paths)
+        keys, logic, variables = self._compile(paths, kb)
+        response = kb.fset.response
+        stack : List[Tuple[BaseSSNode, int, Matching]] = [(self, 0, matching)]
+        while stack:
+            node, i, matching = stack.pop()
+            if i == num_paths:
+                if cast(SSNode, node).ends:
+                    response.append(matching)
+                continue
+            syn = variables[i]
+            if syn is not None:
                 if syn not in matching:
-                    for child in self.logic_children.values():
-                        new_matching = matching.setitem(syn, child.path.value)
-                        child.query_paths(copy(paths), new_matching, kb)
-                    return
+                    children = [(child, i + 1,
+                                 matching.setitem(syn, child.path.value))
+                                for child in node.logic_children.values()]
+                    children.reverse()
+                    stack.extend(children)
+                    continue
+                path, _ = paths[i].substitute(matching)
+                if kb.in_var_range(path):
+                    next_node = node.logic_children.get(path.identity_tuple)
                 else:
-                    path, _ = path.substitute(matching)
-
-            if kb.in_var_range(path):
-                next_node = self.logic_children.get(path)
+                    next_node = node.nonlogic_children.get(path.identity_tuple)
+            elif logic[i]:
+                next_node = node.logic_children.get(keys[i])
             else:
-                next_node = self.nonlogic_children.get(path)
-            if next_node:
-                next_node.query_paths(paths, matching, kb)
+                next_node = node.nonlogic_children.get(keys[i])
+            if next_node is not None:
+                stack.append((next_node, i + 1, matching))
 
-        else:
-            self._response_append(matching)
-
-    def _response_append(self, matching : Matching):
-        if self.parent is None:
-            cast(FactSet, self).response.append(matching)
-        else:
-            self.parent._response_append(matching)
+    @staticmethod
+    def _compile(paths : Sequence[Path], kb : Any) -> Tuple[list, list, list]:
+        '''
+        Prepare the paths of a query to be matched against many nodes: return
+        lists with the key of each path in the dictionaries of children,
+        whether it is a logical path, and its variable if it is one.
+        '''
+        keys = [p.identity_tuple for p in paths]
+        logic = [kb.in_var_range(p) for p in paths]
+        variables = [p.value if p.is_var() else None for p in paths]
+        return keys, logic, variables
 
 
+@trait
 @dataclass
 class ContentSSNode:
     '''
@@ -139,9 +288,15 @@ class ContentSSNode:
 @dataclass
 class SSNode(BaseSSNode, ContentSSNode):
     '''
-    Concrete nodes in the fact set.
+    Concrete nodes in the fact set. The node for the last leaf of a fact
+    keeps the fact, so that the facts in the set can be listed. ends is the
+    number of facts that have a branch ending at the node (the main branch,
+    or one that continues after a logical sub-expression), so that only
+    queries that reach the end of a branch match, and not those that are a
+    prefix of some fact.
     '''
-    parent : BaseSSNode
+    fact : Optional[Fact] = None
+    ends : int = 0
 
 
 @dataclass
@@ -152,13 +307,105 @@ class FactSet(BaseSSNode):
     parent : Optional[BaseSSNode] = None
     kb : Any = None
     response : List[Matching] = field(default_factory=list)
+    indexed : Set[str] = field(default_factory=set)
+    index : Dict[Path, Dict[int, SSNode]] = field(default_factory=dict)
+    index_owned : Set[Path] = field(default_factory=set)
+    token : Any = field(default_factory=object)
+
+    def __post_init__(self):
+        self.owner = self.token
+
+    def fork(self, kb : Any) -> FactSet:
+        '''
+        Return a fact set for kb that shares all its nodes with this one.
+        Both get new tokens, so from then on each of them copies the nodes
+        that it changes, along with their ancestors, before changing them.
+        '''
+        self.token = object()
+        fset = FactSet(logic_children=self.logic_children,
+                       nonlogic_children=self.nonlogic_children,
+                       count=self.count,
+                       kb=kb,
+                       indexed=set(self.indexed),
+                       index=self.index)
+        fset.owner = None
+        return fset
+
+    def snapshot(self) -> tuple:
+        '''
+        Return the current state of the fact set, which can later be
+        restored. The fact set gets a new token, so that from then on the
+        nodes in the snapshot are copied before being changed.
+        '''
+        self.token = object()
+        return (self.logic_children, self.nonlogic_children, self.count,
+                self.index)
+
+    def restore(self, snapshot : tuple):
+        '''
+        Restore the state of the fact set to the given snapshot.
+        '''
+        (self.logic_children, self.nonlogic_children, self.count,
+                self.index) = snapshot
+        self.token = object()
+        self.owner = None
+
+    def release(self, snapshot : tuple):
+        '''
+        Drop a snapshot. Nothing needs to be done, since the nodes only
+        reachable from it are freed once it is no longer referenced.
+        '''
+
+    def _own_root(self):
+        '''
+        Make sure that the dictionaries of children and the index of the
+        fact set are its own, copying them if they are shared with a fork.
+        The buckets of the index are still shared, and are copied by
+        _own_bucket when they are changed.
+        '''
+        if self.owner is not self.token:
+            self.logic_children = dict(self.logic_children)
+            self.nonlogic_children = dict(self.nonlogic_children)
+            self.index = dict(self.index)
+            self.index_owned = set()
+            self.owner = self.token
 
-    def add_fact(self, fact: Fact):
+    def add_fact(self, fact: Fact) -> bool:
         '''
-        Add a new fact to the set.
+        Add a new fact to the set, update the counts of facts in the nodes
+        it goes through, and return whether it was not already in the set.
         '''
-        paths = fact.get_all_paths()
-        self.follow_paths(paths, self.kb)
+        leaf = self.get_fact_leaf(fact.get_leaf_paths())
+        if leaf is not None and leaf.fact is not None:
+            return False
+        if self.kb.query_cache is not None:
+            self.kb.query_cache.invalidate(fact)
+        self._own_root()
+        nodes : Dict[int, SSNode] = {}
+        ends : List[SSNode] = []
+        end = self.follow_paths(fact.layout, self.kb, nodes, ends)
+        end.fact = Fact(fact.text, fact.paths)
+        for node in nodes.values():
+            node.count += 1
+        for node in ends:
+            node.ends += 1
+        self.count += 1
+        return True
+
+    def iter_facts(self) -> Iterator[Fact]:
+        '''
+        Yield the facts in the set, walking the nodes of the leaves of the
+        facts.
+        '''
+        stack : List[BaseSSNode] = [self]
+        while stack:
+            node = stack.pop()
+            for children in (node.nonlogic_children, node.logic_children):
+                for child in children.values():
+                    if child.path.is_leaf():
+                        if child.fact is not None:
+                            yield child.fact
+                        stack.append(child)
 
     def ask_fact(self, fact : Fact) -> List[Matching]:
         '''
@@ -166,22 +413,288 @@ class FactSet(BaseSSNode):
         self.response = []
         paths = fact.get_leaf_paths()
         matching = Matching(origin=fact)
-        self.query_paths(paths, matching, self.kb)
+        self._query(paths, matching)
         return self.response
 
-    def rm_fact(self, fact : Fact, kb : Any):
+    def index_node(self, node : SSNode):
+        '''
+        Add a node to the secondary index of the productions in indexed.
+        '''
+        self._own_bucket(node.path)[id(node)] = node
+
+    def unindex_node(self, node : SSNode):
+        if node.path not in self.index:
+            return
+        nodes = self._own_bucket(node.path)
+        nodes.pop(id(node), None)
+        if not nodes:
+            del self.index[node.path]
+            self.index_owned.discard(node.path)
+
+    def _own_bucket(self, path : Path) -> Dict[int, SSNode]:
+        '''
+        Return the nodes indexed under path, copying them first if they are
+        shared with a fork or a snapshot, so that only the buckets that are
+        changed are copied.
+        '''
+        nodes = self.index.get(path)
+        if nodes is None or path not in self.index_owned:
+            nodes = self.index[path] = dict(nodes or ())
+            self.index_owned.add(path)
+        return nodes
+
+    def _query(self, paths : List[Path], matching : Matching):
+        '''
+        Query the paths, starting from the most selective indexed leaf if
+        there is one after a free variable, or from the root otherwise.
+        '''
+        if self.index:
+            start = self._pick_index(paths, matching)
+            if start is not None:
+                k, path = start
+                for node in list(self.index.get(path, {}).values()):
+                    self._query_from(node, paths, k, matching)
+                return
+        self._walk(self, paths, matching)
+
+    def _walk(self, node : BaseSSNode, paths : Sequence[Path],
+              matching : Matching):
+        '''
+        Match the paths from the node, with the walker generated for their
+        shape if the knowledge base compiles its queries, or with
+        query_paths otherwise.
         '''
+        walkers = self.kb.walkers
+        if walkers is not None:
+            walker = walkers.walker(paths, matching, self.kb)
+            if walker is not None:
+                walker(node, paths, matching, self.response)
+                return
+        node.query_paths(paths, matching, self.kb)
+
+    def _pick_index(self, paths : List[Path],
+                    matching : Matching) -> Optional[Tuple[int, Path]]:
+        free = False
+        best : Optional[Tuple[int, Path]] = None
+        best_count = 0
+        for k, path in enumerate(paths):
+            if path.is_var():
+                if path.value not in matching:
+                    free = True
+                    continue
+                path, _ = path.substitute(matching)
+            if free and path.value.name in self.indexed and path.is_leaf():
+                count = len(self.index.get(path, ()))
+                if best is None or count < best_count:
+                    best, best_count = (k, path), count
+        return best
+
+    def _query_from(self, node : SSNode, paths : List[Path], k : int,
+                    matching : Matching):
         '''
+        Match the first k paths with the ancestors of the node, and the
+        paths after the k-th with its descendants.
+        '''
+        new_matching = self._match_ancestors(node, paths, k, matching)
+        if new_matching is not None:
+            self._walk(node, paths[k + 1:], new_matching)
+
+    def _match_ancestors(self, node : SSNode, paths : List[Path], k : int,
+                         matching : Matching) -> Optional[Matching]:
+        chain : List[SSNode] = []
+        ancestor : BaseSSNode = node
+        while ancestor.parent is not None:
+            chain.append(cast(SSNode, ancestor))
+            ancestor = ancestor.parent
+        if len(chain) != k + 1:
+            return None
+        chain.reverse()
+        for path, child in zip(paths[:k], chain):
+            if path.is_var():
+                syn = path.value
+                if syn not in matching:
+                    if not self.kb.in_var_range(child.path):
+                        return None
+                    matching = matching.setitem(syn, child.path.value)
+                    continue
+                path, _ = path.substitute(matching)
+            if child.path != path:
+                return None
+        return matching
+
+    def count_fact(self, fact : Fact, matching : Optional[Matching] = None) -> int:
+        '''
+        Return the number of facts in the set that match the provided fact.
+        '''
+        if matching is None:
+            matching = Matching(origin=fact)
         paths = fact.get_leaf_paths()
-        leaf = self.get_fact_leaf(paths)
-        while (leaf and
-                not leaf.logic_children and
-                not leaf.nonlogic_children and
-                leaf is not self):
-            parent = leaf.parent
-            path = leaf.path
-            if kb.in_var_range(path):
-                del parent.logic_children[path]
+        free_from = self._free_from(paths, matching)
+        if self.index:
+            start = self._pick_index(paths, matching)
+            if start is not None:
+                k, path = start
+                total = 0
+                for node in list(self.index.get(path, {}).values()):
+                    new_matching = self._match_ancestors(node, paths, k,
+                                                         matching)
+                    if new_matching is not None:
+                        total += node.count_paths(paths, k + 1, free_from,
+                                                  new_matching, self.kb)
+                return total
+        return self.count_paths(paths, 0, free_from, matching, self.kb)
+
+    @staticmethod
+    def _free_from(paths : List[Path], matching : Any) -> int:
+        '''
+        Return the index from which all the paths are distinct free
+        variables.
+        '''
+        seen : Dict[Segment, int] = {}
+        for path in paths:
+            if path.is_var():
+                seen[path.value] = seen.get(path.value, 0) + 1
+        free_from = len(paths)
+        for path in reversed(paths):
+            if (not path.is_var() or path.value in matching or
+                    seen[path.value] > 1):
+                break
+            free_from -= 1
+        return free_from
+
+    def match_paths(self, paths : List[Path], matching : Matching) -> List[Matching]:
+        '''
+        Return the extensions of the matching that match the paths with
+        facts in the set.
+        '''
+        response = self.response
+        self.response = []
+        self._query(paths, matching)
+        found, self.response = self.response, response
+        return found
+
+    def estimate(self, paths : List[Path], bound : Set[Segment],
+                 cap : int = 64) -> float:
+        '''
+        Estimate the number of facts that match the paths, taking the
+        variables in bound as having some (yet unknown) value. To keep the
+        estimation cheap, at most cap nodes are visited at each level of the
+        tree, and the rest are extrapolated; and once the rest of the paths
+        are distinct free variables, the counts kept in the nodes are used.
+        '''
+        free_from = self._free_from(paths, bound)
+        bound = set(bound)
+        frontier : List[Tuple[BaseSSNode, float]] = [(self, 1.0)]
+        for i, path in enumerate(paths):
+            if i >= free_from:
+                return sum(w * node.count for node, w in frontier)
+            new_frontier : List[Tuple[BaseSSNode, float]] = []
+            if path.is_var():
+                syn = path.value
+                for node, weight in frontier:
+                    children = node.logic_children
+                    if syn in bound and children:
+                        weight = weight / len(children)
+                    new_frontier.extend((ch, weight) for ch in children.values())
+                bound.add(syn)
             else:
-                del parent.nonlogic_children[path]
-            leaf = cast(SSNode, parent)
+                logic = self.kb.in_var_range(path)
+                for node, weight in frontier:
+                    if logic:
+                        child = node.logic_children.get(path.identity_tuple)
+                    else:
+                        child = node.nonlogic_children.get(path.identity_tuple)
+                    if child is not None:
+                        new_frontier.append((child, weight))
+            if len(new_frontier) > cap:
+                scale = len(new_frontier) / cap
+                new_frontier = [(n, w * scale) for n, w in new_frontier[:cap]]
+            frontier = new_frontier
+            if not frontier:
+                return 0.0
+        estimate = sum(w for _, w in frontier)
+        for path in paths:
+            if not path.is_var() and path in self.index:
+                estimate = min(estimate, len(self.index[path]))
+        return estimate
+
+    def plan(self, facts : List[Fact]) -> List[Fact]:
+        '''
+        Order the facts in a conjunctive query so that each has the least
+        estimated number of matches, given the variables bound by the
+        previous ones.
+        '''
+        if len(facts) < 2:
+            return list(facts)
+        bound : Set[Segment] = set()
+        pending = list(facts)
+        plan = []
+        while pending:
+            best = min(pending,
+                       key=lambda f: self.estimate(f.get_leaf_paths(), bound))
+            pending.remove(best)
+            plan.append(best)
+            bound.update(p.value for p in best.get_leaf_paths() if p.is_var())
+        return plan
+
+    def ask_facts(self, facts : List[Fact],
+                  limit : Optional[int] = None) -> Iterator[Matching]:
+        '''
+        Yield the matchings that satisfy all the facts at the same time, up
+        to limit. The facts are joined in the order given by plan, passing
+        the bindings found for each fact on to the query for the next.
+        '''
+        plan = [f.get_leaf_paths() for f in self.plan(facts)]
+        matching = Matching(origin=facts[0])
+        return islice(self._join(plan, 0, matching), limit)
+
+    def count_facts(self, facts : List[Fact]) -> int:
+        '''
+        Return the number of matchings that satisfy all the facts at the
+        same time. All but the last of the facts in the plan are joined, and
+        the matches for the last are counted.
+        '''
+        plan = self.plan(facts)
+        paths = [f.get_leaf_paths() for f in plan[:-1]]
+        matching = Matching(origin=facts[0])
+        return sum(self.count_fact(plan[-1], m)
+                   for m in self._join(paths, 0, matching))
+
+    def _join(self, plan : List[List[Path]], i : int,
+              matching : Matching) -> Iterator[Matching]:
+        if i == len(plan):
+            yield matching
+            return
+        for m in self.match_paths(plan[i], matching):
+            yield from self._join(plan, i + 1, m)
+
+    def rm_fact(self, fact : Fact, kb : Any) -> bool:
+        '''
+        Remove a fact from the set, pruning the nodes that no longer have
+        facts under them, and return whether it was in the set.
+        '''
+        leaf = self.get_fact_leaf(fact.get_leaf_paths())
+        if leaf is None or leaf.fact is None:
+            return False
+        if kb.query_cache is not None:
+            kb.query_cache.invalidate(fact)
+        self._own_root()
+        nodes : Dict[int, SSNode] = {}
+        ends : List[SSNode] = []
+        self.collect_nodes(fact.layout, kb, nodes, ends)
+        cast(SSNode, self.get_fact_leaf(fact.get_leaf_paths())).fact = None
+        self.count -= 1
+        for node in ends:
+            node.ends -= 1
+        for node in nodes.values():
+            node.count -= 1
+            if node.count == 0:
+                path = node.path
+                parent = cast(BaseSSNode, node.parent)
+                if kb.in_var_range(path):
+                    parent.logic_children.pop(path.identity_tuple, None)
+                else:
+                    parent.nonlogic_children.pop(path.identity_tuple, None)
+                if path in self.index:
+                    self.unindex_node(node)
+        return True
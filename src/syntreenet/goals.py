@@ -0,0 +1,353 @@
+# Copyright (c) 2019 by Enrique Pérez Arnaud <enrique@cazalla.net>
+#
+# This file is part of the syntreenet project.
+# https://syntree.net
+#
+# The syntreenet project is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The syntreenet project is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with any part of the terms project.
+# If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import annotations
+
+import time
+from itertools import chain
+from dataclasses import dataclass, field
+from typing import List, Dict, Tuple, Iterator, Optional, Any
+
+from .grammar import Segment, Fact, Matching
+
+
+class BudgetExhausted(Exception):
+    '''
+    Raised when a proof runs out of time.
+    '''
+
+
+@dataclass(frozen=True)
+class Answer:
+    '''
+    An answer to a goal. It has the bindings for the variables in the goal,
+    and the facts that are missing from the knowledge base for the goal, with
+    those bindings, to be derived. height is the number of rule steps taken
+    to reach the answer.
+    '''
+    matching : Matching = field(default_factory=Matching)
+    needs : tuple = field(default_factory=tuple)  # Tuple[Fact...]
+    height : int = 0
+
+    @property
+    def key(self) -> tuple:
+        bindings = tuple(sorted((str(k), str(v))
+                                for k, v in self.matching.mapping))
+        needs = tuple(sorted(str(n) for n in self.needs))
+        return bindings, needs
+
+
+@dataclass
+class GoalTable:
+    '''
+    The table of answers for a (normalized) goal.
+    '''
+    goal : Fact
+    answers : Dict[tuple, Answer] = field(default_factory=dict)
+    depth : int = -1
+    complete : bool = False
+    index : Optional[int] = None
+    low : int = 0
+
+    def add(self, answer : Answer) -> bool:
+        '''
+        Add an answer to the table, and return whether it was new (or a
+        shorter derivation of a known answer). Answers that need a superset
+        of the facts needed by a known answer with the same bindings are
+        discarded.
+        '''
+        key = answer.key
+        old = self.answers.get(key)
+        if old is not None:
+            if old.height <= answer.height:
+                return False
+        else:
+            bindings, needs = key
+            for old_bindings, old_needs in self.answers:
+                if old_bindings == bindings and set(old_needs) < set(needs):
+                    return False
+        self.answers[key] = answer
+        return True
+
+
+def get_vars(fact : Fact) -> List[Segment]:
+    '''
+    Return the variables in the fact, in order and without repetitions.
+    '''
+    variables : List[Segment] = []
+    for path in fact.get_leaf_paths():
+        if path.is_var() and path.value not in variables:
+            variables.append(path.value)
+    return variables
+
+
+def is_goal_var(var : Segment) -> bool:
+    '''
+    Whether the variable is one of the variables in a normalized goal.
+    '''
+    return var.text.startswith('__') and not var.text.startswith('___')
+
+
+@dataclass
+class Prover:
+    '''
+    Tabled backward chaining through the tree of consecuences.
+
+    Each goal (up to renaming of variables) gets a table with its answers.
+    Goals that are reached again while they are being solved are answered
+    with the answers found so far, and the goal that heads such a loop is
+    solved again until no new answers are found for it or for the goals it
+    depends on. The depth budget bounds the number of rule steps in any
+    answer, and the time budget the duration of the whole proof.
+    '''
+    kb : Any
+    max_depth : int = 3
+    timeout : Optional[float] = None
+    tables : Dict[tuple, GoalTable] = field(default_factory=dict)
+    stack : List[GoalTable] = field(default_factory=list)
+    pending : List[GoalTable] = field(default_factory=list)
+    changes : int = 0
+    fresh : int = 0
+    deadline : Optional[float] = None
+
+    def prove(self, goal : Fact) -> Iterator[List[Fact]]:
+        '''
+        Yield, as they are found, the lists of facts that would be needed
+        to derive the goal.
+        '''
+        if self.timeout is not None:
+            self.deadline = time.monotonic() + self.timeout
+        _, entry, varmap = self._get_table(goal)
+        trivial = ((), (str(entry.goal),))
+        seen = set()
+        known = list(entry.answers.values())
+        if entry.complete and entry.depth >= self.max_depth:
+            new : Iterator[Answer] = iter(())
+        else:
+            new = self._run(entry, self.max_depth)
+        try:
+            for answer in chain(known, new):
+                if answer.key == trivial or answer.height > self.max_depth:
+                    continue
+                needs = [n.substitute(varmap, self.kb) for n in answer.needs]
+                needs_key = tuple(str(n) for n in needs)
+                if needs_key not in seen:
+                    seen.add(needs_key)
+                    yield needs
+        except BudgetExhausted:
+            pass
+        finally:
+            for table in self.pending:
+                table.index = None
+                if not table.complete:
+                    self.tables.pop(self._key(table.goal), None)
+            self.pending = []
+
+    def _key(self, fact : Fact) -> tuple:
+        return tuple(fact.get_leaf_paths())
+
+    def _get_table(self, goal : Fact) -> Tuple[tuple, GoalTable, Matching]:
+        varmap, paths = goal.normalize(self.kb)
+        key = tuple(paths)
+        entry = self.tables.get(key)
+        if entry is None:
+            norm = goal.substitute(varmap.invert(), self.kb)
+            entry = self.tables[key] = GoalTable(norm)
+        return key, entry, varmap
+
+    def _check_budget(self):
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            raise BudgetExhausted()
+
+    def _run(self, entry : GoalTable, depth : int) -> Iterator[Answer]:
+        '''
+        Solve the goal in the table until no new answers are found, yielding
+        the new answers.
+        '''
+        index = len(self.stack)
+        entry.index = entry.low = index
+        entry.depth = depth
+        entry.complete = False
+        self.stack.append(entry)
+        start = len(self.pending)
+        self.pending.append(entry)
+        try:
+            while True:
+                changes = self.changes
+                yield from self._evaluate(entry, depth)
+                if entry.low < index or changes == self.changes:
+                    break
+        finally:
+            self.stack.pop()
+            entry.index = None
+        if entry.low == index:
+            for table in self.pending[start:]:
+                table.complete = True
+            del self.pending[start:]
+
+    def _solve(self, goal : Fact, depth : int) -> List[Answer]:
+        '''
+        Return the answers to a subgoal, in terms of its own variables.
+        '''
+        _, entry, varmap = self._get_table(goal)
+        caller = self.stack[-1]
+        if entry.index is not None:
+            caller.low = min(caller.low, entry.index)
+        elif not entry.complete or entry.depth < depth:
+            for _ in self._run(entry, depth):
+                pass
+            if not entry.complete:
+                caller.low = min(caller.low, entry.low)
+        return [self._import(a, varmap) for a in entry.answers.values()
+                if a.height <= depth]
+
+    def _import(self, answer : Answer, varmap : Matching) -> Answer:
+        '''
+        Translate an answer from the variables of a normalized goal to the
+        variables of the actual goal, renaming apart any other variable.
+        '''
+        matching = answer.matching.get_real_matching(varmap)
+        if not answer.needs:
+            return Answer(matching, (), answer.height)
+        renaming = varmap
+        for need in answer.needs:
+            for var in get_vars(need):
+                if var not in renaming:
+                    self.fresh += 1
+                    new_var = Segment(f'___X{self.fresh}', '__var__')
+                    renaming = renaming.setitem(var, new_var)
+        needs = tuple(n.substitute(renaming, self.kb) for n in answer.needs)
+        return Answer(matching, needs, answer.height)
+
+    def _evaluate(self, entry : GoalTable, depth : int) -> Iterator[Answer]:
+        self._check_budget()
+        goal = entry.goal
+        known = self.kb.ask(goal)
+        if known:
+            for m in known:
+                answer = Answer(Matching(m.mapping), (), 0)
+                if self._add(entry, answer):
+                    yield answer
+            return
+        answer = Answer(Matching(), (goal,), 0)
+        if self._add(entry, answer):
+            yield answer
+        if depth <= 0:
+            return
+        for rule, theta, bindings in self._rules_for(goal):
+            for answer in self._solve_body(goal, rule, theta, bindings, depth):
+                if self._add(entry, answer):
+                    yield answer
+
+    def _add(self, entry : GoalTable, answer : Answer) -> bool:
+        if entry.add(answer):
+            self.changes += 1
+            return True
+        return False
+
+    def _rules_for(self, goal : Fact) -> Iterator[tuple]:
+        '''
+        Find the rules with consecuences that unify with the goal, and yield
+        them with the corresponding substitution for their variables, and the
+        bindings for the variables in the goal.
+        '''
+        response : list = []
+        self.kb.sset.unify(goal.layout, Matching(origin=goal), Matching(),
+                           self.kb, response)
+        for endnode, matching, bindings in response:
+            for _, varmap, rule in list(endnode.continuations.values()):
+                real = matching.get_real_matching(varmap)
+                theta = Matching(tuple((k, bindings.get(v) or v)
+                                       for k, v in real.mapping))
+                yield rule, theta, bindings
+
+    def _solve_body(self, goal : Fact, rule : Any, theta : Matching,
+                    bindings : Matching, depth : int) -> Iterator[Answer]:
+        '''
+        Solve the conditions of a rule (with the variables in its consecuence
+        already substituted), and yield the corresponding answers to the goal,
+        leaving out those for which some negated condition of the rule is in
+        the knowledge base.
+        '''
+        kb = self.kb
+        conds = [c.substitute(theta, kb) for c in rule.conditions]
+        nots = [n.substitute(theta, kb) for n in rule.negations]
+        partial : List[Tuple[Matching, tuple, int]] = [(Matching(), (), 0)]
+        for cond in conds:
+            new_partial = []
+            for m, needs, height in partial:
+                c = cond.substitute(m, kb) if m.mapping else cond
+                for answer in self._solve(c, depth - 1):
+                    new_partial.append((m.merge(answer.matching),
+                                        needs + answer.needs,
+                                        max(height, answer.height)))
+            partial = new_partial
+
+        goal_vars = get_vars(goal)
+        for m, needs, height in partial:
+            rule_matching = m
+            for k, v in theta.mapping:
+                value = m.get(v) if v.is_var() else v
+                if value is not None:
+                    rule_matching = rule_matching.setitem(k, value)
+            # variables only bound in the needs are left unbound, and python
+            # extra conditions that use them cannot be evaluated.
+            try:
+                extra = kb._extra_matchings(rule, rule_matching)
+            except NameError:
+                continue
+            for em in extra:
+                # as in NegationSet, variables left unbound in a negated
+                # condition match any fact.
+                if any(kb.ask(n.substitute(em, kb)) for n in nots):
+                    continue
+                yield self._make_answer(goal_vars, theta, bindings, em,
+                                        needs, height + 1)
+
+    def _make_answer(self, goal_vars : List[Segment], theta : Matching,
+                     bindings : Matching, matching : Matching,
+                     needs : tuple, height : int) -> Answer:
+        answer_matching = Matching()
+        for var in goal_vars:
+            value = bindings.get(var) or matching.get(var)
+            if value is None:
+                for k, v in theta.mapping:
+                    if v == var and matching.get(k) is not None:
+                        value = matching.get(k)
+                        break
+            if value is not None and not value.is_var():
+                answer_matching = answer_matching.setitem(var, value)
+
+        full = matching.merge(answer_matching)
+        new_needs : Dict[str, Fact] = {}
+        for need in needs:
+            new_need = need.substitute(full, self.kb)
+            new_needs[str(new_need)] = new_need
+
+        renaming = Matching()
+        counter = 0
+        for text in sorted(new_needs):
+            for var in get_vars(new_needs[text]):
+                if not is_goal_var(var) and var not in renaming:
+                    counter += 1
+                    new_var = Segment(f'___X{counter}', '__var__')
+                    renaming = renaming.setitem(var, new_var)
+        final_needs = tuple(n.substitute(renaming, self.kb) if renaming.mapping
+                            else n for n in new_needs.values())
+        return Answer(answer_matching, final_needs, height)
@@ -19,13 +19,24 @@
 
 from __future__ import annotations
 
-from dataclasses import dataclass, field
+from array import array
+from dataclasses import dataclass, field, fields
+from functools import cached_property
 from typing import List, Tuple, Optional, Any, cast
 
 from parsimonious.nodes import Node
 from parsimonious.expressions import Expression
 
 
+def _reduce(obj : Any) -> Tuple[Any, tuple]:
+    '''
+    Pickle frozen dataclasses through their constructor; the default protocol
+    sets their attributes one by one, which compiled (mypyc) frozen
+    dataclasses do not allow.
+    '''
+    return type(obj), tuple(getattr(obj, f.name) for f in fields(obj) if f.init)
+
+
 @dataclass(frozen=True)
 class Segment:
     '''
@@ -37,6 +48,9 @@ class Segment:
     leaf : bool = False
     identity_tuple : tuple = field(init=False)
 
+    def __reduce__(self) -> Tuple[Any, tuple]:
+        return _reduce(self)
+
     def __post_init__(self):
         object.__setattr__(self, 'identity_tuple', (self.name, self.text))
         if self.end == 0:
@@ -83,13 +97,22 @@ class Path:
     '''
     segments : tuple = field(default_factory=tuple)  # Tuple[Segment...]
     identity_tuple : tuple = field(init=False)
-    deep_identity_tuple : tuple = field(init=False)
+
+    def __reduce__(self) -> Tuple[Any, tuple]:
+        return _reduce(self)
 
     def __post_init__(self):
-        i = tuple(s.name for s in self.segments) + (self.segments[-1].text,)
+        i = tuple([s.name for s in self.segments] + [self.segments[-1].text])
         object.__setattr__(self, 'identity_tuple', i)
-        object.__setattr__(self, 'deep_identity_tuple',
-                           tuple(hash(s) for s in self.segments))
+
+    @cached_property
+    def deep_identity_tuple(self) -> tuple:
+        '''
+        The hashes of all the segments in the path. This is only needed by
+        starts_with, so it is computed on first use; walking the paths of a
+        fact is done through its layout.
+        '''
+        return tuple(hash(s) for s in self.segments)
 
     def __str__(self) -> str:
         return ' - '.join(self.identity_tuple)
@@ -189,7 +212,7 @@ class Path:
         while paths:
             path = paths.pop(0)
             for opath in old_paths:
-                if path.starts_with(opath):
+                if common_depth(path, opath) == len(opath):
                     break
             else:
                 new_path, old_path = path.substitute(matching) 
@@ -200,6 +223,83 @@ class Path:
         return new_paths
 
 
+def common_depth(path1 : Path, path2 : Path) -> int:
+    '''
+    Return the number of leading segments that correspond to the same
+    syntactic elements in both paths, i.e., the depth of their closest common
+    ancestor plus one. Sibling elements with the same text are told apart by
+    their offsets within their parent.
+    '''
+    depth = 0
+    for s1, s2 in zip(path1.segments, path2.segments):
+        if s1 is not s2 and (s1.identity_tuple, s1.start, s1.end) != (
+                s2.identity_tuple, s2.start, s2.end):
+            break
+        depth += 1
+    return depth
+
+
+@dataclass(frozen=True)
+class Layout:
+    '''
+    A flat layout of the paths of a fact, in which skipping past a
+    sub-expression is a single jump of index.
+
+    paths are all the (non whitespace) paths of the fact, in order, and
+    skips[j] is the index in paths of the first path after the sub-expression
+    that corresponds to the j-th path.
+
+    leaves are the leaf paths of the fact, in order, and
+    ends[offsets[i] + d] is the index in leaves of the first leaf after the
+    sub-expression that corresponds to the d-th segment of the i-th leaf.
+    '''
+    paths : tuple
+    skips : array
+    leaves : tuple
+    ends : array
+    offsets : array
+
+    def __reduce__(self) -> Tuple[Any, tuple]:
+        return _reduce(self)
+
+    @classmethod
+    def from_paths(cls, paths : tuple, leaves : tuple) -> Layout:
+        num_paths = len(paths)
+        skips = array('l', [num_paths]) * num_paths
+        opened : List[int] = []
+        for k in range(1, num_paths):
+            depth = common_depth(paths[k - 1], paths[k])
+            while opened and len(paths[opened[-1]]) > depth:
+                skips[opened.pop()] = k
+            if len(paths[k - 1]) > depth:
+                skips[k - 1] = k
+            else:
+                opened.append(k - 1)
+
+        num_leaves = len(leaves)
+        rows : List[tuple] = [()] * num_leaves
+        for i in range(num_leaves - 1, -1, -1):
+            size = len(leaves[i])
+            if i + 1 < num_leaves:
+                depth = common_depth(leaves[i], leaves[i + 1])
+                rows[i] = rows[i + 1][:depth] + (i + 1,) * (size - depth)
+            else:
+                rows[i] = (num_leaves,) * size
+        ends = array('l')
+        offsets = array('l')
+        for row in rows:
+            offsets.append(len(ends))
+            ends.extend(row)
+        return cls(paths, skips, leaves, ends, offsets)
+
+    def leaf_end(self, i : int, depth : int) -> int:
+        '''
+        Return the index of the first leaf after the sub-expression that
+        corresponds to the segment at depth in the i-th leaf.
+        '''
+        return self.ends[self.offsets[i] + depth]
+
+
 @dataclass(frozen=True)
 class Fact:
     '''
@@ -207,17 +307,35 @@ class Fact:
     text : str
     paths : tuple = field(default_factory=tuple)
 
+    def __reduce__(self) -> Tuple[Any, tuple]:
+        return _reduce(self)
+
     def __str__(self):
         return self.text
 
     def __repr__(self):
         return f'<Fact <{self.text}>'
 
+    @cached_property
+    def all_paths(self) -> tuple:
+        return tuple(p for p in self.paths if bool(p[-1].text.strip()))
+
+    @cached_property
+    def leaf_paths(self) -> tuple:
+        return tuple(p for p in self.all_paths if p.is_leaf())
+
+    @cached_property
+    def layout(self) -> Layout:
+        '''
+        The flat layout of the paths of the fact, computed on first use.
+        '''
+        return Layout.from_paths(self.all_paths, self.leaf_paths)
+
     def get_all_paths(self) -> List[Path]:
-        return list(p for p in self.paths if bool(p[-1].text.strip()))
+        return list(self.all_paths)
 
     def get_leaf_paths(self) -> List[Path]:
-        return list(p for p in self.paths if p.is_leaf() and bool(p[-1].text.strip()))
+        return list(self.leaf_paths)
 
     def substitute(self, matching: Matching, kb) -> Fact:
         '''
@@ -252,6 +370,9 @@ class Matching:
     mapping : tuple = field(default_factory=tuple)  # Tuple[Tuple[Segment, Segment]]
     origin : Optional[Fact] = None
 
+    def __reduce__(self) -> Tuple[Any, tuple]:
+        return _reduce(self)
+
     def __str__(self) -> str:
         return ', '.join([f'{k} : {v}' for k, v in self.mapping])
 
@@ -309,7 +430,7 @@ class Matching:
         mapping = tuple((v, k) for k, v in self.mapping)
         return Matching(mapping, self.origin)
 
-    def merge(self, other : Matching) -> Matching:
+    def merge(self, other : Optional[Matching]) -> Matching:
         '''
         '''
         if other is None:
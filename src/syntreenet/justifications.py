@@ -0,0 +1,227 @@
+# Copyright (c) 2019 by Enrique Pérez Arnaud <enrique@cazalla.net>
+#
+# This file is part of the syntreenet project.
+# https://syntree.net
+#
+# The syntreenet project is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The syntreenet project is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with any part of the terms project.
+# If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import annotations
+
+from array import array
+from dataclasses import dataclass, field
+from typing import List, Dict, Optional, Tuple, Any
+
+NO_STEP = -1
+
+
+def _int_array() -> array:
+    return array('i')
+
+
+@dataclass
+class Justifications:
+    '''
+    The graph of justifications of the derived facts, kept as parallel
+    arrays of integers rather than as objects.
+
+    Facts and told rules are numbered in the order in which they are first
+    seen. Each step records that a fact (support) matched a condition of a
+    rule (or of a rule derived from it), and points to the previous step,
+    so that the steps that led to a partial rule form a chain, that ends at
+    a step with no support that holds the number of the told rule. A rule
+    carries the number of its last step, and a derived fact the number of
+    the step that produced it (or NO_STEP if it was told).
+
+    Everything but the reasons is only appended to, so a snapshot is made
+    of the lengths of the lists, and, while there are snapshots, the
+    reasons that are changed are logged in changes, with their previous
+    values, to be undone when restoring a snapshot.
+
+    The justifications are shared with forks of the knowledge base: owner
+    is the token of the justifications that can change the lists in place,
+    and otherwise they are copied before the first change.
+    '''
+    fact_numbers : Dict[str, int] = field(default_factory=dict)
+    facts : List[str] = field(default_factory=list)
+    rules : List[str] = field(default_factory=list)
+    reasons : array = field(default_factory=_int_array)
+    step_rules : array = field(default_factory=_int_array)
+    step_supports : array = field(default_factory=_int_array)
+    step_previous : array = field(default_factory=_int_array)
+    changes : Optional[List[Tuple[int, int]]] = None
+    token : Any = field(default_factory=object)
+    owner : Any = None
+
+    def __post_init__(self):
+        self.owner = self.token
+
+    def _number(self, text : str) -> int:
+        number = self.fact_numbers.get(text)
+        if number is None:
+            self._own()
+            number = self.fact_numbers[text] = len(self.facts)
+            self.facts.append(text)
+            self.reasons.append(NO_STEP)
+        return number
+
+    def add_rule(self, text : str) -> int:
+        '''
+        Record a told rule, and return the number of the step at the root of
+        its chains of supports.
+        '''
+        self._own()
+        self.rules.append(text)
+        return self._add_step(len(self.rules) - 1, NO_STEP, NO_STEP)
+
+    def add_support(self, step : int, support : str) -> int:
+        '''
+        Record that the fact support matched a condition of the rule at the
+        given step, and return the new step.
+        '''
+        return self._add_step(self.step_rules[step], self._number(support),
+                              step)
+
+    def _add_step(self, rule : int, support : int, previous : int) -> int:
+        self._own()
+        self.step_rules.append(rule)
+        self.step_supports.append(support)
+        self.step_previous.append(previous)
+        return len(self.step_rules) - 1
+
+    def add_fact(self, text : str, step : int = NO_STEP):
+        '''
+        Record that a fact was added to the knowledge base, derived at the
+        given step, or told.
+        '''
+        if step != NO_STEP:
+            self._set_reason(self._number(text), step)
+        else:
+            number = self.fact_numbers.get(text)
+            if number is not None:
+                self._set_reason(number, NO_STEP)
+
+    def _set_reason(self, number : int, step : int):
+        self._own()
+        if self.changes is not None:
+            self.changes.append((number, self.reasons[number]))
+        self.reasons[number] = step
+
+    def explain(self, text : str) -> dict:
+        '''
+        Return the justification of a fact, as a dict with the fact, the
+        told rule that derived it (None if it was told), and the
+        justifications of the facts that matched the conditions of the rule.
+        A fact that supports more than one fact gets a single dict, so, if
+        a fact was removed and derived again from facts derived from it,
+        the result has cycles.
+        '''
+        root = self.fact_numbers.get(text)
+        if root is None:
+            return {'fact': text, 'rule': None, 'supports': []}
+        explained : Dict[int, dict] = {
+                root: {'fact': text, 'rule': None, 'supports': []}}
+        stack = [root]
+        while stack:
+            number = stack.pop()
+            step = self.reasons[number]
+            if step == NO_STEP:
+                continue
+            explanation = explained[number]
+            explanation['rule'] = self.rules[self.step_rules[step]]
+            for support in self.get_supports(step):
+                if support not in explained:
+                    explained[support] = {'fact': self.facts[support],
+                                          'rule': None, 'supports': []}
+                    stack.append(support)
+                explanation['supports'].append(explained[support])
+        return explained[root]
+
+    def get_supports(self, step : int) -> List[int]:
+        '''
+        Return the numbers of the facts in the chain of supports that ends at
+        step, in the order in which they matched.
+        '''
+        supports = []
+        while step != NO_STEP:
+            support = self.step_supports[step]
+            if support != NO_STEP:
+                supports.append(support)
+            step = self.step_previous[step]
+        supports.reverse()
+        return supports
+
+    def snapshot(self) -> tuple:
+        '''
+        Return the current state of the justifications, which can later be
+        restored, and start logging the changes to the reasons.
+        '''
+        if self.changes is None:
+            self.changes = []
+        return (len(self.facts), len(self.rules), len(self.step_rules),
+                len(self.changes))
+
+    def restore(self, snapshot : tuple):
+        '''
+        Restore the justifications to the given snapshot, undoing the
+        changes to the reasons logged since, in reverse order, and dropping
+        whatever was appended since.
+        '''
+        num_facts, num_rules, num_steps, num_changes = snapshot
+        self._own()
+        changes = self.changes or []
+        while len(changes) > num_changes:
+            number, step = changes.pop()
+            self.reasons[number] = step
+        for text in self.facts[num_facts:]:
+            del self.fact_numbers[text]
+        del self.facts[num_facts:]
+        del self.reasons[num_facts:]
+        del self.rules[num_rules:]
+        del self.step_rules[num_steps:]
+        del self.step_supports[num_steps:]
+        del self.step_previous[num_steps:]
+
+    def release(self):
+        '''
+        Stop logging the changes to the reasons, once there are no
+        snapshots left.
+        '''
+        self.changes = None
+
+    def _own(self):
+        if self.owner is not self.token:
+            self.fact_numbers = dict(self.fact_numbers)
+            self.facts = list(self.facts)
+            self.rules = list(self.rules)
+            self.reasons = array('i', self.reasons)
+            self.step_rules = array('i', self.step_rules)
+            self.step_supports = array('i', self.step_supports)
+            self.step_previous = array('i', self.step_previous)
+            self.owner = self.token
+
+    def fork(self) -> Justifications:
+        '''
+        Return justifications that share everything with these. Both get
+        new tokens, so from then on each of them copies the lists before
+        changing them.
+        '''
+        self.token = object()
+        justifications = Justifications(self.fact_numbers, self.facts,
+                                        self.rules, self.reasons,
+                                        self.step_rules, self.step_supports,
+                                        self.step_previous)
+        justifications.owner = None
+        return justifications
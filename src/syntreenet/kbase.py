@@ -19,18 +19,38 @@
 
 from __future__ import annotations
 
+import logging
+import math
 import os.path
-import re
-from dataclasses import dataclass, field
-from typing import List, Set, Union, cast
+import time
+from contextlib import contextmanager
+from copy import copy
+from dataclasses import dataclass, field, replace
+from typing import (List, Set, Dict, Union, Iterable, Iterator, Callable, Optional,
+                    Any, cast)
 
 from .grammar import Segment, Path, Fact, Matching
 from .factset import FactSet
-from .ruleset import CondSet, ConsSet, Activation, Rule, ExtraCondition
+from .sqlfactset import SQLFactSet
+from .ruleset import (CondSet, ConsSet, Activation, Rule, ExtraCondition,
+                      Subscription)
 from .extra import ec_handlers
-from .logging import logger
+from .calc import compile_calc
+from .aggregates import Aggregate, AggregateSet, FUNCTIONS
+from .negations import NegationSet
+from .querycache import QueryCache
+from .codegen import Walkers
+from .goals import Prover, GoalTable
+from .transaction import Transaction
+from .timers import TimerWheel
+from .logging import logger, Tracer
+from .records import dump_facts, load_facts
+from .templates import Template
+from .parallel import MatchPool
+from .justifications import Justifications, NO_STEP
+from .compaction import PartialRules
+from .logic import Logic
 
-from parsimonious.grammar import Grammar
 from parsimonious.nodes import Node
 
 
@@ -43,21 +63,74 @@ class KnowledgeBase:
     The object that contains both the graph of rules (or the tree of
     conditions) and the graph of facts.
     '''
-    def __init__(self, grammar_text : str,
+    def __init__(self, grammar_text : Union[str, Logic],
                  fact_rule : str = 'fact',
                  var_range_expr : str = '^v_',
                  base_grammar_fn='../grammars/_base.peg',
-                 backend : str = 'parsimonious'):
+                 backend : str = 'parsimonious',
+                 indexed : tuple = (),
+                 ttl_resolution : float = 1.0,
+                 clock : Callable[[], float] = time.monotonic,
+                 db : Optional[str] = None,
+                 justify : bool = False,
+                 query_cache : int = 0,
+                 compact_after : int = 0,
+                 record_rules : bool = False,
+                 compile_queries : bool = False):
         '''
+        grammar_text is the grammar, or a Logic already made with it (see
+        syntreenet.logic.Logic), that many knowledge bases can share; in
+        that case, fact_rule, var_range_expr and base_grammar_fn are taken
+        from it.
+
+        indexed is a tuple of names of productions, whose values will be
+        indexed in the fact set, to speed up queries with variables before
+        them.
+
+        ttl_resolution is the duration in seconds of a tick of the timer
+        wheel that expires facts told with a ttl, and clock the function
+        that gives the current time in seconds.
+
+        db is the name of a SQLite database file, in which to keep the fact
+        set, instead of keeping it in memory (see sqlfactset.SQLFactSet).
+        Such knowledge bases cannot be forked, and their fact sets are not
+        indexed, so db cannot be given along with indexed.
+
+        If justify is True, the rule and the facts that derived each derived
+        fact are recorded, to be given by explain.
+
+        query_cache is the number of query results to keep in a cache (see
+        syntreenet.querycache.QueryCache); 0 disables the cache.
+
+        compact_after is the number of facts removed after which the
+        knowledge base is compacted (see compact) when it is done processing;
+        0 means that it is only compacted by calling compact.
+
+        If record_rules is True, or compact_after is not 0, the partial rules
+        derived from each rule are recorded, so that they can be retracted
+        along with it (see retract_rule), and removing a fact removes the
+        partial rules derived from it: a fact removed no longer completes
+        the rules it matched, as it does otherwise.
+
+        If compile_queries is True, the fact set is queried with functions
+        generated for the shape of each query, kept in the logic and shared
+        with the knowledge bases that use it (see codegen.Walkers).
         '''
-        if not os.path.isabs(base_grammar_fn):
-            here = os.path.abspath(os.path.dirname(__file__))
-            base_grammar_fn = os.path.join(here, base_grammar_fn)
-        with open(base_grammar_fn) as fh:
-            common = fh.read()
-        self.grammar_text = f"{common}\n{grammar_text}"
-        self.grammar = Grammar(self.grammar_text)
-        self.fset = FactSet(kb=self)
+        if isinstance(grammar_text, Logic):
+            logic = grammar_text
+        else:
+            logic = Logic(grammar_text, fact_rule, var_range_expr,
+                          base_grammar_fn)
+        self.logic = logic
+        self.grammar_text = logic.text
+        self.grammar = logic.grammar
+        self.fset : Union[FactSet, SQLFactSet]
+        if db is not None and indexed:
+            raise ValueError('Fact sets kept in a database are not indexed')
+        if db is None:
+            self.fset = FactSet(kb=self, indexed=set(indexed))
+        else:
+            self.fset = SQLFactSet(kb=self, filename=db)
         self.dset = CondSet(kb=self)
         self.sset = ConsSet(kb=self)
         self.activations : List[Activation] = list()
@@ -65,21 +138,66 @@ class KnowledgeBase:
         self.counter = 0
         self.querying_rules = True
         self.seen_rules : Set[str] = set()
-        self.fact_rule : str = fact_rule
-        self.var_range_expr = re.compile(var_range_expr)
+        self.fact_rule : str = logic.fact_rule
+        self.var_range_expr = logic.var_range_re
+        self.var_range : Dict[str, bool] = logic.var_range
+        self.goal_tables : Dict[tuple, GoalTable] = {}
+        self.tracer : Optional[Tracer] = None
+        self.subscriptions = 0
+        self.aggregates : Optional[AggregateSet] = None
+        self.negations : Optional[NegationSet] = None
+        self.query_cache : Optional[QueryCache] = None
+        if query_cache:
+            self.query_cache = QueryCache(query_cache)
+        self.ttl_resolution = ttl_resolution
+        self.clock = clock
+        self.timers = TimerWheel(self._ticks(clock()))
+        self.deadlines : Dict[str, int] = {}
+        self.deadlines_owner : Any = self.timers.token
+        self.justifications : Optional[Justifications] = None
+        if justify:
+            self.justifications = Justifications()
+        self.partial_rules = PartialRules()
+        self.record_rules = record_rules or bool(compact_after)
+        self.compact_after = compact_after
+        self.removed = 0
+        self.pool : Optional[MatchPool] = None
+        self.transactions = 0
+        self.walkers : Optional[Walkers] = None
+        if compile_queries:
+            self.walkers = logic.walkers
 
     def parse(self, s : str) -> Node:
         tree = self.grammar.parse(s)
         return tree.children[0]
 
-    def in_var_range(self, path):
-        return bool(self.var_range_expr.match(path[-1].name))
+    def in_var_range(self, path : Union[Path, tuple]) -> bool:
+        '''
+        Whether the production of the last segment of the path is in the
+        range of the logical variables. The grammar is fixed, so the result
+        is kept for each production, and the regular expression is matched
+        only once for each.
+        '''
+        return self.name_in_var_range(path[-1].name)
+
+    def name_in_var_range(self, name : str) -> bool:
+        '''
+        Whether the production with the given name is in the range of the
+        logical variables, kept in the var_range of the logic.
+        '''
+        logic = self.var_range.get(name)
+        if logic is None:
+            logic = self.var_range[name] = bool(self.var_range_expr.match(name))
+        return logic
 
-    def tell(self, s : str):
+    def tell(self, s : str, ttl : Optional[float] = None):
         '''
-        Add new sentence (rule or fact) to the knowledge base.
+        Add new sentence (rule or fact) to the knowledge base. If a ttl (in
+        seconds) is given for a fact, it will be removed from the knowledge
+        base by the first call to tick made ttl seconds after it was told.
         '''
         tree = self.parse(s)
+        fact = None
         if tree.expr.name == '__rule__':
             activation = self._deal_with_told_rule_tree(tree)
         elif tree.expr.name == self.fact_rule:
@@ -88,18 +206,172 @@ class KnowledgeBase:
         elif tree.expr.name == '__rm__':
             fact = self.from_parse_tree(tree.children[2])
             activation = Activation('rm', fact, data={'query_rules': False})
+        self._tell(activation, fact, ttl)
+
+    def tell_fact(self, fact : Fact, ttl : Optional[float] = None):
+        '''
+        Add a fact already built, e.g. from a template, to the knowledge
+        base, as tell would do with its text.
+        '''
+        activation = Activation('fact', fact, data={'query_rules': False})
+        self._tell(activation, fact, ttl)
+
+    def tell_many(self, sentences : Iterable[str], processes : int = 1):
+        '''
+        Add many facts to the knowledge base at once. The new facts are added
+        to the fact set, and matched against the conditions of the rules,
+        with more than 1 processes in a pool of processes, each with a
+        replica of the tree of conditions; the activations found are then
+        queued in the order of the facts, as if each fact had been told in
+        turn, and processed. The pool is kept in pool for later calls with
+        the same number of processes, until closed with close_pool.
+
+        Since all the facts are added before any activation is processed, the
+        result can differ from telling them one by one only when rules remove
+        facts.
+        '''
+        if self.processing:
+            raise RuntimeError('Cannot tell many facts while processing')
+        self._add_many((self._parse_fact(s) for s in sentences), processes)
+
+    def _parse_fact(self, s : str) -> Fact:
+        tree = self.parse(s)
+        if tree.expr.name != self.fact_rule:
+            raise ValueError(f'{s} is not a fact')
+        return self.from_parse_tree(tree)
+
+    def _add_many(self, facts : Iterable[Fact], processes : int = 1) -> int:
+        '''
+        Add the facts to the fact set, then match the new ones against the
+        tree of conditions and process the activations, as described in
+        tell_many, and return the number of facts given.
+        '''
+        info = logger.isEnabledFor(logging.INFO)
+        new : List[Fact] = []
+        given = 0
+        for fact in facts:
+            given += 1
+            if self.fset.add_fact(fact):
+                if info:
+                    logger.info('adding fact "%s"', fact)
+                if self.justifications is not None:
+                    self.justifications.add_fact(fact.text)
+                if self.aggregates is not None:
+                    self.aggregates.update(fact, 1)
+                if self.negations is not None:
+                    self._update_negations(fact, 1)
+                new.append(fact)
+        if not new:
+            return given
+        self.goal_tables.clear()
+        # The rules made by the activations of a fact must look up the facts
+        # in the fact set, since the facts after it in the batch have already
+        # been matched.
+        self.querying_rules = True
+        if processes > 1:
+            if self.pool is None or self.pool.processes != processes:
+                self.close_pool()
+                self.pool = MatchPool(processes)
+            found = self.pool.match_layouts(self.dset, [f.layout for f in new])
+            for fact, matches in zip(new, found):
+                for endnode, mapping in matches:
+                    endnode.add_matching(Matching(mapping, fact), self.dset)
+        else:
+            for fact in new:
+                self._add_fact(fact)
+        self.process()
+        return given
+
+    def close_pool(self):
+        '''
+        Shut down the pool of processes used by tell_many, if any.
+        '''
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+
+    def template(self, s : str) -> Template:
+        '''
+        Parse a fact with variables, and return a template from which to build
+        facts with the same structure, given the values of its variables,
+        with no parsing (see syntreenet.templates.Template).
+        '''
+        tree = self.parse(s)
+        if tree.expr.name != self.fact_rule:
+            raise ValueError(f'{s} is not a fact')
+        return Template(self, self.from_parse_tree(tree))
+
+    def _tell(self, activation : Activation, fact : Optional[Fact],
+              ttl : Optional[float]):
         self.activations.append(activation)
         self.process()
+        if fact is not None:
+            if ttl is not None and activation.kind == 'fact':
+                deadline = math.ceil((self.clock() + ttl) / self.ttl_resolution)
+                self._own_deadlines()[fact.text] = deadline
+                self.timers.add(deadline, (deadline, fact))
+            elif fact.text in self.deadlines:
+                del self._own_deadlines()[fact.text]
+
+    def _own_deadlines(self) -> Dict[str, int]:
+        '''
+        Return the deadlines of the facts told with a ttl, copying them
+        first if they are shared with a fork or a snapshot; they follow the
+        tokens of the timer wheel.
+        '''
+        if self.deadlines_owner is not self.timers.token:
+            self.deadlines = dict(self.deadlines)
+            self.deadlines_owner = self.timers.token
+        return self.deadlines
+
+    def tick(self, now : Optional[float] = None) -> int:
+        '''
+        Advance the timer wheel up to now (by default, the current time given
+        by the clock), remove the facts whose ttl has expired, and return
+        how many they were. The facts are removed in a single batch, with no
+        parsing; facts derived from them are kept.
+        '''
+        if now is None:
+            now = self.clock()
+        expired = 0
+        for deadline, fact in self.timers.advance(self._ticks(now)):
+            if self.deadlines.get(fact.text) == deadline:
+                del self._own_deadlines()[fact.text]
+                act = Activation('rm', fact, data={'query_rules': False})
+                self.activations.append(act)
+                expired += 1
+        self.process()
+        return expired
+
+    def _ticks(self, seconds : float) -> int:
+        return int(seconds / self.ttl_resolution)
 
     def _deal_with_told_rule_tree(self, tree : Node) -> Activation:
+        rule = self._rule_from_tree(tree)
+        if self.justifications is not None:
+            step = self.justifications.add_rule(tree.text)
+            rule = replace(rule, step=step)
+        if rule.negations and self.negations is None:
+            self.negations = NegationSet(kb=self)
+        act_data = {
+            'matching': EMPTY_MATCHING,
+            'condition': EMPTY_FACT,
+            'query_rules': True
+            }
+        return Activation('rule', rule, data=act_data)
+
+    def _rule_from_tree(self, tree : Node) -> Rule:
         econds : tuple = ()
+        nots : tuple = ()
         for child_node in tree.children:
             if child_node.expr.name == '__conds__':
                 conds = tuple(self.from_parse_tree(ch.children[0]) for ch
                               in child_node.children)
+            elif child_node.expr.name == '__nots__':
+                nots = tuple(self.from_parse_tree(ch.children[0].children[2])
+                             for ch in child_node.children)
             elif child_node.expr.name == '__econds__':
-                econds = tuple(ExtraCondition(kind=ch.children[0].children[2].text,
-                                              text=ch.children[0].children[4].text)
+                econds = tuple(self._extra_condition(ch.children[0])
                                for ch in child_node.children)
             elif child_node.expr.name == '__conss__':
                 conss_list = []
@@ -113,24 +385,270 @@ class KnowledgeBase:
                     pass
                 conss = tuple(conss_list)
                 rms = tuple(rms_list)
-        rule = Rule(conds, econds, conss, rms)
-        act_data = {
-            'matching': EMPTY_MATCHING,
-            'condition': EMPTY_FACT,
-            'query_rules': True
-            }
-        return Activation('rule', rule, data=act_data)
+        return Rule(conds, econds, conss, rms, negations=nots)
 
-    def query(self, q : str) -> Union[dict, bool]:
-        tree = self.parse(q)
-        qf = self.from_parse_tree(tree)
-        response = self.ask(qf)
+    def _extra_condition(self, tree : Node) -> ExtraCondition:
+        '''
+        Build an extra condition from its parse tree. The text of calc
+        conditions is parsed here, once, and compiled.
+        '''
+        kind = tree.children[2].text
+        text = tree.children[4].text
+        if kind == 'calc':
+            calc_tree = self.grammar['__calc__'].parse(text.strip())
+            return ExtraCondition(kind, text, compile_calc(calc_tree))
+        return ExtraCondition(kind, text)
+
+    def parse_facts(self, s : str) -> List[Fact]:
+        '''
+        Build facts from a string with one or more facts separated by
+        semicolons.
+        '''
+        tree = self.grammar['__conds__'].parse(s)
+        return [self.from_parse_tree(ch.children[0]) for ch in tree.children]
+
+    def query(self, q : str, limit : Optional[int] = None) -> Union[list, bool]:
+        '''
+        Query the knowledge base with one or more facts separated by
+        semicolons, that may share variables. Return whether the query holds,
+        or, if it has variables, the (at most limit) variable assigments that
+        make it hold. If the knowledge base has a query cache, the result is
+        taken from it when possible.
+        '''
+        if self.query_cache is not None:
+            return self.query_cache.query(q, limit, self)
+        response = list(self.fset.ask_facts(self.parse_facts(q), limit))
         if not response:
             return False
         if len(response) == 1 and not response[0].mapping:
             return True
         return [m.to_dict() for m in response]
 
+    def query_iter(self, q : str, limit : Optional[int] = None) -> Iterator[dict]:
+        '''
+        Like query, but yield the variable assigments as they are found.
+        '''
+        for m in self.fset.ask_facts(self.parse_facts(q), limit):
+            yield m.to_dict()
+
+    def count(self, q : str) -> int:
+        '''
+        Return the number of variable assigments that make the query hold,
+        without building them when possible. As in query, the query can have
+        several facts separated by semicolons.
+        '''
+        return self.fset.count_facts(self.parse_facts(q))
+
+    def export_facts(self, filename : str) -> int:
+        '''
+        Write the facts in the knowledge base to a file, as JSON lines with
+        their parse trees (see syntreenet.records), and return the number of
+        facts written.
+        '''
+        with open(filename, 'w') as fh:
+            return dump_facts(self.fset.iter_facts(), fh)
+
+    def import_facts(self, filename : str) -> int:
+        '''
+        Tell the knowledge base the facts in a file written by export_facts,
+        building them from their records with no parsing, and return the
+        number of facts read. The facts are added in a single batch, as
+        tell_many does.
+        '''
+        if self.processing:
+            raise RuntimeError('Cannot import facts while processing')
+        with open(filename, 'r') as fh:
+            return self._add_many(load_facts(fh, self))
+
+    def fork(self) -> KnowledgeBase:
+        '''
+        Return a copy of the knowledge base, for hypothetical reasoning,
+        that shares with it all the nodes of its fact set and of its trees of
+        conditions and consecuences. Each of them copies the nodes that it
+        changes (along with their ancestors) before changing them, so
+        forking copies no facts nor rules, and the memory used by a fork is
+        proportional to its changes. Subscriptions and aggregates are not
+        inherited. The counts of the negated conditions of rules, the record
+        of partial rules, the pending timers of facts told with a ttl and the
+        justifications, if recorded, are shared in the same way, so forking
+        costs the same whatever the size of the knowledge base. Knowledge
+        bases that keep their facts in a database (see
+        db in __init__) cannot be forked, and raise TypeError.
+        '''
+        if self.processing:
+            raise RuntimeError('Cannot fork a knowledge base while processing')
+        if isinstance(self.fset, SQLFactSet):
+            raise TypeError('Knowledge bases kept in a database cannot be forked')
+        kb = copy(self)
+        kb.fset = self.fset.fork(kb)
+        kb.dset = self.dset.fork(kb)
+        kb.sset = self.sset.fork(kb)
+        kb.activations = []
+        kb.seen_rules = set()
+        kb.goal_tables = {}
+        kb.tracer = None
+        kb.aggregates = None
+        kb.pool = None
+        kb.transactions = 0
+        if self.query_cache is not None:
+            kb.query_cache = QueryCache(self.query_cache.size)
+        if self.negations is not None:
+            kb.negations = self.negations.fork(kb)
+        kb.timers = self.timers.fork()
+        kb.deadlines_owner = None
+        if self.justifications is not None:
+            kb.justifications = self.justifications.fork()
+        kb.partial_rules = self.partial_rules.fork()
+        return kb
+
+    def compact(self) -> int:
+        '''
+        Reclaim the memory held by what can no longer affect matching: the
+        partial rules that only derive from facts that have been removed
+        (see syntreenet.compaction.PartialRules), if any is left, are
+        removed from the trees of conditions and consecuences, pruning the
+        branches left empty, and the leaf segments that are no longer used
+        are released from the table of the logic. Return the number of
+        partial rules removed. The knowledge base must be recording partial
+        rules (see record_rules in __init__), and so removing a fact already
+        removes the partial rules derived from it.
+        '''
+        if self.processing:
+            raise RuntimeError('Cannot compact a knowledge base while processing')
+        if not self.record_rules:
+            raise RuntimeError('The knowledge base does not record partial rules')
+        orphans = self.partial_rules.orphans(self)
+        for rule in orphans:
+            self.dset.remove_rule(rule)
+            self.sset.remove_rule(rule)
+        if orphans:
+            self.goal_tables.clear()
+        self.logic.release_leaves()
+        self.removed = 0
+        return len(orphans)
+
+    def retract_rule(self, s : str) -> int:
+        '''
+        Remove a told rule, given its text as it was told, along with the
+        partial rules derived from it (that were not also derived from other
+        rules), pruning the branches of the trees of conditions and
+        consecuences left empty, and return the number of rules removed (0
+        if the rule was not in the knowledge base). Only the continuations
+        of the removed rules are visited. The facts derived from them are
+        kept. The knowledge base must be recording partial rules (see
+        record_rules in __init__).
+        '''
+        if self.processing:
+            raise RuntimeError('Cannot retract a rule while processing')
+        if not self.record_rules:
+            raise RuntimeError('The knowledge base does not record partial rules')
+        tree = self.parse(s)
+        if tree.expr.name != '__rule__':
+            raise ValueError(f'{s} is not a rule')
+        rule = self._rule_from_tree(tree)
+        if not self.dset.remove_rule(rule):
+            return 0
+        self.sset.remove_rule(rule)
+        retracted = self.partial_rules.retract(rule)
+        self._remove_partial_rules(retracted)
+        if self.negations is not None and rule.negations:
+            self.negations.remove_rules({str(rule)})
+        self.goal_tables.clear()
+        return len(retracted) + 1
+
+    def _remove_partial_rules(self, rules : List[Rule]):
+        '''
+        Remove the partial rules, already forgotten by the record of partial
+        rules, from the trees of conditions and consecuences, along with
+        the instances of their negated conditions.
+        '''
+        for partial in rules:
+            self.dset.remove_rule(partial)
+            self.sset.remove_rule(partial)
+        if self.negations is not None:
+            self.negations.remove_rules({str(r) for r in rules if r.negations})
+
+    @contextmanager
+    def transaction(self) -> Iterator[Transaction]:
+        '''
+        Context manager for a transaction on the knowledge base. If the
+        block raises an exception, the changes made in it are undone, and
+        otherwise they are kept. The transaction object can be used inside
+        the block to take savepoints and to roll back to them. Callbacks of
+        subscriptions already called are not undone.
+        '''
+        if self.processing:
+            raise RuntimeError('Cannot start a transaction while processing')
+        tx = Transaction(self)
+        try:
+            yield tx
+        except BaseException:
+            tx.abort()
+            raise
+        tx.commit()
+
+    def subscribe(self, pattern : str,
+                  callback : Optional[Callable[[dict], Any]] = None) -> Subscription:
+        '''
+        Register a fact (possibly with variables) in the tree of conditions,
+        so that, for each new fact added to the knowledge base that matches
+        it, callback is called with the variable assigments, as a dict of
+        strings to strings. Without a callback, the assigments are queued in
+        the returned subscription, and are consumed iterating over it.
+        Facts already in the knowledge base are not notified.
+        '''
+        fact = self.from_parse_tree(self.parse(pattern))
+        self.subscriptions += 1
+        sub = Subscription(fact, self.subscriptions, callback, kb=self)
+        sub.key = self.dset.add_condition(fact, sub)
+        return sub
+
+    def unsubscribe(self, sub : Subscription):
+        '''
+        Stop notifying new facts to the subscription.
+        '''
+        self.dset.remove_continuation(sub.pattern, sub.key)
+
+    def aggregate(self, pattern : str, function : str,
+                  value : Optional[str] = None,
+                  group_by : Iterable[str] = ()) -> Aggregate:
+        '''
+        Declare an aggregate (function is one of count, sum, min or max) of
+        the values of the variable named value, in the facts that match the
+        pattern, grouped by the values of the variables named in group_by.
+        The aggregate is computed from the facts already in the knowledge
+        base, and then kept up to date as facts are added and removed (see
+        syntreenet.aggregates.Aggregate).
+        '''
+        fact = self.from_parse_tree(self.parse(pattern))
+        variables = {p.value.text: p.value for p in fact.get_leaf_paths()
+                     if p.is_var()}
+        if function not in FUNCTIONS:
+            raise ValueError(f'Unknown aggregate function {function}')
+        if function != 'count' and value is None:
+            raise ValueError(f'{function} needs a variable to aggregate')
+        names = list(group_by) + ([] if value is None else [value])
+        for name in names:
+            if name not in variables:
+                raise ValueError(f'{name} is not a variable in {pattern}')
+        if self.aggregates is None:
+            self.aggregates = AggregateSet(kb=self)
+        self.subscriptions += 1
+        agg = Aggregate(fact, function,
+                        None if value is None else variables[value],
+                        tuple(variables[name] for name in group_by),
+                        self.subscriptions)
+        agg.recount(self)
+        self.aggregates.add_aggregate(agg)
+        return agg
+
+    def drop_aggregate(self, agg : Aggregate):
+        '''
+        Stop keeping the aggregate up to date.
+        '''
+        if self.aggregates is not None:
+            self.aggregates.remove_aggregate(agg)
+
     def ask(self, q : Fact) -> List[Matching]:
         '''
         Check whether a fact exists in the knowledge base, or, if it contains
@@ -139,20 +657,52 @@ class KnowledgeBase:
         '''
         return self.fset.ask_fact(q)
 
-    def goal(self, q : str) -> list:
+    def explain(self, q : str) -> Optional[dict]:
+        '''
+        Return why a fact is in the knowledge base, or None if it is not, as
+        a dict with the fact, the rule that derived it (None if it was told),
+        and, in supports, the same kind of dicts for the facts that matched
+        the conditions of the rule. The knowledge base must be recording
+        justifications (see justify in __init__).
+        '''
+        if self.justifications is None:
+            raise RuntimeError('The knowledge base does not record justifications')
+        fact = self.from_parse_tree(self.parse(q))
+        if not self.ask(fact):
+            return None
+        return self.justifications.explain(fact.text)
+
+    def goal(self, q : str, recursive : bool = False, max_depth : int = 3,
+             timeout : Optional[float] = None) -> Union[list, Iterator[list]]:
+        '''
+        Find the lists of facts that would be needed to derive the provided
+        fact. If recursive is True, the needed facts are themselves taken as
+        goals, up to max_depth rule steps, and the lists are yielded as they
+        are found, for at most timeout seconds.
+        '''
         tree = self.parse(q)
         qf = self.from_parse_tree(tree)
+        if recursive:
+            return self.prove_goal(qf, max_depth=max_depth, timeout=timeout)
         return self.query_goal(qf)
 
     def query_goal(self, fact : Fact) -> list:
+        '''
+        Find the lists of facts that would be needed to derive the fact with
+        a single rule, leaving out those for which some negated condition of
+        the rule is in the knowledge base; as in NegationSet, variables left
+        unbound in a negated condition match any fact.
+        '''
         self.sset.backtracks = []
-        paths = fact.get_leaf_paths()
         matching = Matching(origin=fact)
-        self.sset.propagate(paths, matching)
+        self.sset.propagate(fact.layout, matching)
         fulfillments = []
         for bt in self.sset.backtracks:
+            rule = cast(Rule, bt.precedent)
             conds = [c.substitute(bt.data['matching'], self) for c in
-                    cast(Rule, bt.precedent).conditions]
+                    rule.conditions]
+            nots = [n.substitute(bt.data['matching'], self) for n in
+                    rule.negations]
             needed = []
             known = []
             for cond in conds:
@@ -164,21 +714,32 @@ class KnowledgeBase:
 
             for answs in known:
                 for a in answs:
+                    if any(self.ask(n.substitute(a, self)) for n in nots):
+                        continue
                     newf = list(n.substitute(a, self) for n in needed)
                     fulfillments.append(newf)
-            if not known:
+            if not known and not any(self.ask(n) for n in nots):
                 fulfillments.append(needed)
         return fulfillments
 
 
+    def prove_goal(self, fact : Fact, max_depth : int = 3,
+                   timeout : Optional[float] = None) -> Iterator[list]:
+        '''
+        Tabled, recursive backward chaining. The tables are kept while the
+        knowledge base does not change.
+        '''
+        prover = Prover(self, max_depth=max_depth, timeout=timeout,
+                        tables=self.goal_tables)
+        return prover.prove(fact)
+
     def _add_fact(self, fact : Fact):
         '''
         This method is the entry to the algorithm that checks for conditions
         that match a new fact being added to the knowledge base. 
         '''
-        paths = fact.get_leaf_paths()
         matching = Matching(origin=fact)
-        self.dset.propagate(paths, matching)
+        self.dset.propagate(fact.layout, matching)
 
     def _new_rule_activation(self, act : Activation) -> Rule:
         rule = cast(Rule, act.precedent)
@@ -188,6 +749,7 @@ class KnowledgeBase:
         new_conds = tuple(conds)
         cons = tuple(c.substitute(matching, self) for c in rule.consecuences)
         rms = tuple(c.substitute(matching, self) for c in rule.to_remove)
+        nots = tuple(c.substitute(matching, self) for c in rule.negations)
         econds = rule.extra_conditions
         new_extra_matching = None
         if rule.extra_conditions:
@@ -195,23 +757,93 @@ class KnowledgeBase:
                 new_extra_matching = matching
             else:
                 new_extra_matching = matching.merge(rule.extra_matching)
-        new_rule = Rule(new_conds, econds, cons, rms, new_extra_matching)
+        support = None
+        if self.record_rules or self.justifications is not None:
+            support = self._support(act)
+        step = rule.step
+        if self.justifications is not None:
+            step = self._justify(rule, support)
+        new_rule = Rule(new_conds, econds, cons, rms, new_extra_matching, step,
+                        nots)
         self.dset.add_rule(new_rule)
         self.sset.add_rule(new_rule)
+        if self.record_rules and support is not None:
+            self.partial_rules.add(new_rule, rule, support)
         return new_rule
 
     def _new_fact_activations(self, act : Activation):
         rule = cast(Rule, act.precedent)
         matching = act.data['matching']
+        step = NO_STEP
+        if self.justifications is not None:
+            step = self._justify(rule, self._support(act))
+        for m in self._extra_matchings(rule, matching):
+            if rule.negations:
+                negations = cast(NegationSet, self.negations)
+                if not negations.add_instance(rule, m, step):
+                    continue
+            self._new_fact_activation(rule, m, step)
+
+    def _update_negations(self, fact : Fact, delta : int):
+        '''
+        Count a fact added (delta 1) or removed (delta -1) in the negated
+        conditions of rules, fire the rule instances that it unblocks, and
+        remove the consecuences of those that it blocks.
+        '''
+        negations = cast(NegationSet, self.negations)
+        unblocked, blocked = negations.update(fact, delta)
+        for instance in unblocked:
+            self._new_fact_activation(instance.rule, instance.matching,
+                                      instance.step)
+        for instance in blocked:
+            act_data = {'query_rules': self.querying_rules}
+            for c in instance.rule.consecuences:
+                con = c.substitute(instance.matching, self)
+                self.activations.append(Activation('rm', con, data=act_data))
+
+    def _support(self, act : Activation) -> Optional[Fact]:
+        '''
+        Return the fact that matched the condition of the rule in the
+        activation, or None if the rule was just told.
+        '''
+        condition = act.data['condition']
+        if condition == EMPTY_FACT:
+            return None
+        matching = act.data['matching']
+        # the matchings found propagating a new fact have it as origin, and
+        # those found querying the fact set, the condition queried.
+        support = matching.origin
+        if support is None or support is condition:
+            support = condition.substitute(matching, self)
+        return support
+
+    def _justify(self, rule : Rule, support : Optional[Fact]) -> int:
+        '''
+        Record the fact that matched a condition of the rule as a step in
+        the justification of the rule, and return the new step.
+        '''
+        if rule.step == NO_STEP or support is None:
+            return rule.step
+        return cast(Justifications, self.justifications).add_support(
+                rule.step, support.text)
+
+    def _extra_matchings(self, rule : Rule, matching : Matching) -> List[Matching]:
+        '''
+        Check the extra conditions of the rule against the matching, and
+        return the resulting matchings, or an empty list if they fail.
+        '''
         all_results = [matching.merge(rule.extra_matching)]
         prev_results = []
         for ec in rule.extra_conditions:
             for m in all_results:
-                results = getattr(ec_handlers, ec.kind)(ec.text, m, self)
+                if ec.calculation is not None:
+                    results = ec.calculation(m)
+                else:
+                    results = getattr(ec_handlers, ec.kind)(ec.text, m, self)
                 if results is True:
                     continue
                 elif results is False:
-                    return
+                    return []
                 new_results = []
                 for pm in results:
                     new_results.append(m.merge(pm))
@@ -222,11 +854,13 @@ class KnowledgeBase:
                 all_results = prev_results
                 prev_results = []
 
-        for m in all_results:
-            self._new_fact_activation(rule, m)
+        return all_results
 
-    def _new_fact_activation(self, rule : Rule, matching : Matching):
-        act_data = {'query_rules': self.querying_rules}
+    def _new_fact_activation(self, rule : Rule, matching : Matching,
+                             step : int = NO_STEP):
+        act_data : Dict[str, Any] = {'query_rules': self.querying_rules}
+        if step != NO_STEP:
+            act_data['step'] = step
         for c in rule.to_remove:
             kind = 'rm'
             con = c.substitute(matching, self)
@@ -276,31 +910,82 @@ class KnowledgeBase:
         if not self.processing:
             self.processing = True
             self.seen_rules = set()
+            if self.activations:
+                self.goal_tables.clear()
+            info = logger.isEnabledFor(logging.INFO)
+            tracer = self.tracer
             while self.activations:
                 act = self.activations.pop(0)
+                if tracer is not None:
+                    start = time.perf_counter()
                 self.querying_rules = bool(act.data.get('query_rules'))
                 self.counter += 1
                 s = act.precedent
                 if act.kind == 'fact':
                     if not self.ask(s):
-                        logger.info(f'adding fact "{s}"')
+                        if info:
+                            logger.info('adding fact "%s"', s)
                         self._add_fact(s)
                         self.fset.add_fact(s)
+                        if self.justifications is not None:
+                            self.justifications.add_fact(
+                                    s.text, act.data.get('step', NO_STEP))
+                        if self.aggregates is not None:
+                            self.aggregates.update(s, 1)
+                        if self.negations is not None:
+                            self._update_negations(s, 1)
                 elif act.kind == 'rule':
                     if len(s.conditions) > 1 or act.data['condition'] == EMPTY_FACT:
                         new_rule = self._new_rule_activation(act)
-                        logger.info(f'adding rule "{new_rule}"')
+                        if info:
+                            logger.info('adding rule "%s"', new_rule)
                         if self.querying_rules:
                             self._new_rule(new_rule)
                     else:
                         self._new_fact_activations(act)
                         if self.querying_rules:
                             self._new_facts(act)
+                elif act.kind == 'subscription':
+                    sub = cast(Subscription, s)
+                    if sub.kb is self:
+                        sub.notify(act.data['matching'].to_dict())
                 elif act.kind == 'rm':
-                    logger.info(f'removing fact "{s}"')
-                    self.fset.rm_fact(s, self)
+                    if info:
+                        logger.info('removing fact "%s"', s)
+                    if ((self.aggregates is not None or
+                            self.negations is not None) and self.ask(s)):
+                        if self.aggregates is not None:
+                            self.aggregates.update(s, -1)
+                        if self.negations is not None:
+                            self._update_negations(s, -1)
+                    if self.fset.rm_fact(s, self):
+                        self.removed += 1
+                        if self.record_rules:
+                            self._remove_partial_rules(
+                                    self.partial_rules.remove_fact(s.text))
+                if tracer is not None:
+                    tracer.record(self.counter, act, time.perf_counter() - start)
 
             self.processing = False
+            if self.compact_after and self.removed >= self.compact_after:
+                self.compact()
+
+    def start_trace(self, filename : str):
+        '''
+        Start appending a structured trace of the activations processed to
+        the file named filename (see syntreenet.logging.Tracer for the
+        format). Tracing is off by default.
+        '''
+        self.stop_trace()
+        self.tracer = Tracer(filename)
+
+    def stop_trace(self):
+        '''
+        Stop tracing the activations processed, and close the trace file.
+        '''
+        if self.tracer is not None:
+            self.tracer.close()
+            self.tracer = None
 
     def from_parse_tree(self, tree : Node) -> Fact:
         '''
@@ -313,16 +998,28 @@ class KnowledgeBase:
 
     def _visit_pnode(self, node : Node, root_path : tuple,
             all_paths : List[tuple], parent : Node = None):
-        name = node.expr.name
-        text = node.full_text[node.start: node.end]
-        try:
-            start = node.start - cast(Segment, parent).start
-            end = node.end - cast(Segment, parent).start
-        except AttributeError:  # node is root node
-            start, end = 0, len(text)
-        segment = Segment(text, name, start, end, not bool(node.children))
-        path = root_path + (segment,)
-        if path[-1].leaf or self.in_var_range(path):
-            all_paths.append(path)
-        for child in node.children:
-            self._visit_pnode(child, path, all_paths, parent=node)
+        '''
+        Collect the paths in the parse tree under node, in document order,
+        walking it with an explicit stack.
+        '''
+        leaves = self.logic.leaves
+        stack = [(node, root_path, parent)]
+        while stack:
+            node, root_path, parent = stack.pop()
+            name = node.expr.name
+            text = node.full_text[node.start: node.end]
+            try:
+                start = node.start - cast(Segment, parent).start
+                end = node.end - cast(Segment, parent).start
+            except AttributeError:  # node is root node
+                start, end = 0, len(text)
+            if node.children:
+                segment = Segment(text, name, start, end, False)
+            else:
+                key = (text, name, start, end)
+                segment = leaves.get(key) or self.logic.leaf(key)
+            path = root_path + (segment,)
+            if path[-1].leaf or self.in_var_range(path):
+                all_paths.append(path)
+            for child in reversed(node.children):
+                stack.append((child, path, node))
@@ -17,13 +17,53 @@
 # along with any part of the terms project.
 # If not, see <http://www.gnu.org/licenses/>.
 
-import sys
+from __future__ import annotations
+
+import json
 import logging
+from dataclasses import dataclass, field
+from typing import Any, IO, Optional
+
+# The library only logs to its own logger, and leaves the configuration of
+# handlers and levels to the application.
+logger = logging.getLogger('syntreenet')
+logger.addHandler(logging.NullHandler())
+
+
+@dataclass
+class Tracer:
+    '''
+    Write a structured trace of the activations processed by a knowledge
+    base to a file, one JSON array per line, with the fields:
+
+        [number, kind, precedent, condition, matching, seconds]
+
+    where number is the count of activations processed by the knowledge
+    base, kind is one of fact, rule or rm, precedent is the fact or rule
+    in the activation, condition and matching are those that produced the
+    activation (empty strings for told sentences and for facts), and seconds
+    is the time taken to process it.
+    '''
+    filename : str
+    fh : Optional[IO[str]] = field(default=None, init=False)
+
+    def __post_init__(self):
+        self.fh = open(self.filename, 'a')
 
-logger = logging.getLogger()
-logger.setLevel(logging.ERROR)
+    def record(self, number : int, act : Any, seconds : float):
+        data = act.data
+        record = [number,
+                  act.kind,
+                  str(act.precedent),
+                  str(data.get('condition', '')),
+                  str(data.get('matching', '')),
+                  round(seconds, 6)]
+        fh = self.fh
+        if fh is not None:
+            fh.write(json.dumps(record, separators=(',', ':')))
+            fh.write('\n')
 
-handler = logging.StreamHandler(sys.stdout)
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-handler.setFormatter(formatter)
-logger.addHandler(handler)
+    def close(self):
+        if self.fh is not None:
+            self.fh.close()
+            self.fh = None
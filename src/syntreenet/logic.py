@@ -0,0 +1,104 @@
+# Copyright (c) 2019 by Enrique Pérez Arnaud <enrique@cazalla.net>
+#
+# This file is part of the syntreenet project.
+# https://syntree.net
+#
+# The syntreenet project is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The syntreenet project is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with any part of the terms project.
+# If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import annotations
+
+import os.path
+import re
+from sys import getrefcount
+from dataclasses import dataclass, field
+from typing import Dict, Tuple, Pattern
+
+from parsimonious.grammar import Grammar
+
+from .grammar import Segment
+from .codegen import Walkers
+
+
+@dataclass
+class Logic:
+    '''
+    A grammar compiled for knowledge bases, along with what is known of its
+    productions, and a table of interned leaf segments. It does not change
+    with the facts and rules told to the knowledge bases, so many of them
+    can share it (see KnowledgeBase).
+
+    var_range has, for each production in the grammar, whether it is in the
+    range of the logical variables, computed once.
+
+    Leaf segments are immutable and do not depend on the rest of the fact,
+    so those with the same text, production and position are built once and
+    shared by all the facts in all the knowledge bases; leaves is the table
+    in which they are kept, which is emptied when it reaches intern_size,
+    and from which KnowledgeBase.compact releases those no longer used.
+
+    walkers keeps the functions generated to walk the fact sets for the
+    queries of each shape, for the knowledge bases that compile their
+    queries (see codegen.Walkers).
+    '''
+    grammar_text : str
+    fact_rule : str = 'fact'
+    var_range_expr : str = '^v_'
+    base_grammar_fn : str = '../grammars/_base.peg'
+    intern_size : int = 100000
+    text : str = field(init=False)
+    grammar : Grammar = field(init=False)
+    var_range_re : Pattern = field(init=False)
+    var_range : Dict[str, bool] = field(init=False)
+    leaves : Dict[tuple, Segment] = field(init=False, default_factory=dict)
+    walkers : Walkers = field(init=False, default_factory=Walkers)
+
+    def __post_init__(self) -> None:
+        base_grammar_fn = self.base_grammar_fn
+        if not os.path.isabs(base_grammar_fn):
+            here = os.path.abspath(os.path.dirname(__file__))
+            base_grammar_fn = os.path.join(here, base_grammar_fn)
+        with open(base_grammar_fn) as fh:
+            common = fh.read()
+        self.text = f"{common}\n{self.grammar_text}"
+        self.grammar = Grammar(self.text)
+        self.var_range_re = re.compile(self.var_range_expr)
+        self.var_range = {name: bool(self.var_range_re.match(name))
+                          for name in self.grammar}
+
+    def leaf(self, key : Tuple[str, str, int, int]) -> Segment:
+        '''
+        Return the leaf segment with the text, name, start and end in key,
+        building it if it is not in the table.
+        '''
+        segment = self.leaves.get(key)
+        if segment is None:
+            if len(self.leaves) >= self.intern_size:
+                self.leaves.clear()
+            segment = self.leaves[key] = Segment(*key, True)
+        return segment
+
+    def release_leaves(self) -> int:
+        '''
+        Remove from the table the leaf segments that nothing else refers
+        to, i.e., that are not in any fact, rule or query kept by any of the
+        knowledge bases, and return the number removed.
+        '''
+        leaves = self.leaves
+        # the table and the argument of getrefcount.
+        unused = [key for key in leaves if getrefcount(leaves[key]) <= 2]
+        for key in unused:
+            del leaves[key]
+        return len(unused)
@@ -0,0 +1,219 @@
+# Copyright (c) 2019 by Enrique Pérez Arnaud <enrique@cazalla.net>
+#
+# This file is part of the syntreenet project.
+# https://syntree.net
+#
+# The syntreenet project is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The syntreenet project is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with any part of the terms project.
+# If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import annotations
+
+from dataclasses import dataclass, field, replace
+from typing import Any, List, Dict, Set, Tuple
+
+from .grammar import Fact, Matching
+from .ruleset import RuleSet, Rule
+
+
+@dataclass
+class Negation:
+    '''
+    A negated condition, with the variables bound by the positive conditions
+    of its rule substituted, and the number of facts in the knowledge base
+    that match it. instances are the keys of the rule instances that need
+    the count to be 0 to fire. owner is the token of the negation set that
+    can change it in place.
+    '''
+    pattern : Fact
+    count : int = 0
+    instances : List[str] = field(default_factory=list)
+    owner : Any = None
+
+
+@dataclass
+class Instance:
+    '''
+    A rule with negated conditions, whose positive conditions have all been
+    matched, and the number of its negations that are matched by some fact
+    (blockers). The instance fires when blockers is 0.
+    '''
+    rule : Rule
+    matching : Matching
+    step : int = -1
+    blockers : int = 0
+    owner : Any = None
+
+
+@dataclass
+class NegationSet(RuleSet):
+    '''
+    The tree of the negated conditions of the rule instances in a knowledge
+    base, built and matched as the tree of conditions. Each fact added or
+    removed is matched against it to update the counts of the negations it
+    matches, and the instances of rules that are blocked or unblocked by
+    the change are returned, so that firing or retracting them needs no
+    query to the fact set. The fact set is only queried once for each new
+    negation, to start its count.
+
+    The negations and instances are shared with forks and snapshots as the
+    nodes of the tree are: the dictionaries are copied on the first change
+    after a new token, and each negation or instance when it is changed.
+    by_rule has the keys of the instances of each rule, by the text of the
+    rule.
+    '''
+    negations : Dict[str, Negation] = field(default_factory=dict)
+    instances : Dict[str, Instance] = field(default_factory=dict)
+    by_rule : Dict[str, List[str]] = field(default_factory=dict)
+    by_rule_owned : Set[str] = field(default_factory=set)
+    state_owner : Any = None
+
+    def get_cons(self, rule):
+        return rule.negations
+
+    def add_activation(self, act):
+        pass
+
+    def add_instance(self, rule : Rule, matching : Matching,
+                     step : int = -1) -> bool:
+        '''
+        Add a rule instance with the matching of its positive conditions,
+        and return whether it fires, i.e., whether it is new and no fact
+        matches any of its negations.
+        '''
+        text = str(rule)
+        key = text + str(matching)
+        if key in self.instances:
+            return False
+        self._own_state()
+        token = self.token
+        instance = self.instances[key] = Instance(rule, matching, step,
+                                                  owner=token)
+        self._own_keys(text).append(key)
+        for neg in rule.negations:
+            pattern = neg.substitute(matching, self.kb)
+            negation = self.negations.get(pattern.text)
+            if negation is None:
+                count = self.kb.fset.count_facts([pattern])
+                negation = self.negations[pattern.text] = Negation(
+                        pattern, count, owner=token)
+                self.add_condition(pattern, pattern.text)
+            else:
+                negation = self._own_negation(pattern.text)
+            negation.instances.append(key)
+            if negation.count:
+                instance.blockers += 1
+        return instance.blockers == 0
+
+    def update(self, fact : Fact,
+               delta : int) -> Tuple[List[Instance], List[Instance]]:
+        '''
+        Count a fact added (delta 1) or removed (delta -1) in the negations
+        that it matches, and return the instances that it unblocks and the
+        instances that it blocks.
+        '''
+        unblocked : List[Instance] = []
+        blocked : List[Instance] = []
+        for endnode, _ in self.matches(fact.layout, Matching(origin=fact)):
+            self._own_state()
+            for _, _, text in endnode.continuations.values():
+                negation = self._own_negation(text)
+                negation.count += delta
+                if delta > 0 and negation.count == 1:
+                    for key in negation.instances:
+                        instance = self._own_instance(key)
+                        instance.blockers += 1
+                        if instance.blockers == 1:
+                            blocked.append(instance)
+                elif delta < 0 and negation.count == 0:
+                    for key in negation.instances:
+                        instance = self._own_instance(key)
+                        instance.blockers -= 1
+                        if instance.blockers == 0:
+                            unblocked.append(instance)
+        return unblocked, blocked
+
+    def remove_rules(self, texts : Set[str]):
+        '''
+        Remove the instances of the rules with the given texts, and the
+        negations left without instances.
+        '''
+        texts = {text for text in texts if text in self.by_rule}
+        if not texts:
+            return
+        self._own_state()
+        for text in texts:
+            self.by_rule_owned.discard(text)
+            for key in self.by_rule.pop(text):
+                instance = self.instances.pop(key)
+                for neg in instance.rule.negations:
+                    pattern = neg.substitute(instance.matching, self.kb)
+                    if pattern.text not in self.negations:
+                        continue
+                    negation = self._own_negation(pattern.text)
+                    if key not in negation.instances:
+                        continue
+                    negation.instances.remove(key)
+                    if not negation.instances:
+                        del self.negations[pattern.text]
+                        self.remove_condition(pattern, pattern.text)
+
+    def _own_state(self):
+        '''
+        Make sure that the dictionaries of negations and instances are the
+        negation set's own, copying them if they are shared with a fork or
+        a snapshot. The negations and instances in them are still shared.
+        '''
+        if self.state_owner is not self.token:
+            self.negations = dict(self.negations)
+            self.instances = dict(self.instances)
+            self.by_rule = dict(self.by_rule)
+            self.by_rule_owned = set()
+            self.state_owner = self.token
+
+    def _own_keys(self, text : str) -> List[str]:
+        keys = self.by_rule.get(text)
+        if keys is None or text not in self.by_rule_owned:
+            keys = self.by_rule[text] = list(keys or ())
+            self.by_rule_owned.add(text)
+        return keys
+
+    def _own_negation(self, text : str) -> Negation:
+        negation = self.negations[text]
+        if negation.owner is not self.token:
+            negation = self.negations[text] = replace(
+                    negation, instances=list(negation.instances),
+                    owner=self.token)
+        return negation
+
+    def _own_instance(self, key : str) -> Instance:
+        instance = self.instances[key]
+        if instance.owner is not self.token:
+            instance = self.instances[key] = replace(instance, owner=self.token)
+        return instance
+
+    def fork(self, kb) -> NegationSet:
+        tree = super().fork(kb)
+        tree.negations = self.negations
+        tree.instances = self.instances
+        tree.by_rule = self.by_rule
+        return tree
+
+    def snapshot(self) -> tuple:
+        return (super().snapshot(), self.negations, self.instances,
+                self.by_rule)
+
+    def restore(self, snapshot : tuple):
+        tree, self.negations, self.instances, self.by_rule = snapshot
+        super().restore(tree)
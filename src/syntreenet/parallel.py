@@ -0,0 +1,191 @@
+# Copyright (c) 2019 by Enrique Pérez Arnaud <enrique@cazalla.net>
+#
+# This file is part of the syntreenet project.
+# https://syntree.net
+#
+# The syntreenet project is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The syntreenet project is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with any part of the terms project.
+# If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import annotations
+
+import os
+import pickle
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import List, Dict, Tuple, Sequence, Optional, cast
+
+from .grammar import Layout, Matching
+from .ruleset import ParentNode, Node, EndNode, RuleSet
+
+
+# The tree of conditions in each worker process, the numbers of its
+# endnodes, by id, and the number of the description it was rebuilt from.
+_replica : Optional[ParentNode] = None
+_numbers : Dict[int, int] = {}
+_shipped : int = 0
+
+
+def flatten(tree : RuleSet) -> Tuple[list, List[EndNode]]:
+    '''
+    Return a flat description of the nodes of a tree of conditions, that
+    can be pickled and sent to other processes, along with the list of the
+    endnodes of the tree. The description has, for each node, in breadth
+    first order, a tuple with its path, whether it is a variable, the
+    indexes of its var_child, var_children and children, and the number of
+    its endnode in the list (or -1 where there is none). The rules in the
+    endnodes are left out.
+    '''
+    order : List[ParentNode] = [tree]
+    index = {id(tree): 0}
+    k = 0
+    while k < len(order):
+        node = order[k]
+        k += 1
+        children = list(node.var_children) + list(node.children.values())
+        if node.var_child is not None:
+            children.insert(0, node.var_child)
+        for child in children:
+            index[id(child)] = len(order)
+            order.append(child)
+    nodes = []
+    endnodes : List[EndNode] = []
+    for node in order:
+        end = -1
+        if node.endnode is not None:
+            end = len(endnodes)
+            endnodes.append(node.endnode)
+        var_child = -1 if node.var_child is None else index[id(node.var_child)]
+        nodes.append((getattr(node, 'path', None),
+                      getattr(node, 'var', False),
+                      var_child,
+                      [index[id(c)] for c in node.var_children],
+                      [index[id(c)] for c in node.children.values()],
+                      end))
+    return nodes, endnodes
+
+
+def rebuild(nodes : list) -> Tuple[ParentNode, Dict[int, int]]:
+    '''
+    Build a tree of conditions from its flat description, and return its
+    root, and the numbers of its endnodes by id.
+    '''
+    built : List[ParentNode] = [ParentNode() if path is None else
+                                Node(path, var, parent=cast(ParentNode, None))
+                                for path, var, *_ in nodes]
+    numbers : Dict[int, int] = {}
+    for node, (_, _, var_child, var_children, children, end) in zip(built, nodes):
+        if var_child >= 0:
+            node.var_child = cast(Node, built[var_child])
+        node.var_children = [cast(Node, built[c]) for c in var_children]
+        node.children = {nodes[c][0].identity_tuple: cast(Node, built[c])
+                         for c in children}
+        if end >= 0:
+            node.endnode = EndNode(parent=node)
+            numbers[id(node.endnode)] = end
+    return built[0], numbers
+
+
+def _match_chunk(task : Tuple[int, str, List[Layout]]
+                 ) -> List[List[Tuple[int, tuple]]]:
+    '''
+    Match the facts with the given layouts against the replica of the tree
+    of conditions in the worker, and return, for each fact, the numbers of
+    the endnodes reached and the mappings of the matchings, in order. The
+    task has the number of the description of the tree and the file with
+    it, which is only read when the replica is not already built from it.
+    '''
+    global _replica, _numbers, _shipped
+    shipped, filename, layouts = task
+    if shipped != _shipped:
+        with open(filename, 'rb') as fh:
+            _replica, _numbers = rebuild(pickle.load(fh))
+        _shipped = shipped
+    root = _replica
+    assert root is not None
+    return [[(_numbers[id(endnode)], matching.mapping)
+             for endnode, matching in root.matches(layout, Matching())]
+            for layout in layouts]
+
+
+@dataclass
+class MatchPool:
+    '''
+    A pool of processes, each with a replica of a tree of conditions, in
+    which to match facts. The processes are kept across calls to
+    match_layouts. The tree is flattened and pickled only when its version
+    (see RuleSet.version) is not the one last shipped, and it is shipped
+    through a file in directory, rather than with each task: the tasks only
+    carry the facts and the number and file of the description, and each
+    process rebuilds its replica once for each description. shipped is the
+    number of descriptions written.
+    '''
+    processes : int
+    executor : Optional[ProcessPoolExecutor] = None
+    directory : str = ''
+    tree : Optional[RuleSet] = None
+    version : int = -1
+    filename : str = ''
+    endnodes : List[EndNode] = field(default_factory=list)
+    shipped : int = 0
+
+    def match_layouts(self, tree : RuleSet, layouts : Sequence[Layout]
+                      ) -> List[List[Tuple[EndNode, tuple]]]:
+        '''
+        Match the facts with the given layouts against the tree of
+        conditions, partitioning them among the processes. Return, for each
+        fact, the endnodes reached in the tree and the mappings of the
+        matchings, in the order in which propagate would reach them.
+        '''
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.processes)
+            self.directory = tempfile.mkdtemp(prefix='syntreenet-')
+        if tree is not self.tree or tree.version != self.version:
+            self._ship(tree)
+        size = max(1, -(-len(layouts) // (self.processes * 4)))
+        tasks = [(self.shipped, self.filename, list(layouts[i:i + size]))
+                 for i in range(0, len(layouts), size)]
+        endnodes = self.endnodes
+        results : List[List[Tuple[EndNode, tuple]]] = []
+        for chunk in self.executor.map(_match_chunk, tasks):
+            for found in chunk:
+                results.append([(endnodes[n], mapping) for n, mapping in found])
+        return results
+
+    def _ship(self, tree : RuleSet):
+        '''
+        Write the description of the tree to a new file, for the processes
+        to rebuild their replicas from, and remove the previous one, that no
+        task will read any more.
+        '''
+        nodes, self.endnodes = flatten(tree)
+        self.shipped += 1
+        filename = os.path.join(self.directory, f'tree-{self.shipped}.pickle')
+        with open(filename, 'wb') as fh:
+            pickle.dump(nodes, fh, pickle.HIGHEST_PROTOCOL)
+        if self.filename:
+            os.remove(self.filename)
+        self.tree, self.version, self.filename = tree, tree.version, filename
+
+    def close(self):
+        '''
+        Shut down the processes of the pool, and remove its files.
+        '''
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.tree, self.version, self.filename = None, -1, ''
@@ -0,0 +1,157 @@
+# Copyright (c) 2019 by Enrique Pérez Arnaud <enrique@cazalla.net>
+#
+# This file is part of the syntreenet project.
+# https://syntree.net
+#
+# The syntreenet project is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The syntreenet project is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with any part of the terms project.
+# If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from typing import List, Dict, Tuple, Optional, Union, Any
+
+from .grammar import Fact
+
+
+@dataclass
+class QueryCache:
+    '''
+    A cache of the results of queries, keyed on the queries with their
+    variables numbered in order of appearance, so that queries that only
+    differ in the names of their variables share an entry.
+
+    Each entry is registered, in a trie, under the leading constant leaf
+    paths of each of the facts in its query (up to the first variable),
+    since only facts that start with them can change its result. A fact
+    added to or removed from the fact set walks the trie along its own leaf
+    paths, and drops just the entries registered on the way, along with
+    their registrations under other prefixes, that registered keeps. When
+    the cache is full it is cleared, as are the caches of templates.
+    '''
+    size : int = 1000
+    parsed : Dict[str, tuple] = field(default_factory=dict)
+    entries : Dict[tuple, Any] = field(default_factory=dict)
+    prefixes : dict = field(default_factory=dict)
+    registered : Dict[tuple, List[dict]] = field(default_factory=dict)
+    hits : int = 0
+    misses : int = 0
+    invalidations : int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def query(self, q : str, limit : Optional[int],
+              kb : Any) -> Union[list, bool]:
+        '''
+        Return the result of the query, as KnowledgeBase.query, from the
+        cache, or asking the fact set of kb and keeping it.
+        '''
+        parsed = self.parsed.get(q)
+        if parsed is None:
+            if len(self.parsed) >= self.size:
+                self.parsed.clear()
+            facts = kb.parse_facts(q)
+            parsed = self.parsed[q] = (facts,) + normalize(facts)
+        facts, key, names, prefixes = parsed
+        key = (key, limit)
+        result = self.entries.get(key)
+        if result is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            result = self._ask(facts, names, limit, kb)
+            if len(self.entries) >= self.size:
+                self.clear()
+            self.entries[key] = result
+            nodes = self.registered[key] = []
+            for prefix in prefixes:
+                node = self.prefixes
+                for item in prefix:
+                    node = node.setdefault(item, {})
+                keys = node.setdefault(None, set())
+                if key not in keys:
+                    keys.add(key)
+                    nodes.append(node)
+        if isinstance(result, bool):
+            return result
+        return [dict(zip(names, values)) for values in result]
+
+    def _ask(self, facts : List[Fact], names : List[str],
+             limit : Optional[int], kb : Any) -> Union[list, bool]:
+        response = [m.to_dict() for m in kb.fset.ask_facts(facts, limit)]
+        if not response:
+            return False
+        if len(response) == 1 and not response[0]:
+            return True
+        return [tuple(d[name] for name in names) for d in response]
+
+    def invalidate(self, fact : Fact):
+        '''
+        Drop the entries whose results may change with the addition or
+        removal of the fact.
+        '''
+        paths = fact.leaf_paths
+        node : Optional[dict] = self.prefixes
+        i = 0
+        while node is not None:
+            for key in node.pop(None, ()):
+                del self.entries[key]
+                self.invalidations += 1
+                for other in self.registered.pop(key):
+                    keys = other.get(None)
+                    if keys is not None:
+                        keys.discard(key)
+                        if not keys:
+                            del other[None]
+            if i == len(paths):
+                break
+            node = node.get(paths[i].identity_tuple)
+            i += 1
+
+    def clear(self):
+        '''
+        Drop all the entries.
+        '''
+        self.entries.clear()
+        self.prefixes.clear()
+        self.registered.clear()
+
+
+def normalize(facts : List[Fact]) -> Tuple[tuple, List[str], List[tuple]]:
+    '''
+    Return the key for the query with the facts, the names of its variables
+    in order of appearance, and the leading constant leaf paths of each fact.
+    '''
+    numbers : Dict[str, int] = {}
+    key = []
+    prefixes = []
+    for fact in facts:
+        items : List[tuple] = []
+        prefix = None
+        for path in fact.leaf_paths:
+            if path.is_var():
+                if prefix is None:
+                    prefix = tuple(items)
+                var = path.value.text
+                number = numbers.setdefault(var, len(numbers))
+                items.append(path.identity_tuple[:-1] + (number,))
+            else:
+                items.append(path.identity_tuple)
+        key.append(tuple(items))
+        prefixes.append(tuple(items) if prefix is None else prefix)
+    return tuple(key), list(numbers), prefixes
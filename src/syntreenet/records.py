@@ -0,0 +1,106 @@
+# Copyright (c) 2019 by Enrique Pérez Arnaud <enrique@cazalla.net>
+#
+# This file is part of the syntreenet project.
+# https://syntree.net
+#
+# The syntreenet project is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The syntreenet project is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with any part of the terms project.
+# If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import annotations
+
+import json
+from typing import List, Iterable, Iterator, IO, Any
+
+from .grammar import Segment, Path, Fact
+
+
+def fact_to_record(fact : Fact) -> list:
+    '''
+    Return a record of the fact, that can be serialized as JSON and turned
+    back into the same fact with fact_from_record, with no parsing.
+
+    The record is a list with the text of the fact and a flat list with the
+    segments of its parse tree, in document order, each as 4 items: its depth
+    in the tree, the name of its production, and its start and end offsets
+    within its parent. The text of each segment is the slice of the text of
+    its parent, and whether it is a leaf is given by the depth of the next
+    segment.
+    '''
+    nodes : list = []
+    prev : tuple = ()
+    for path in fact.paths:
+        segments = path.segments
+        depth = 0
+        for s1, s2 in zip(prev, segments[:-1]):
+            if s1 is not s2:
+                break
+            depth += 1
+        for d in range(depth, len(segments)):
+            segment = segments[d]
+            nodes.extend((d, segment.name, segment.start, segment.end))
+        prev = segments
+    return [fact.text, nodes]
+
+
+def fact_from_record(record : list, kb : Any) -> Fact:
+    '''
+    Build a fact from a record made by fact_to_record. The paths of the fact
+    are those of the leaves and of the segments in the range of the logical
+    variables of kb, as in KnowledgeBase.from_parse_tree.
+
+    Leaf segments are interned in the table of kb.logic, shared with the
+    facts parsed by any knowledge base with the same logic.
+    '''
+    text, nodes = record
+    leaf = kb.logic.leaf
+    in_range = kb.name_in_var_range
+    paths : List[Path] = []
+    stack : List[Segment] = []
+    num_nodes = len(nodes)
+    for k in range(0, num_nodes, 4):
+        depth, name, start, end = nodes[k:k + 4]
+        del stack[depth:]
+        parent_text = stack[-1].text if depth else text
+        if k + 4 == num_nodes or nodes[k + 4] <= depth:
+            stack.append(leaf((parent_text[start:end], name, start, end)))
+            paths.append(Path(tuple(stack)))
+        else:
+            stack.append(Segment(parent_text[start:end], name, start, end))
+            if in_range(name):
+                paths.append(Path(tuple(stack)))
+    return Fact(text, tuple(paths))
+
+
+def dump_facts(facts : Iterable[Fact], fh : IO[str]) -> int:
+    '''
+    Write the records of the facts to the file, one JSON array per line, and
+    return the number of facts written.
+    '''
+    written = 0
+    for fact in facts:
+        fh.write(json.dumps(fact_to_record(fact), separators=(',', ':')))
+        fh.write('\n')
+        written += 1
+    return written
+
+
+def load_facts(fh : IO[str], kb : Any) -> Iterator[Fact]:
+    '''
+    Yield the facts in a file written by dump_facts, as they are read.
+    '''
+    loads = json.loads
+    for line in fh:
+        if line.strip():
+            yield fact_from_record(loads(line), kb)
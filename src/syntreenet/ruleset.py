@@ -19,27 +19,46 @@
 
 from __future__ import annotations
 
-from copy import copy
+from collections import deque
 from dataclasses import dataclass, field
-from typing import List, Dict, Union, Tuple, Any, Optional, Union, cast
+from typing import (List, Dict, Deque, Union, Tuple, Any, Callable, Iterator,
+                    Optional, Sequence, TypeVar, cast)
 
-from .grammar import Segment, Fact, Path, Matching
+from .grammar import Segment, Fact, Path, Layout, Matching
+from .calc import Calculation
 from .factset import FactSet
 
+try:
+    from mypy_extensions import trait, mypyc_attr
+except ImportError:  # pragma: no cover
+    def trait(cls):  # type: ignore
+        return cls
+
+    def mypyc_attr(*args, **kwargs):  # type: ignore
+        return lambda cls: cls
+
 
 @dataclass(frozen=True)
 class Rule:
     '''
-    A rule. A set of conditions plus a set of consecuences.
+    A rule. A set of conditions plus a set of consecuences. negations are
+    the facts (possibly with variables) that must not be in the knowledge
+    base for the rule to fire (see syntreenet.negations.NegationSet). step
+    is the number of the last step in the chain of justifications of the
+    rule, when the knowledge base records them (see
+    syntreenet.justifications.Justifications).
     '''
     conditions : tuple = field(default_factory=tuple)
     extra_conditions : tuple = field(default_factory=tuple)
     consecuences : tuple = field(default_factory=tuple)
     to_remove : tuple = field(default_factory=tuple)
     extra_matching : Optional[Matching] = None
+    step : int = field(default=-1, compare=False)
+    negations : tuple = field(default_factory=tuple)
 
     def __str__(self) -> str:
-        conds = '; '.join([str(c) for c in self.conditions])
+        conds = '; '.join([str(c) for c in self.conditions] +
+                          [f'not {c}' for c in self.negations])
         econds = '; '.join([str(c) for c in self.extra_conditions])
         if econds:
             econds = '; ' + econds
@@ -52,10 +71,48 @@ class Rule:
 
 @dataclass(frozen=True)
 class ExtraCondition:
+    '''
+    An extra condition in a rule, to be checked by the handler for its kind
+    (see syntreenet.extra.ec_handlers), or, for calc conditions, by its
+    compiled calculation (see syntreenet.calc.Calculation).
+    '''
     kind : str
     text : str
+    calculation : Optional[Calculation] = field(default=None, compare=False,
+                                                repr=False)
 
 
+@dataclass(eq=False)
+class Subscription:
+    '''
+    A pattern registered in the tree of conditions, as a condition would be.
+    For each new fact that matches it, the callback is called with the
+    variable assigments, or, if there is no callback, they are queued, to be
+    consumed iterating over the subscription.
+    '''
+    pattern : Fact
+    number : int = 0
+    callback : Optional[Callable[[dict], Any]] = None
+    pending : Deque[dict] = field(default_factory=deque)
+    kb : Any = None
+    key : str = ''
+
+    def __str__(self) -> str:
+        return f'subscription {self.number} to {self.pattern}'
+
+    def __iter__(self) -> Iterator[dict]:
+        while self.pending:
+            yield self.pending.popleft()
+
+    def notify(self, bindings : dict):
+        if self.callback is None:
+            self.pending.append(bindings)
+        else:
+            self.callback(bindings)
+
+
+@mypyc_attr(allow_interpreted_subclasses=True)
+@trait
 @dataclass
 class ChildNode:
     parent : Optional[ParentNode] = None
@@ -68,19 +125,14 @@ class Activation:
     and contains the information needed to produce the new facts or rules.
     '''
     kind : str
-    precedent : Union[Rule, Fact]
+    precedent : Union[Rule, Fact, Subscription]
     data : Dict[str, Any] = field(default_factory=dict)
 
 
+@trait
 @dataclass
 class End:
-    continuations : Dict[str, Tuple[Fact, Matching, Rule]] = field(default_factory=dict)
-
-
-def get_root(node):
-    while node.parent is not None:
-        node = node.parent
-    return node
+    continuations : Dict[str, Tuple[Fact, Matching, Any]] = field(default_factory=dict)
 
 
 @dataclass
@@ -93,59 +145,197 @@ class EndNode(ChildNode, End):
     the actual variables in the rule provided by the user.
     '''
     parent : Optional[ParentNode] = None
-    kb : Any = None
 
-    def add_matching(self, matching : Matching):
+    def add_matching(self, matching : Matching, root : RuleSet):
         '''
+        Pass the activations that correspond to the matching to the root of
+        the tree where it was found.
         '''
-        root = get_root(self)
         for condition, varmap, rule in self.continuations.values():
             real_matching = matching.get_real_matching(varmap)
+            act_data : Dict[str, Any]
+            if isinstance(rule, Subscription):
+                act_data = {'matching': real_matching}
+                root.add_activation(Activation('subscription', rule,
+                                               data=act_data))
+                continue
             act_data = {
                     'matching': real_matching,
                     'condition': condition,
-                    'query_rules': self.kb.querying_rules
+                    'query_rules': root.kb.querying_rules
                     }
             activation = Activation('rule', rule, data=act_data)
             root.add_activation(activation)
 
 
+@mypyc_attr(allow_interpreted_subclasses=True)
 @dataclass
 class ParentNode:
     '''
     '''
     var_child : Optional[Node] = None
     var_children : List[Node] = field(default_factory=list)
-    children : Dict[Path, Node] = field(default_factory=dict)
+    children : Dict[tuple, Node] = field(default_factory=dict)
     endnode : Optional[EndNode] = None
+    owner : Any = None
 
-    def propagate(self, paths : List[Path], matching : Matching):
+    def propagate(self, layout : Layout, matching : Matching):
         '''
+        Find the conditions that match the leaf paths of a fact, and pass the
+        resulting matchings to their endnodes.
         '''
-        if paths:
-            path = paths.pop(0)
-            child = self.children.get(path)
+        for endnode, new_matching in self.matches(layout, matching):
+            endnode.add_matching(new_matching, cast(RuleSet, self))
+
+    def matches(self, layout : Layout,
+                matching : Matching) -> Iterator[Tuple[EndNode, Matching]]:
+        '''
+        Yield the endnodes of the conditions that match the leaf paths of a
+        fact, with the resulting matchings. The tree is walked with an
+        explicit stack, where each entry has a node and the index of the next
+        leaf to match in the layout of the fact; the endnodes are reached in
+        the same order as in a depth first traversal in which each node fires
+        its endnode after visiting its children. When a variable matches a
+        whole sub-expression, the leaves in it are skipped with a single jump
+        of index.
+        '''
+        paths = layout.leaves
+        num_paths = len(paths)
+        keys = [p.identity_tuple for p in paths]
+        stack : List[tuple] = [(self, 0, matching, False)]
+        while stack:
+            node, i, matching, ended = stack.pop()
+            if ended:
+                yield node.endnode, matching
+                continue
+            if node.endnode:
+                stack.append((node, i, matching, True))
+            if i == num_paths:
+                continue
+            path = paths[i]
+
+            if node.var_child is not None:
+                depth = len(node.var_child.path) - 1
+                child_var = node.var_child.path.value
+                new_matching = matching.setitem(child_var, path[depth])
+                stack.append((node.var_child, layout.leaf_end(i, depth),
+                              new_matching, False))
+
+            for vchild in node.var_children:
+                depth = len(vchild.path) - 1
+                if path[depth] == matching[vchild.path.value]:
+                    stack.append((vchild, layout.leaf_end(i, depth),
+                                  matching, False))
+                    break
+
+            child = node.children.get(keys[i])
             if child is not None:
-                child.propagate(copy(paths), matching)
-            
-            for vchild in self.var_children:
-                new_path = path.get_subpath(vchild.path)
-                if new_path.value == matching[vchild.path.value]:
-                    new_paths = new_path.paths_after(paths, try_to_see=False)
-                    vchild.propagate(new_paths, matching)
+                stack.append((child, i + 1, matching, False))
+
+    def unify(self, layout : Layout, matching : Matching,
+              bindings : Matching, kb : Any, response : list):
+        '''
+        Like propagate, but the leaf paths may contain variables of their own,
+        as happens with goals. Variables in the paths can be bound to the
+        logical constants in the tree, and those bindings are kept apart, in
+        bindings. For each endnode reached, a tuple with the endnode, the
+        matching and the bindings is appended to response.
+        '''
+        paths = layout.leaves
+        num_paths = len(paths)
+        stack : List[tuple] = [(self, 0, matching, bindings)]
+        while stack:
+            node, i, matching, bindings = stack.pop()
+            if i == num_paths:
+                if node.endnode:
+                    response.append((node.endnode, matching, bindings))
+                continue
+            path = paths[i]
+            if path.is_var():
+                syn = path.value
+                if bindings.get(syn) is None:
+                    node._unify_var(path, i, matching, bindings, kb, stack)
+                    continue
+                path, _ = path.substitute(bindings)
+
+            if node.var_child is not None:
+                depth = len(node.var_child.path) - 1
+                child_var = node.var_child.path.value
+                new_matching = matching.setitem(child_var, path[depth])
+                stack.append((node.var_child, layout.leaf_end(i, depth),
+                              new_matching, bindings))
+
+            for vchild in node.var_children:
+                depth = len(vchild.path) - 1
+                if path[depth] == matching[vchild.path.value]:
+                    stack.append((vchild, layout.leaf_end(i, depth),
+                                  matching, bindings))
                     break
 
-            if self.var_child is not None:
-                new_path = path.get_subpath(self.var_child.path)
-                new_paths = new_path.paths_after(paths, try_to_see=False)
-                child_var = self.var_child.path.value
-                new_matching = matching.setitem(child_var, new_path.value)
-                self.var_child.propagate(new_paths, new_matching)
+            child = node.children.get(path.identity_tuple)
+            if child is not None:
+                stack.append((child, i + 1, matching, bindings))
+
+    def _own_child(self, child : Node, token : Any) -> Node:
+        '''
+        Return the child node if it is owned by the tree with the given
+        token, or otherwise (if it is shared with other forks of the
+        knowledge base) replace it with a copy, and return the copy.
+        '''
+        if child.owner is token:
+            return child
+        new_child = Node(child.path, child.var, parent=self,
+                         var_child=child.var_child,
+                         var_children=list(child.var_children),
+                         children=dict(child.children),
+                         owner=token)
+        if child.endnode is not None:
+            new_child.endnode = EndNode(
+                    parent=new_child,
+                    continuations=dict(child.endnode.continuations))
+        if self.var_child is child:
+            self.var_child = new_child
+        elif child.path.is_var():
+            for i, vchild in enumerate(self.var_children):
+                if vchild is child:
+                    self.var_children[i] = new_child
+        else:
+            self.children[child.path.identity_tuple] = new_child
+        return new_child
+
+    def _unify_var(self, path : Path, i : int,
+                   matching : Matching, bindings : Matching, kb : Any,
+                   stack : list):
+        '''
+        Unify a free variable in the paths with the children of the node,
+        pushing the results to the stack.
+        '''
+        syn = path.value
+        names = tuple(s.name for s in path.segments[:-1])
+
+        if self.var_child is not None:
+            child_var = self.var_child.path.value
+            new_matching = matching.setitem(child_var, syn)
+            stack.append((self.var_child, i + 1, new_matching, bindings))
+
+        for vchild in self.var_children:
+            value = matching[vchild.path.value]
+            if value.is_var():
+                if value == syn:
+                    stack.append((vchild, i + 1, matching, bindings))
+            else:
+                new_bindings = bindings.setitem(syn, value)
+                stack.append((vchild, i + 1, matching, new_bindings))
 
-        if self.endnode:
-            self.endnode.add_matching(matching)
+        for child in self.children.values():
+            child_path = child.path
+            if (child_path.is_leaf() and kb.in_var_range(child_path) and
+                    names == tuple(s.name for s in child_path.segments[:-1])):
+                new_bindings = bindings.setitem(syn, child_path.value)
+                stack.append((child, i + 1, matching, new_bindings))
 
 
+@trait
 @dataclass
 class ContentNode:
     '''
@@ -163,47 +353,111 @@ class Node(ParentNode, ChildNode, ContentNode):
     '''
     A node in the tree of conditions.
     '''
-    parent : ParentNode
 
 
+RS = TypeVar('RS', bound='RuleSet')
+
+
+@mypyc_attr(allow_interpreted_subclasses=True)
 @dataclass
 class RuleSet(ParentNode, ChildNode):
     kb : Any = None
+    token : Any = field(default_factory=object)
+    version : int = 0
+
+    def __post_init__(self):
+        self.owner = self.token
 
-    def follow_paths(self, paths : List[Path]) -> Tuple[ParentNode,
+    def fork(self : RS, kb : Any) -> RS:
+        '''
+        Return a tree for kb that shares all its nodes with this one. Both
+        get new tokens, so from then on each of them copies the nodes that it
+        changes, along with their ancestors, before changing them.
+        '''
+        self.token = object()
+        tree = type(self)(var_child=self.var_child,
+                          var_children=self.var_children,
+                          children=self.children,
+                          endnode=self.endnode,
+                          kb=kb)
+        tree.owner = None
+        return tree
+
+    def snapshot(self) -> tuple:
+        '''
+        Return the current state of the tree, which can later be restored.
+        The tree gets a new token, so that from then on the nodes in the
+        snapshot are copied before being changed.
+        '''
+        self.token = object()
+        return self.var_child, self.var_children, self.children, self.endnode
+
+    def restore(self, snapshot : tuple):
+        '''
+        Restore the state of the tree to the given snapshot.
+        '''
+        self.var_child, self.var_children, self.children, self.endnode = snapshot
+        self.token = object()
+        self.owner = None
+        self.version += 1
+
+    def _own_root(self):
+        '''
+        Make sure that the children of the root are its own, copying them if
+        they are shared with a fork.
+        '''
+        if self.owner is not self.token:
+            self.version += 1
+            self.var_children = list(self.var_children)
+            self.children = dict(self.children)
+            if self.endnode is not None:
+                self.endnode = EndNode(
+                        parent=self,
+                        continuations=dict(self.endnode.continuations))
+            self.owner = self.token
+
+    def follow_paths(self, paths : Sequence[Path]) -> Tuple[ParentNode,
                                                         List[Segment],
                                                         List[Path]]:
+        '''
+        Find the sequence of already existing nodes that correspond to the
+        paths, and return the last one, the variables visited, and the paths
+        left. Since this is done to change the last node, the nodes followed
+        are made to be owned by the tree.
+        '''
+        self._own_root()
+        token = self.token
         node : ParentNode = self
         visited_vars = []
         rest_paths : List[Path] = []
         for i, path in enumerate(paths):
+            child : Optional[Node] = None
             if path.is_var():
-                var_child = None
                 for ch in node.var_children:
                     if ch.path == path:
-                        var_child = ch
+                        child = ch
                         break
-                if var_child is not None:
-                    node = var_child
-                elif node.var_child and path == node.var_child.path:
+                if (child is None and node.var_child and
+                        path == node.var_child.path):
                     visited_vars.append(path.value)
-                    node = node.var_child
-                else:
-                    rest_paths = paths[i:]
-                    break
+                    child = node.var_child
             else:
-                child = node.children.get(path)
-                if child:
-                    node = child
-                else:
-                    rest_paths = paths[i:]
-                    break
+                child = node.children.get(path.identity_tuple)
+            if child is None:
+                rest_paths = list(paths[i:])
+                break
+            if child.owner is not token:
+                self.version += 1
+            node = node._own_child(child, token)
         return node, visited_vars, rest_paths
 
     def create_paths(self, node : ParentNode,
                      paths : List[Path], visited : List[Segment]) -> Node:
+        if paths:
+            self.version += 1
         for path in paths:
-            next_node = Node(path, path.is_var(), parent=node)
+            next_node = Node(path, path.is_var(), parent=node,
+                             owner=self.token)
             if path.is_var():
                 if path.value not in visited:
                     visited.append(path.value)
@@ -211,7 +465,7 @@ class RuleSet(ParentNode, ChildNode):
                 else:
                     node.var_children.append(next_node)
             else:
-                node.children[path] = next_node
+                node.children[path.identity_tuple] = next_node
             node = next_node
 
         return cast(Node, node)
@@ -220,14 +474,85 @@ class RuleSet(ParentNode, ChildNode):
         '''
         '''
         for con in self.get_cons(rule):
-            varmap, paths = con.normalize(self.kb)
-            node, visited_vars, paths_left = self.follow_paths(paths)
-            node = self.create_paths(node, paths_left, visited_vars)
-            if node.endnode is None:
-                node.endnode = EndNode(parent=node, kb=self.kb)
-            rulestr = str(rule) + str(varmap) + str(con)
-            if rulestr not in node.endnode.continuations:
-                node.endnode.continuations[rulestr] = (con, varmap, rule)
+            self.add_condition(con, rule)
+
+    def add_condition(self, con : Fact,
+                      precedent : Any) -> str:
+        '''
+        Add a condition (or consecuence) to the tree, and return the key of
+        the continuation for the precedent in its endnode.
+        '''
+        varmap, paths = con.normalize(self.kb)
+        node, visited_vars, paths_left = self.follow_paths(paths)
+        node = self.create_paths(node, paths_left, visited_vars)
+        if node.endnode is None:
+            node.endnode = EndNode(parent=node)
+            self.version += 1
+        rulestr = str(precedent) + str(varmap) + str(con)
+        if rulestr not in node.endnode.continuations:
+            node.endnode.continuations[rulestr] = (con, varmap, precedent)
+        return rulestr
+
+    def remove_continuation(self, con : Fact, key : str):
+        '''
+        Remove the continuation with the given key from the endnode of the
+        condition (or consecuence).
+        '''
+        _, paths = con.normalize(self.kb)
+        self._remove_continuation(paths, key)
+
+    def remove_condition(self, con : Fact, precedent : Any) -> bool:
+        '''
+        Remove the continuation added by add_condition for the precedent
+        from the endnode of the condition (or consecuence), and return
+        whether it was there.
+        '''
+        varmap, paths = con.normalize(self.kb)
+        return self._remove_continuation(paths,
+                                         str(precedent) + str(varmap) + str(con))
+
+    def remove_rule(self, rule : Rule) -> bool:
+        '''
+        Remove the continuations for the rule from the endnodes of its
+        conditions (or consecuences), and return whether there was any.
+        '''
+        found = False
+        for con in self.get_cons(rule):
+            if self.remove_condition(con, rule):
+                found = True
+        return found
+
+    def _remove_continuation(self, paths : Sequence[Path], key : str) -> bool:
+        node, _, paths_left = self.follow_paths(paths)
+        if paths_left or node.endnode is None:
+            return False
+        if node.endnode.continuations.pop(key, None) is None:
+            return False
+        if not node.endnode.continuations:
+            node.endnode = None
+            self.version += 1
+            self._prune(node)
+        return True
+
+    def _prune(self, node : ParentNode):
+        '''
+        Detach the node from the tree if it has neither endnode nor
+        children, and then do the same with its ancestors. The node and its
+        ancestors must be owned by the tree, as they are after follow_paths.
+        '''
+        while isinstance(node, Node):
+            if (node.endnode is not None or node.children or
+                    node.var_child is not None or node.var_children):
+                break
+            parent = cast(ParentNode, node.parent)
+            if parent.var_child is node:
+                parent.var_child = None
+            elif node.path.is_var():
+                parent.var_children = [ch for ch in parent.var_children
+                                       if ch is not node]
+            else:
+                parent.children.pop(node.path.identity_tuple, None)
+            node = parent
 
     def get_cons(self, rule : Optional[Rule]) -> tuple:
         raise NotImplementedError()
@@ -0,0 +1,72 @@
+# Copyright (c) 2019 by Enrique Pérez Arnaud <enrique@cazalla.net>
+#
+# This file is part of the syntreenet project.
+# https://syntree.net
+#
+import os
+import argparse
+from random import Random
+from timeit import default_timer
+from typing import cast
+from ..kbase import KnowledgeBase
+
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+
+parser = argparse.ArgumentParser(description='Benchmark on score.peg, '
+                                 'comparing the maximum and mean of the '
+                                 'scores kept by rules and by aggregates.')
+parser.add_argument('-n', dest='n', type=int, default=3000,
+                    help='number of scores to add')
+
+
+def scores(n : int):
+    rnd = Random(0)
+    for i in range(n):
+        name = ''.join(chr(97 + int(d)) for d in str(i))
+        yield f'score p{name} {rnd.randrange(100000)}'
+
+
+def with_rules(grammar : str, n : int):
+    kb = KnowledgeBase(grammar)
+    kb.tell('''score X1 X2 ;
+               {{logic}max-score X3 X4} ;
+               {{calc}X2 > X4}
+               ->
+               rm max-score X3 X4 ;
+               max-score X1 X2''')
+    kb.tell('''score X1 X2 ;
+               {{logic}mean X3 X4 X5} ;
+               {{calc}X6 = X3 + 1; X7 = X4 + X2; X8 = X7 / X6}
+               ->
+               rm mean X3 X4 X5 ;
+               mean X6 X7 X8''')
+    kb.tell('max-score nobody 0')
+    kb.tell('mean 0 0 0')
+    for s in scores(n):
+        kb.tell(s)
+    return kb.query('max-score X1 X2'), kb.query('mean X1 X2 X3')
+
+
+def with_aggregates(grammar : str, n : int):
+    kb = KnowledgeBase(grammar)
+    best = kb.aggregate('score X1 X2', 'max', 'X2')
+    total = kb.aggregate('score X1 X2', 'sum', 'X2')
+    count = kb.aggregate('score X1 X2', 'count')
+    for s in scores(n):
+        kb.tell(s)
+    return best.get(), cast(float, total.get()) / cast(float, count.get())
+
+
+if __name__ == '__main__':
+    fn = os.path.join(HERE, '../../grammars/score.peg')
+    with open(fn, 'r') as fh:
+        grammar = fh.read()
+    args = parser.parse_args()
+    for name, run in (('rules', with_rules), ('aggregates', with_aggregates)):
+        start = default_timer()
+        result = run(grammar, args.n)
+        t = default_timer() - start
+        print(f'{name}: took {t}sec to add {args.n} scores\n'
+              f'    mean for score : {(t/args.n)*1000}ms\n'
+              f'    result : {result}')
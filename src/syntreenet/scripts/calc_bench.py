@@ -0,0 +1,61 @@
+# Copyright (c) 2019 by Enrique Pérez Arnaud <enrique@cazalla.net>
+#
+# This file is part of the syntreenet project.
+# https://syntree.net
+#
+import os
+import argparse
+from dataclasses import dataclass
+from random import Random
+from timeit import timeit
+from ..kbase import KnowledgeBase
+
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+
+parser = argparse.ArgumentParser(description='Benchmark on score.peg, '
+                                 'comparing python and calc extra conditions.')
+parser.add_argument('-n', dest='n', type=int, default=5000,
+                    help='number of scores to add')
+
+
+@dataclass
+class Benchmark:
+    n : int
+    kb : KnowledgeBase
+
+    def __call__(self):
+        rnd = Random(0)
+        for i in range(self.n):
+            name = ''.join(chr(97 + int(d)) for d in str(i))
+            self.kb.tell(f'score p{name} {rnd.randrange(100000)}')
+
+
+def run(grammar : str, n : int, kind : str):
+    kb = KnowledgeBase(grammar)
+    kb.tell(f'''score X1 X2 ;
+                {{{{logic}}max-score X3 X4}} ;
+                {{{{{kind}}}X2 > X4}}
+                ->
+                rm max-score X3 X4 ;
+                max-score X1 X2''')
+    kb.tell(f'''score X1 X2 ;
+                {{{{logic}}mean X3 X4 X5}} ;
+                {{{{{kind}}}X6 = X3 + 1; X7 = X4 + X2; X8 = X7 / X6}}
+                ->
+                rm mean X3 X4 X5 ;
+                mean X6 X7 X8''')
+    kb.tell('max-score nobody 0')
+    kb.tell('mean 0 0 0')
+    t = timeit(Benchmark(n, kb), number=1)
+    print(f'{kind}: took {t}sec to add {n} scores\n'
+          f'    mean for score : {(t/n)*1000}ms')
+
+
+if __name__ == '__main__':
+    fn = os.path.join(HERE, '../../grammars/score.peg')
+    with open(fn, 'r') as fh:
+        grammar = fh.read()
+    args = parser.parse_args()
+    run(grammar, args.n, 'python')
+    run(grammar, args.n, 'calc')
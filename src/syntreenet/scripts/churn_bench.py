@@ -0,0 +1,59 @@
+# Copyright (c) 2019 by Enrique Pérez Arnaud <enrique@cazalla.net>
+#
+# This file is part of the syntreenet project.
+# https://syntree.net
+#
+import gc
+import os
+import argparse
+import tracemalloc
+from timeit import default_timer
+from ..kbase import KnowledgeBase
+
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+
+parser = argparse.ArgumentParser(description='Benchmark on adding and '
+                                 'removing facts that make partial rules, '
+                                 'with and without compaction, on '
+                                 'classes.peg.')
+parser.add_argument('-n', dest='n', type=int, default=500,
+                    help='number of facts added and removed in each round')
+parser.add_argument('-r', dest='r', type=int, default=8,
+                    help='number of rounds')
+
+
+def name(i : int) -> str:
+    return 'x' + ''.join(chr(97 + int(d)) for d in str(i))
+
+
+def run(grammar : str, n : int, rounds : int, compact_after : int):
+    kb = KnowledgeBase(grammar, compact_after=compact_after)
+    kb.tell('X1 isa X2 ; X2 is X3 -> X1 isa X3')
+    kb.tell('thing is thing')
+    tracemalloc.start()
+    start = default_timer()
+    for r in range(rounds):
+        for i in range(n):
+            kb.tell(f'{name(r * n + i)} isa thing')
+        for i in range(n):
+            kb.tell(f'rm {name(r * n + i)} isa thing')
+        # measure what is alive, not what the collector has yet to free.
+        gc.collect()
+        current, _ = tracemalloc.get_traced_memory()
+        print(f'    round {r}: {current // 1024}KiB, '
+              f'{len(kb.logic.leaves)} leaves interned')
+    t = default_timer() - start
+    tracemalloc.stop()
+    print(f'    took {t}sec, mean for round : {t / rounds}sec')
+
+
+if __name__ == '__main__':
+    fn = os.path.join(HERE, '../../grammars/classes.peg')
+    with open(fn, 'r') as fh:
+        grammar = fh.read()
+    args = parser.parse_args()
+    print('without compaction')
+    run(grammar, args.n, args.r, 0)
+    print(f'compacting after {args.n} removals')
+    run(grammar, args.n, args.r, args.n)
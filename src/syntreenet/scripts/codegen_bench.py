@@ -0,0 +1,50 @@
+# Copyright (c) 2019 by Enrique Pérez Arnaud <enrique@cazalla.net>
+#
+# This file is part of the syntreenet project.
+# https://syntree.net
+#
+import os
+import argparse
+from timeit import timeit
+from ..kbase import KnowledgeBase
+
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+
+parser = argparse.ArgumentParser(description='Benchmark on queries with '
+                                 'free variables on pairs.peg, with and '
+                                 'without compiling them.')
+parser.add_argument('-n', dest='n', type=int, default=3000,
+                    help='number of facts')
+parser.add_argument('-q', dest='q', type=int, default=20,
+                    help='number of times to run each query')
+
+QUERIES = ['(name : X1 , value : (thing : X2 , other : X3))',
+           '(name : X1 , value : (thing : X2 , other : X2))',
+           '(name : n7 , value : (thing : X1 , other : X2))',
+           '(name : X1 , value : (thing : v7 , other : X2))',
+           '(name : X1 , value : X2)',
+           '(name : X1 , value : X2) ; (name : X1 , value : (thing : X3 , '
+           'other : w7))']
+
+
+def run(grammar : str, n : int, q : int, compiled : bool) -> float:
+    kb = KnowledgeBase(grammar, var_range_expr='^(word|fact)$',
+                       compile_queries=compiled)
+    for i in range(n):
+        kb.tell(f'(name : n{i} , value : (thing : v{i % 10} , '
+                f'other : w{i % 9}))')
+    t = timeit(lambda: [kb.query(query) for query in QUERIES], number=q)
+    print(f'compile_queries={compiled}: took {t}sec to run '
+          f'{q * len(QUERIES)} queries')
+    return t
+
+
+if __name__ == '__main__':
+    fn = os.path.join(HERE, '../../grammars/pairs.peg')
+    with open(fn, 'r') as fh:
+        grammar = fh.read()
+    args = parser.parse_args()
+    t1 = run(grammar, args.n, args.q, False)
+    t2 = run(grammar, args.n, args.q, True)
+    print(f'    {t1/t2:.2f} times faster compiled')
@@ -0,0 +1,46 @@
+# Copyright (c) 2019 by Enrique Pérez Arnaud <enrique@cazalla.net>
+#
+# This file is part of the syntreenet project.
+# https://syntree.net
+#
+import os
+import argparse
+from timeit import default_timer
+from ..kbase import KnowledgeBase
+
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+
+parser = argparse.ArgumentParser(description='Benchmark on the first tell '
+                                 'after forking knowledge bases of growing '
+                                 'size, indexed and not, on classes.peg.')
+parser.add_argument('-n', dest='n', type=int, default=1000,
+                    help='number of facts in the smallest knowledge base')
+parser.add_argument('-s', dest='s', type=int, default=3,
+                    help='number of sizes, each 10 times the previous')
+
+
+def run(grammar : str, n : int, indexed : tuple):
+    kb = KnowledgeBase(grammar, indexed=indexed)
+    for i in range(n):
+        kb.tell(f'thing{i} isa thing')
+    fork = kb.fork()
+    start = default_timer()
+    fork.tell('susan isa thing')
+    first = default_timer() - start
+    start = default_timer()
+    fork.tell('john isa thing')
+    second = default_timer() - start
+    print(f'    {n} facts: first tell {first * 1000}ms, '
+          f'second tell {second * 1000}ms')
+
+
+if __name__ == '__main__':
+    fn = os.path.join(HERE, '../../grammars/classes.peg')
+    with open(fn, 'r') as fh:
+        grammar = fh.read()
+    args = parser.parse_args()
+    for indexed in ((), ('v_word',)):
+        print(f'indexed {indexed}')
+        for s in range(args.s):
+            run(grammar, args.n * 10 ** s, indexed)
@@ -0,0 +1,69 @@
+# Copyright (c) 2019 by Enrique Pérez Arnaud <enrique@cazalla.net>
+#
+# This file is part of the syntreenet project.
+# https://syntree.net
+#
+import os
+import argparse
+import tracemalloc
+from timeit import default_timer
+from typing import cast
+from ..kbase import KnowledgeBase
+from ..justifications import Justifications, NO_STEP
+
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+
+sets = ('thing', 'animal', 'mammal', 'primate', 'human',
+        'vegetable', 'tree', 'pine')
+
+parser = argparse.ArgumentParser(description='Benchmark on the memory and '
+                                 'time taken by recording justifications.')
+parser.add_argument('-n', dest='n', type=int, default=2000,
+                    help='number of facts to add')
+
+
+def build(grammar : str, n : int, justify : bool) -> KnowledgeBase:
+    kb = KnowledgeBase(grammar, justify=justify)
+    kb.tell("X1 is X2 ; X2 is X3 -> X1 is X3")
+    kb.tell("X1 isa X2 ; X2 is X3 -> X1 isa X3")
+    kb.tell('animal is thing')
+    kb.tell('mammal is animal')
+    kb.tell('primate is mammal')
+    kb.tell('human is primate')
+    kb.tell('vegetable is thing')
+    kb.tell('tree is vegetable')
+    kb.tell('pine is tree')
+    for i in range(n):
+        s = sets[i % len(sets)]
+        kb.tell(f'{s}{i} isa {s}')
+    return kb
+
+
+def run(grammar : str, n : int, justify : bool) -> int:
+    tracemalloc.start()
+    start = default_timer()
+    kb = build(grammar, n, justify)
+    t = default_timer() - start
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    facts = sum(1 for _ in kb.fset.iter_facts())
+    print(f'justify={justify}: took {t}sec to add {n} facts, '
+          f'{facts} in the knowledge base\n'
+          f'    memory : {size} bytes')
+    return size
+
+
+if __name__ == '__main__':
+    fn = os.path.join(HERE, '../../grammars/classes.peg')
+    with open(fn, 'r') as fh:
+        grammar = fh.read()
+    args = parser.parse_args()
+    plain = run(grammar, args.n, False)
+    justified = run(grammar, args.n, True)
+    kb = build(grammar, args.n, True)
+    justifications = cast(Justifications, kb.justifications)
+    derivations = len([step for step in justifications.reasons
+                       if step != NO_STEP])
+    print(f'{derivations} derivations recorded, '
+          f'{(justified - plain) / derivations} bytes each')
@@ -0,0 +1,88 @@
+# Copyright (c) 2019 by Enrique Pérez Arnaud <enrique@cazalla.net>
+#
+# This file is part of the syntreenet project.
+# https://syntree.net
+#
+import os
+import sys
+import argparse
+import subprocess
+from timeit import timeit
+from typing import Tuple
+from .. import grammar
+from ..kbase import KnowledgeBase
+
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+PURE = os.path.abspath(os.path.join(HERE, '../..'))
+COMPILED = os.path.abspath(os.path.join(HERE, '../../../build/mypyc/src'))
+
+parser = argparse.ArgumentParser(description='Benchmark on classes.peg, '
+                                 'with the core modules in pure Python and '
+                                 'compiled with mypyc (make mypyc).')
+parser.add_argument('-n', dest='n', type=int, default=1000,
+                    help='number of sentences to add')
+parser.add_argument('-q', dest='q', type=int, default=20,
+                    help='number of times to run each query')
+parser.add_argument('-d', dest='d', default=COMPILED,
+                    help='src directory of the tree built with mypyc')
+parser.add_argument('--time', action='store_true',
+                    help='time the build the script is imported from, and '
+                         'print the results on one line')
+
+SETS = ('thing', 'animal', 'mammal', 'primate', 'human',
+        'vegetable', 'tree', 'pine')
+
+QUERIES = ['X1 isa X2', 'X1 isa thing', 'X1 is X2 ; X2 is thing']
+
+
+def tell(kb : KnowledgeBase, n : int):
+    kb.tell("X1 is X2 ; X2 is X3 -> X1 is X3")
+    kb.tell("X1 isa X2 ; X2 is X3 -> X1 isa X3")
+    kb.tell('animal is thing')
+    kb.tell('mammal is animal')
+    kb.tell('primate is mammal')
+    kb.tell('human is primate')
+    kb.tell('vegetable is thing')
+    kb.tell('tree is vegetable')
+    kb.tell('pine is tree')
+    for i in range(n):
+        s = SETS[i % len(SETS)]
+        kb.tell(f'{s}{i} isa {s}')
+
+
+def measure(n : int, q : int):
+    fn = os.path.join(PURE, 'grammars/classes.peg')
+    with open(fn, 'r') as fh:
+        kb = KnowledgeBase(fh.read())
+    told = timeit(lambda: tell(kb, n), number=1)
+    queried = timeit(lambda: [kb.query(query) for query in QUERIES],
+                     number=q)
+    compiled = not grammar.__file__.endswith('.py')
+    print(f'{compiled} {told} {queried}')
+
+
+def run(directory : str, n : int, q : int) -> Tuple[float, float]:
+    out = subprocess.run([sys.executable, '-m',
+                          'syntreenet.scripts.mypyc_bench', '--time',
+                          '-n', str(n), '-q', str(q)],
+                         cwd=directory, check=True, capture_output=True,
+                         text=True).stdout
+    compiled, tell, query = out.split()
+    print(f'{"compiled" if compiled == "True" else "pure"} ({directory}):\n'
+          f'    took {tell}sec to add {n} facts, '
+          f'{query}sec to run {q * len(QUERIES)} queries')
+    return float(tell), float(query)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.time:
+        measure(args.n, args.q)
+    else:
+        if not os.path.isdir(args.d):
+            sys.exit(f'{args.d} not found, build it first with make mypyc')
+        tell1, query1 = run(PURE, args.n, args.q)
+        tell2, query2 = run(args.d, args.n, args.q)
+        print(f'    {tell1/tell2:.2f} times faster to add facts compiled, '
+              f'{query1/query2:.2f} to query')
@@ -0,0 +1,48 @@
+# Copyright (c) 2019 by Enrique Pérez Arnaud <enrique@cazalla.net>
+#
+# This file is part of the syntreenet project.
+# https://syntree.net
+#
+import os
+import argparse
+from timeit import default_timer
+from ..kbase import KnowledgeBase
+
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+
+parser = argparse.ArgumentParser(description='Benchmark on rules with '
+                                 'negated conditions, on classes.peg.')
+parser.add_argument('-n', dest='n', type=int, default=2000,
+                    help='number of individuals')
+
+
+def name(i : int) -> str:
+    return 'x' + ''.join(chr(97 + int(d)) for d in str(i))
+
+
+if __name__ == '__main__':
+    fn = os.path.join(HERE, '../../grammars/classes.peg')
+    with open(fn, 'r') as fh:
+        kb = KnowledgeBase(fh.read())
+    args = parser.parse_args()
+    kb.tell('X1 isa animal ; not X1 isa dead -> X1 isa alive')
+    start = default_timer()
+    for i in range(args.n):
+        kb.tell(f'{name(i)} isa animal')
+    t = default_timer() - start
+    print(f'took {t}sec to add {args.n} facts that fire the rule\n'
+          f'    mean for fact : {(t/args.n)*1000}ms')
+    start = default_timer()
+    for i in range(args.n):
+        kb.tell(f'{name(i)} isa dead')
+    t = default_timer() - start
+    print(f'took {t}sec to add {args.n} facts that retract the rule\n'
+          f'    mean for fact : {(t/args.n)*1000}ms')
+    start = default_timer()
+    for i in range(args.n):
+        kb.tell(f'rm {name(i)} isa dead')
+    t = default_timer() - start
+    print(f'took {t}sec to remove {args.n} facts that fire the rule again\n'
+          f'    mean for fact : {(t/args.n)*1000}ms')
+    print(f'{kb.count("X1 isa alive")} alive')
@@ -0,0 +1,50 @@
+# Copyright (c) 2019 by Enrique Pérez Arnaud <enrique@cazalla.net>
+#
+# This file is part of the syntreenet project.
+# https://syntree.net
+#
+import os
+import argparse
+from dataclasses import dataclass
+from timeit import timeit
+from ..kbase import KnowledgeBase
+
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+
+parser = argparse.ArgumentParser(description='Benchmark on nested pairs.peg facts.')
+parser.add_argument('-n', dest='n', type=int, default=100,
+                    help='number of facts to add')
+parser.add_argument('-d', dest='d', type=int, default=10,
+                    help='depth of nesting of the facts')
+
+
+def nested(i : int, depth : int) -> str:
+    fact = f'(leaf : v{i})'
+    for j in range(depth):
+        fact = f'(level : l{j} , inner : {fact})'
+    return fact
+
+
+@dataclass
+class Benchmark:
+    n : int
+    depth : int
+    kb : KnowledgeBase
+
+    def __call__(self):
+        self.kb.tell('(level : l0 , inner : (leaf : X1)) -> (found : X1)')
+        for i in range(self.n):
+            self.kb.tell(nested(i, self.depth))
+        for i in range(self.n):
+            self.kb.query(nested(i, self.depth).replace(f'v{i}', 'X1'))
+
+
+if __name__ == '__main__':
+    fn = os.path.join(HERE, '../../grammars/pairs.peg')
+    with open(fn, 'r') as fh:
+        kb = KnowledgeBase(fh.read(), var_range_expr='^(word|fact)$')
+    args = parser.parse_args()
+    t = timeit(Benchmark(args.n, args.d, kb), number=1)
+    print(f'took {t}sec to add and query {args.n} facts nested {args.d} deep\n'
+          f'    mean for fact : {(t/args.n)*1000}ms')
@@ -0,0 +1,65 @@
+# Copyright (c) 2019 by Enrique Pérez Arnaud <enrique@cazalla.net>
+#
+# This file is part of the syntreenet project.
+# https://syntree.net
+#
+import os
+import argparse
+from dataclasses import dataclass
+from timeit import timeit
+from ..kbase import KnowledgeBase
+
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+
+parser = argparse.ArgumentParser(description='Benchmark on tell_many, with '
+                                 'the matching done in a pool of processes.')
+parser.add_argument('-n', dest='n', type=int, default=5000,
+                    help='number of facts to add')
+parser.add_argument('-r', dest='r', type=int, default=500,
+                    help='number of rules in the knowledge base')
+parser.add_argument('-b', dest='b', type=int, default=10,
+                    help='number of batches in which to add them')
+parser.add_argument('-p', dest='processes', type=int, nargs='+',
+                    default=[1, 2, 4], help='numbers of processes to try')
+
+
+@dataclass
+class Benchmark:
+    n : int
+    r : int
+    b : int
+    processes : int
+    kb : KnowledgeBase
+
+    def __call__(self):
+        size = -(-self.n // self.b)
+        for start in range(0, self.n, size):
+            self.kb.tell_many([f'x{i} isa c{i % self.r}'
+                               for i in range(start, min(start + size, self.n))],
+                              processes=self.processes)
+
+
+def run(grammar : str, n : int, r : int, b : int, processes : int):
+    kb = KnowledgeBase(grammar)
+    for j in range(r):
+        kb.tell(f'X1 isa c{j} ; c{j} is X2 -> X1 isa X2')
+        kb.tell(f'c{j} is d{j}')
+    t = timeit(Benchmark(n, r, b, processes, kb), number=1)
+    print(f'{processes} processes: took {t}sec to add {n} facts '
+          f'in {b} batches against {r} rules\n'
+          f'    mean for added fact : {(t/n)*1000}ms')
+    if kb.pool is not None:
+        size = os.path.getsize(kb.pool.filename)
+        print(f'    tree shipped {kb.pool.shipped} times, {size} bytes')
+    kb.close_pool()
+
+
+if __name__ == '__main__':
+    fn = os.path.join(HERE, '../../grammars/classes.peg')
+    with open(fn, 'r') as fh:
+        grammar = fh.read()
+    args = parser.parse_args()
+    print(f'{os.cpu_count()} cores')
+    for processes in args.processes:
+        run(grammar, args.n, args.r, args.b, processes)
@@ -0,0 +1,52 @@
+# Copyright (c) 2019 by Enrique Pérez Arnaud <enrique@cazalla.net>
+#
+# This file is part of the syntreenet project.
+# https://syntree.net
+#
+import os
+import argparse
+from timeit import default_timer
+from ..kbase import KnowledgeBase
+
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+
+parser = argparse.ArgumentParser(description='Benchmark on repeated queries '
+                                 'on pairs.peg, with and without a cache.')
+parser.add_argument('-n', dest='n', type=int, default=2000,
+                    help='number of facts')
+parser.add_argument('-q', dest='q', type=int, default=20000,
+                    help='number of queries')
+parser.add_argument('-w', dest='w', type=int, default=100,
+                    help='number of queries for each new fact')
+
+
+def name(i : int) -> str:
+    return 'n' + ''.join(chr(97 + int(d)) for d in str(i))
+
+
+def run(grammar : str, n : int, q : int, w : int, cache : int):
+    kb = KnowledgeBase(grammar, var_range_expr='^(word|fact)$',
+                       query_cache=cache)
+    for i in range(n):
+        kb.tell(f'(group : g{name(i % 10)} , member : {name(i)})')
+    start = default_timer()
+    for i in range(q):
+        kb.query(f'(group : g{name(i % 10)} , member : X1)')
+        if not i % w:
+            kb.tell(f'(group : g{name(i % 7)} , member : {name(n + i)})')
+    t = default_timer() - start
+    print(f'cache={cache}: took {t}sec to run {q} queries\n'
+          f'    mean for query : {(t/q)*1000}ms')
+    if kb.query_cache is not None:
+        print(f'    hit rate : {kb.query_cache.hit_rate}, '
+              f'invalidations : {kb.query_cache.invalidations}')
+
+
+if __name__ == '__main__':
+    fn = os.path.join(HERE, '../../grammars/pairs.peg')
+    with open(fn, 'r') as fh:
+        grammar = fh.read()
+    args = parser.parse_args()
+    run(grammar, args.n, args.q, args.w, 0)
+    run(grammar, args.n, args.q, args.w, 1000)
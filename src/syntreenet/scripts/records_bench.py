@@ -0,0 +1,48 @@
+# Copyright (c) 2019 by Enrique Pérez Arnaud <enrique@cazalla.net>
+#
+# This file is part of the syntreenet project.
+# https://syntree.net
+#
+import os
+import argparse
+import tempfile
+from timeit import timeit
+from ..kbase import KnowledgeBase
+
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+
+parser = argparse.ArgumentParser(description='Benchmark on reloading facts '
+                                 'from records, compared to telling them one '
+                                 'by one and in a batch.')
+parser.add_argument('-n', dest='n', type=int, default=10000,
+                    help='number of facts to reload')
+
+
+def fact(i : int) -> str:
+    return f'(name : n{i} , value : (thing : v{i} , other : w{i}))'
+
+
+if __name__ == '__main__':
+    fn = os.path.join(HERE, '../../grammars/pairs.peg')
+    with open(fn, 'r') as fh:
+        grammar = fh.read()
+    args = parser.parse_args()
+    kb = KnowledgeBase(grammar, var_range_expr='^(word|fact)$')
+    facts = [fact(i) for i in range(args.n)]
+    t1 = timeit(lambda: [kb.from_parse_tree(kb.parse(f)) for f in facts],
+                number=1)
+    t2 = timeit(lambda: [kb.tell(f) for f in facts], number=1)
+    batch = KnowledgeBase(grammar, var_range_expr='^(word|fact)$')
+    t5 = timeit(lambda: batch.tell_many(facts), number=1)
+    with tempfile.TemporaryDirectory() as tmp:
+        records = os.path.join(tmp, 'facts.jsonl')
+        t3 = timeit(lambda: kb.export_facts(records), number=1)
+        kb = KnowledgeBase(grammar, var_range_expr='^(word|fact)$')
+        t4 = timeit(lambda: kb.import_facts(records), number=1)
+        size = os.path.getsize(records)
+    print(f'parsing {args.n} facts took {t1}sec, telling them {t2}sec, '
+          f'telling them in a batch {t5}sec\n'
+          f'exporting them took {t3}sec, {size} bytes\n'
+          f'importing them took {t4}sec, {t2/t4:.2f} times faster than '
+          f'telling, {t5/t4:.2f} times faster than in a batch')
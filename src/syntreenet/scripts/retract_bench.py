@@ -0,0 +1,63 @@
+# Copyright (c) 2019 by Enrique Pérez Arnaud <enrique@cazalla.net>
+#
+# This file is part of the syntreenet project.
+# https://syntree.net
+#
+import os
+import argparse
+from timeit import default_timer
+from ..kbase import KnowledgeBase
+
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+
+parser = argparse.ArgumentParser(description='Benchmark on retracting rules '
+                                 'from a knowledge base with many rules, '
+                                 'compared to rebuilding it, on classes.peg.')
+parser.add_argument('-n', dest='n', type=int, default=200,
+                    help='number of rules')
+parser.add_argument('-f', dest='f', type=int, default=20,
+                    help='number of facts that match each rule')
+parser.add_argument('-g', dest='g', action='store_true',
+                    help='add a negated condition to each rule')
+
+
+def name(i : int) -> str:
+    return 'x' + ''.join(chr(97 + int(d)) for d in str(i))
+
+
+def rule(i : int, g : bool = False) -> str:
+    if g:
+        return f'X1 isa {name(i)} ; not X1 isa dead -> X1 isa alive'
+    return f'X1 isa {name(i)} ; X1 is X2 -> X2 isa {name(i)}'
+
+
+def build(grammar : str, n : int, f : int, g : bool = False,
+          skip : int = -1) -> KnowledgeBase:
+    kb = KnowledgeBase(grammar, record_rules=True)
+    for i in range(n):
+        if i != skip:
+            kb.tell(rule(i, g))
+    for i in range(n):
+        for j in range(f):
+            kb.tell(f'{name(j)}y isa {name(i)}')
+    return kb
+
+
+if __name__ == '__main__':
+    fn = os.path.join(HERE, '../../grammars/classes.peg')
+    with open(fn, 'r') as fh:
+        grammar = fh.read()
+    args = parser.parse_args()
+    kb = build(grammar, args.n, args.f, args.g)
+    start = default_timer()
+    removed = 0
+    for i in range(10):
+        removed += kb.retract_rule(rule(i, args.g))
+    t = default_timer() - start
+    print(f'took {t}sec to retract 10 rules, with {removed} partial and '
+          f'told rules\n    mean for rule : {(t/10)*1000}ms')
+    start = default_timer()
+    build(grammar, args.n, args.f, args.g, 0)
+    t = default_timer() - start
+    print(f'took {t}sec to rebuild the knowledge base without a rule')
@@ -0,0 +1,54 @@
+# Copyright (c) 2019 by Enrique Pérez Arnaud <enrique@cazalla.net>
+#
+# This file is part of the syntreenet project.
+# https://syntree.net
+#
+import os
+import argparse
+import tempfile
+from dataclasses import dataclass
+from timeit import timeit
+from typing import Optional, cast
+from ..kbase import KnowledgeBase
+from ..sqlfactset import SQLFactSet
+
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+
+parser = argparse.ArgumentParser(description='Benchmark on the SQLite fact set, '
+                                 'compared to the in memory fact set.')
+parser.add_argument('-n', dest='n', type=int, default=10000,
+                    help='number of facts to add')
+
+
+@dataclass
+class Benchmark:
+    n : int
+    kb : KnowledgeBase
+
+    def __call__(self):
+        for i in range(self.n):
+            self.kb.tell(f'(name : n{i} , value : v{i})')
+        for i in range(self.n):
+            self.kb.query(f'(name : n{i} , value : X1)')
+
+
+def run(grammar : str, n : int, db : Optional[str] = None):
+    kb = KnowledgeBase(grammar, var_range_expr='^(word|fact)$', db=db)
+    t = timeit(Benchmark(n, kb), number=1)
+    name = 'sqlite' if db else 'memory'
+    print(f'{name}: took {t}sec to add and query {n} facts\n'
+          f'    mean for fact : {(t/n)*1000}ms')
+    if db:
+        cast(SQLFactSet, kb.fset).close()
+        print(f'    size on disk : {os.path.getsize(db)} bytes')
+
+
+if __name__ == '__main__':
+    fn = os.path.join(HERE, '../../grammars/pairs.peg')
+    with open(fn, 'r') as fh:
+        grammar = fh.read()
+    args = parser.parse_args()
+    run(grammar, args.n)
+    with tempfile.TemporaryDirectory() as tmp:
+        run(grammar, args.n, os.path.join(tmp, 'facts.db'))
@@ -0,0 +1,45 @@
+# Copyright (c) 2019 by Enrique Pérez Arnaud <enrique@cazalla.net>
+#
+# This file is part of the syntreenet project.
+# https://syntree.net
+#
+import os
+import argparse
+from timeit import timeit
+from ..kbase import KnowledgeBase
+
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+
+parser = argparse.ArgumentParser(description='Benchmark on telling facts '
+                                 'built from templates, compared to telling '
+                                 'their text.')
+parser.add_argument('-n', dest='n', type=int, default=10000,
+                    help='number of facts to tell')
+
+
+def new_kb(grammar : str) -> KnowledgeBase:
+    return KnowledgeBase(grammar, var_range_expr='^(word|fact)$')
+
+
+if __name__ == '__main__':
+    fn = os.path.join(HERE, '../../grammars/pairs.peg')
+    with open(fn, 'r') as fh:
+        grammar = fh.read()
+    args = parser.parse_args()
+    n = args.n
+    kb = new_kb(grammar)
+    texts = [f'(name : n{i} , value : (thing : v{i} , other : w{i}))'
+             for i in range(n)]
+    t1 = timeit(lambda: [kb.from_parse_tree(kb.parse(t)) for t in texts],
+                number=1)
+    t2 = timeit(lambda: [kb.tell(t) for t in texts], number=1)
+    kb = new_kb(grammar)
+    outer = kb.template('(name : X1 , value : X2)')
+    inner = kb.template('(thing : X1 , other : X2)')
+    build = lambda i: outer(f'n{i}', (inner, f'v{i}', f'w{i}'))
+    t3 = timeit(lambda: [build(i) for i in range(n)], number=1)
+    t4 = timeit(lambda: [kb.tell_fact(build(i)) for i in range(n)], number=1)
+    print(f'parsing {n} facts took {t1}sec, telling them {t2}sec\n'
+          f'building them from templates took {t3}sec, telling them {t4}sec\n'
+          f'    {t1/t3:.2f} times faster to build, {t2/t4:.2f} to tell')
@@ -0,0 +1,52 @@
+# Copyright (c) 2019 by Enrique Pérez Arnaud <enrique@cazalla.net>
+#
+# This file is part of the syntreenet project.
+# https://syntree.net
+#
+import os
+import argparse
+import tracemalloc
+from timeit import default_timer
+from typing import Union
+from ..kbase import KnowledgeBase
+from ..logic import Logic
+
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+
+parser = argparse.ArgumentParser(description='Benchmark on many small '
+                                 'knowledge bases with the same grammar, '
+                                 'each with its own grammar or sharing a '
+                                 'logic, on classes.peg.')
+parser.add_argument('-n', dest='n', type=int, default=200,
+                    help='number of knowledge bases')
+parser.add_argument('-f', dest='f', type=int, default=20,
+                    help='number of facts told to each knowledge base')
+
+
+def run(grammar : Union[str, Logic], n : int, f : int):
+    tracemalloc.start()
+    start = default_timer()
+    kbs = []
+    for i in range(n):
+        kb = KnowledgeBase(grammar)
+        for j in range(f):
+            kb.tell(f'thing{chr(97 + j % 26)} isa thing')
+        kbs.append(kb)
+    t = default_timer() - start
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f'    took {t}sec to make {n} knowledge bases with {f} facts\n'
+          f'    mean for knowledge base : {(t/n)*1000}ms, '
+          f'{current // n} bytes')
+
+
+if __name__ == '__main__':
+    fn = os.path.join(HERE, '../../grammars/classes.peg')
+    with open(fn, 'r') as fh:
+        grammar = fh.read()
+    args = parser.parse_args()
+    print('each with its own grammar')
+    run(grammar, args.n, args.f)
+    print('sharing a logic')
+    run(Logic(grammar), args.n, args.f)
@@ -0,0 +1,72 @@
+# Copyright (c) 2019 by Enrique Pérez Arnaud <enrique@cazalla.net>
+#
+# This file is part of the syntreenet project.
+# https://syntree.net
+#
+import os
+import argparse
+import tracemalloc
+from dataclasses import dataclass
+from random import randrange
+from timeit import timeit
+from ..kbase import KnowledgeBase
+from ..timers import TimerWheel
+
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+
+parser = argparse.ArgumentParser(description='Benchmark on expiring facts.')
+parser.add_argument('-n', dest='n', type=int, default=10000,
+                    help='number of facts to tell with a ttl')
+parser.add_argument('-t', dest='t', type=int, default=600,
+                    help='maximum ttl, in seconds')
+
+
+@dataclass
+class Clock:
+    now : float = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@dataclass
+class Benchmark:
+    kb : KnowledgeBase
+    clock : Clock
+    n : int
+
+    def __call__(self):
+        expired = 0
+        while expired < self.n:
+            self.clock.now += 1
+            expired += self.kb.tick()
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    fn = os.path.join(HERE, '../../grammars/classes.peg')
+    clock = Clock()
+    with open(fn, 'r') as fh:
+        kb = KnowledgeBase(fh.read(), clock=clock)
+    facts = [f'sensor{i} isa reading{i % 10}' for i in range(args.n)]
+    ttls = [randrange(1, args.t) for _ in facts]
+    for fact, ttl in zip(facts, ttls):
+        kb.tell(fact, ttl=ttl)
+
+    t = timeit(Benchmark(kb, clock, args.n), number=1)
+    print(f'took {t}sec to expire {args.n} facts over {args.t} ticks\n'
+          f'    expired facts per second : {args.n / t}')
+
+    told = [kb.from_parse_tree(kb.parse(f)) for f in facts[:1000]]
+    wheel = TimerWheel()
+    deadlines = {}
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for told_fact, ttl in zip(told, ttls):
+        deadlines[told_fact.text] = ttl
+        wheel.add(ttl, (ttl, told_fact))
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(s.size_diff for s in after.compare_to(before, 'filename'))
+    print(f'memory per pending timer : {size / len(told)} bytes')
@@ -0,0 +1,508 @@
+# Copyright (c) 2019 by Enrique Pérez Arnaud <enrique@cazalla.net>
+#
+# This file is part of the syntreenet project.
+# https://syntree.net
+#
+# The syntreenet project is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The syntreenet project is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with any part of the terms project.
+# If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import annotations
+
+import json
+import sqlite3
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from itertools import islice
+from typing import List, Dict, Set, Tuple, Iterator, Optional, Any, cast
+
+from .grammar import Segment, Fact, Path, Layout, Matching
+from .factset import FactSet
+from .records import fact_to_record, fact_from_record
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS nodes (
+    id INTEGER PRIMARY KEY,
+    parent INTEGER NOT NULL,
+    logic INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    name TEXT NOT NULL,
+    value TEXT NOT NULL,
+    leaf INTEGER NOT NULL,
+    count INTEGER NOT NULL DEFAULT 0,
+    ends INTEGER NOT NULL DEFAULT 0
+);
+CREATE UNIQUE INDEX IF NOT EXISTS nodes_child ON nodes (parent, logic, key);
+CREATE TABLE IF NOT EXISTS facts (
+    node INTEGER PRIMARY KEY,
+    record TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO meta (name, value) VALUES ('count', 0);
+'''
+
+ROOT = 0
+
+
+def path_key(path : Path) -> str:
+    return '\x1f'.join(path.identity_tuple)
+
+
+@dataclass
+class LRUCache:
+    '''
+    A mapping that keeps only the most recently used entries.
+    '''
+    size : int
+    entries : OrderedDict = field(default_factory=OrderedDict)
+
+    def get(self, key : Any) -> Any:
+        value = self.entries.get(key)
+        if value is not None:
+            self.entries.move_to_end(key)
+        return value
+
+    def put(self, key : Any, value : Any):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def pop(self, key : Any):
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+
+
+@dataclass
+class SQLFactSet:
+    '''
+    A fact set kept in a SQLite database, with the same interface as FactSet
+    for adding, removing and querying facts, for sets of facts that do not
+    fit in memory.
+
+    The tree of the fact set is stored as rows in a table of nodes, each
+    with the id of its parent, whether it is a logical node, the identity of
+    its path, the value of the path, the number of facts under it, and the
+    number of facts with a branch that ends at it (see factset.SSNode); the
+    facts themselves are kept as records (see records.fact_to_record), by
+    the id of the node of their last leaf. The nodes most recently looked
+    up, and the logical children of the nodes most recently expanded, are
+    kept in memory, in LRU caches of cache_size entries.
+
+    Changes are committed to the database every commit_every changed
+    facts, and on close.
+    '''
+    kb : Any = None
+    filename : str = ':memory:'
+    cache_size : int = 100000
+    commit_every : int = 1000
+    db : sqlite3.Connection = field(init=False)
+    nodes : LRUCache = field(init=False)
+    children : LRUCache = field(init=False)
+    savepoints : int = 0
+    changes : int = 0
+
+    def __post_init__(self):
+        self.db = sqlite3.connect(self.filename)
+        self.db.executescript(SCHEMA)
+        self.db.commit()
+        self.nodes = LRUCache(self.cache_size)
+        self.children = LRUCache(self.cache_size)
+
+    @property
+    def count(self) -> int:
+        row = self.db.execute("SELECT value FROM meta WHERE name = 'count'")
+        return row.fetchone()[0]
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    def _lookup(self, parent : int, logic : bool, path : Path) -> Optional[int]:
+        key = (parent, logic, path_key(path))
+        node = self.nodes.get(key)
+        if node is None:
+            row = self.db.execute(
+                    'SELECT id FROM nodes WHERE parent = ? AND logic = ? AND key = ?',
+                    (parent, int(logic), key[2])).fetchone()
+            if row is None:
+                return None
+            node = row[0]
+            self.nodes.put(key, node)
+        return node
+
+    def _create(self, parent : int, logic : bool, path : Path) -> int:
+        key = path_key(path)
+        value = path.value
+        cursor = self.db.execute(
+                'INSERT INTO nodes (parent, logic, key, name, value, leaf) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (parent, int(logic), key, value.name, value.text,
+                 int(path.is_leaf())))
+        node = cast(int, cursor.lastrowid)
+        self.nodes.put((parent, logic, key), node)
+        if logic:
+            self.children.pop(parent)
+        return node
+
+    def _logic_children(self, parent : int) -> List[Tuple[int, Segment]]:
+        children = self.children.get(parent)
+        if children is None:
+            rows = self.db.execute(
+                    'SELECT id, name, value, leaf FROM nodes '
+                    'WHERE parent = ? AND logic = 1', (parent,))
+            children = [(node, Segment(value, name, 0, len(value), bool(leaf)))
+                        for node, name, value, leaf in rows]
+            self.children.put(parent, children)
+        return children
+
+    def get_fact_leaf(self, paths : List[Path]) -> Optional[int]:
+        node = ROOT
+        for path in paths:
+            child = self._lookup(node, False, path)
+            if child is None:
+                child = self._lookup(node, True, path)
+            if child is None:
+                return None
+            node = child
+        return node
+
+    def _count(self, node : int) -> int:
+        if node == ROOT:
+            return self.count
+        row = self.db.execute('SELECT count FROM nodes WHERE id = ?', (node,))
+        return row.fetchone()[0]
+
+    def _ends(self, node : int) -> int:
+        row = self.db.execute('SELECT ends FROM nodes WHERE id = ?', (node,))
+        return row.fetchone()[0]
+
+    def _has_fact(self, node : int) -> bool:
+        row = self.db.execute('SELECT 1 FROM facts WHERE node = ?', (node,))
+        return row.fetchone() is not None
+
+    def add_fact(self, fact : Fact) -> bool:
+        '''
+        Add a new fact to the set, update the counts of facts in the nodes
+        it goes through, and return whether it was not already in the set.
+        '''
+        end = self.get_fact_leaf(fact.get_leaf_paths())
+        if end is not None and self._has_fact(end):
+            return False
+        if self.kb.query_cache is not None:
+            self.kb.query_cache.invalidate(fact)
+        layout = fact.layout
+        paths, skips = layout.paths, layout.skips
+        kb = self.kb
+        nodes : Dict[int, None] = {}
+        ends : List[Tuple[int]] = []
+        work : List[Tuple[int, int, bool]] = [(ROOT, 0, False)]
+        end = None
+        while work:
+            parent, j, creating = work.pop()
+            while j < len(paths):
+                path = paths[j]
+                logic = kb.in_var_range(path)
+                node = None if creating else self._lookup(parent, logic, path)
+                if node is None:
+                    node = self._create(parent, logic, path)
+                    branch_creating = True
+                else:
+                    branch_creating = False
+                nodes[node] = None
+                j += 1
+                if logic and not path.is_leaf():
+                    work.append((node, skips[j - 1], branch_creating))
+                    continue
+                creating = branch_creating
+                parent = node
+            ends.append((parent,))
+            if end is None:
+                end = parent
+        record = json.dumps(fact_to_record(fact), separators=(',', ':'))
+        self.db.execute('INSERT INTO facts (node, record) VALUES (?, ?)',
+                        (end, record))
+        self.db.executemany('UPDATE nodes SET count = count + 1 WHERE id = ?',
+                            ((node,) for node in nodes))
+        self.db.executemany('UPDATE nodes SET ends = ends + 1 WHERE id = ?',
+                            ends)
+        self.db.execute("UPDATE meta SET value = value + 1 WHERE name = 'count'")
+        self._changed()
+        return True
+
+    def rm_fact(self, fact : Fact, kb : Any) -> bool:
+        '''
+        Remove a fact from the set, deleting the nodes that no longer have
+        facts under them, and return whether it was in the set.
+        '''
+        end = self.get_fact_leaf(fact.get_leaf_paths())
+        if end is None or not self._has_fact(end):
+            return False
+        if kb.query_cache is not None:
+            kb.query_cache.invalidate(fact)
+        self.db.execute('DELETE FROM facts WHERE node = ?', (end,))
+        layout = fact.layout
+        paths, skips = layout.paths, layout.skips
+        nodes : Dict[int, None] = {}
+        ends : List[Tuple[int]] = []
+        work : List[Tuple[int, int]] = [(ROOT, 0)]
+        while work:
+            parent, j = work.pop()
+            while j < len(paths):
+                path = paths[j]
+                logic = kb.in_var_range(path)
+                node = self._lookup(parent, logic, path)
+                if node is None:
+                    break
+                nodes[node] = None
+                j += 1
+                if logic and not path.is_leaf():
+                    work.append((node, skips[j - 1]))
+                    continue
+                parent = node
+            else:
+                ends.append((parent,))
+        ids = [(node,) for node in nodes]
+        self.db.executemany('UPDATE nodes SET count = count - 1 WHERE id = ?', ids)
+        self.db.executemany('UPDATE nodes SET ends = ends - 1 WHERE id = ?', ends)
+        self.db.execute("UPDATE meta SET value = value - 1 WHERE name = 'count'")
+        for node in nodes:
+            row = self.db.execute(
+                    'SELECT parent, logic, key, count FROM nodes WHERE id = ?',
+                    (node,)).fetchone()
+            parent, logic, key, count = row
+            if count <= 0:
+                self.db.execute('DELETE FROM nodes WHERE id = ?', (node,))
+                self.nodes.pop((parent, bool(logic), key))
+                self.children.pop(parent)
+        self._changed()
+        return True
+
+    def iter_facts(self) -> Iterator[Fact]:
+        '''
+        Yield the facts in the set.
+        '''
+        for (record,) in self.db.execute('SELECT record FROM facts'):
+            yield fact_from_record(json.loads(record), self.kb)
+
+    def _changed(self):
+        self.changes += 1
+        if not self.savepoints and self.changes >= self.commit_every:
+            self.db.commit()
+            self.changes = 0
+
+    def ask_fact(self, fact : Fact) -> List[Matching]:
+        '''
+        Return the matchings of the variables in the fact that correspond to
+        facts in the set.
+        '''
+        return self.match_paths(fact.get_leaf_paths(), Matching(origin=fact))
+
+    def match_paths(self, paths : List[Path], matching : Matching) -> List[Matching]:
+        '''
+        Return the extensions of the matching that match the paths with
+        facts in the set.
+        '''
+        kb = self.kb
+        num_paths = len(paths)
+        response = []
+        stack : List[Tuple[int, int, Matching]] = [(ROOT, 0, matching)]
+        while stack:
+            node, i, matching = stack.pop()
+            if i == num_paths:
+                if self._ends(node):
+                    response.append(matching)
+                continue
+            path = paths[i]
+            if path.is_var():
+                syn = path.value
+                if syn not in matching:
+                    children = [(child, i + 1, matching.setitem(syn, value))
+                                for child, value in self._logic_children(node)]
+                    children.reverse()
+                    stack.extend(children)
+                    continue
+                path, _ = path.substitute(matching)
+            next_node = self._lookup(node, kb.in_var_range(path), path)
+            if next_node is not None:
+                stack.append((next_node, i + 1, matching))
+        return response
+
+    def count_fact(self, fact : Fact, matching : Optional[Matching] = None) -> int:
+        '''
+        Return the number of facts in the set that match the provided fact.
+        As in FactSet.count_paths, once the rest of the paths are distinct
+        free variables, the count kept in the node is used.
+        '''
+        if matching is None:
+            matching = Matching(origin=fact)
+        kb = self.kb
+        paths = fact.get_leaf_paths()
+        num_paths = len(paths)
+        free_from = FactSet._free_from(paths, matching)
+        total = 0
+        stack : List[Tuple[int, int, Matching]] = [(ROOT, 0, matching)]
+        while stack:
+            node, i, matching = stack.pop()
+            if i >= free_from:
+                if i < num_paths:
+                    total += self._count(node)
+                elif self._ends(node):
+                    total += 1
+                continue
+            path = paths[i]
+            if path.is_var():
+                syn = path.value
+                if syn not in matching:
+                    stack.extend((child, i + 1, matching.setitem(syn, value))
+                                 for child, value in self._logic_children(node))
+                    continue
+                path, _ = path.substitute(matching)
+            next_node = self._lookup(node, kb.in_var_range(path), path)
+            if next_node is not None:
+                stack.append((next_node, i + 1, matching))
+        return total
+
+    def estimate(self, paths : List[Path], bound : Set[Segment],
+                 cap : int = 64) -> float:
+        '''
+        Estimate the number of facts that match the paths, as
+        FactSet.estimate does, from the counts kept in the table of nodes.
+        At most cap logical children of each node are fetched, and the rest
+        are extrapolated from the number of them.
+        '''
+        kb = self.kb
+        free_from = FactSet._free_from(paths, bound)
+        bound = set(bound)
+        frontier : List[Tuple[int, float]] = [(ROOT, 1.0)]
+        for i, path in enumerate(paths):
+            if i >= free_from:
+                return sum(w * self._count(node) for node, w in frontier)
+            new_frontier : List[Tuple[int, float]] = []
+            if path.is_var():
+                syn = path.value
+                for node, weight in frontier:
+                    num, children = self._sample_children(node, cap)
+                    if not children:
+                        continue
+                    if syn in bound:
+                        weight = weight / num
+                    weight = weight * num / len(children)
+                    new_frontier.extend((child, weight) for child in children)
+                bound.add(syn)
+            else:
+                logic = kb.in_var_range(path)
+                for node, weight in frontier:
+                    child = self._lookup(node, logic, path)
+                    if child is not None:
+                        new_frontier.append((child, weight))
+            if len(new_frontier) > cap:
+                scale = len(new_frontier) / cap
+                new_frontier = [(n, w * scale) for n, w in new_frontier[:cap]]
+            frontier = new_frontier
+            if not frontier:
+                return 0.0
+        return sum(w for _, w in frontier)
+
+    def _sample_children(self, parent : int, cap : int) -> Tuple[int, List[int]]:
+        '''
+        Return the number of logical children of the node, and the ids of at
+        most cap of them.
+        '''
+        num = self.db.execute(
+                'SELECT COUNT(*) FROM nodes WHERE parent = ? AND logic = 1',
+                (parent,)).fetchone()[0]
+        rows = self.db.execute(
+                'SELECT id FROM nodes WHERE parent = ? AND logic = 1 LIMIT ?',
+                (parent, cap))
+        return num, [node for (node,) in rows]
+
+    def plan(self, facts : List[Fact]) -> List[Fact]:
+        '''
+        Order the facts in a conjunctive query so that each has the least
+        estimated number of matches, given the variables bound by the
+        previous ones.
+        '''
+        if len(facts) < 2:
+            return list(facts)
+        bound : Set[Segment] = set()
+        pending = list(facts)
+        plan = []
+        while pending:
+            best = min(pending,
+                       key=lambda f: self.estimate(f.get_leaf_paths(), bound))
+            pending.remove(best)
+            plan.append(best)
+            bound.update(p.value for p in best.get_leaf_paths() if p.is_var())
+        return plan
+
+    def ask_facts(self, facts : List[Fact],
+                  limit : Optional[int] = None) -> Iterator[Matching]:
+        '''
+        Yield the matchings that satisfy all the facts at the same time, up
+        to limit, joining the facts in the order given by plan.
+        '''
+        plan = [f.get_leaf_paths() for f in self.plan(facts)]
+        matching = Matching(origin=facts[0])
+        return islice(self._join(plan, 0, matching), limit)
+
+    def count_facts(self, facts : List[Fact]) -> int:
+        '''
+        Return the number of matchings that satisfy all the facts at the
+        same time. All but the last of the facts in the plan are joined, and
+        the matches for the last are counted with count_fact.
+        '''
+        plan = self.plan(facts)
+        paths = [f.get_leaf_paths() for f in plan[:-1]]
+        matching = Matching(origin=facts[0])
+        return sum(self.count_fact(plan[-1], m)
+                   for m in self._join(paths, 0, matching))
+
+    def _join(self, plan : List[List[Path]], i : int,
+              matching : Matching) -> Iterator[Matching]:
+        if i == len(plan):
+            yield matching
+            return
+        for m in self.match_paths(plan[i], matching):
+            yield from self._join(plan, i + 1, m)
+
+    def snapshot(self) -> str:
+        '''
+        Open a savepoint in the database, and return its name.
+        '''
+        self.savepoints += 1
+        name = f'sp{self.savepoints}'
+        self.db.execute(f'SAVEPOINT {name}')
+        return name
+
+    def restore(self, snapshot : str):
+        '''
+        Roll back the database to the savepoint.
+        '''
+        self.db.execute(f'ROLLBACK TO {snapshot}')
+        self.savepoints = int(snapshot[2:])
+        self.nodes.clear()
+        self.children.clear()
+
+    def release(self, snapshot : str):
+        '''
+        Release the savepoint, keeping the changes made since it was opened.
+        '''
+        self.db.execute(f'RELEASE {snapshot}')
+        self.savepoints = int(snapshot[2:]) - 1
@@ -0,0 +1,241 @@
+# Copyright (c) 2019 by Enrique Pérez Arnaud <enrique@cazalla.net>
+#
+# This file is part of the syntreenet project.
+# https://syntree.net
+#
+# The syntreenet project is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The syntreenet project is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with any part of the terms project.
+# If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from typing import List, Dict, Tuple, Union, Optional, Any, cast
+
+from parsimonious.exceptions import ParseError
+from parsimonious.expressions import OneOf
+from parsimonious.nodes import Node
+
+from .grammar import Fact
+from .records import fact_to_record, fact_from_record
+
+
+# A parse tree as a flat list of nodes in document order, each as a tuple
+# with its depth, the name of its production, and its text if it is a leaf
+# or None otherwise.
+Flat = List[Tuple[int, str, Optional[str]]]
+
+# The value of a variable in a template.
+Value = Union[str, Fact, tuple]
+
+
+def flatten_record(record : list) -> Flat:
+    '''
+    Return the flat tree of a record made by records.fact_to_record.
+    '''
+    text, nodes = record
+    flat : Flat = []
+    texts : List[str] = []
+    num_nodes = len(nodes)
+    for k in range(0, num_nodes, 4):
+        depth, name, start, end = nodes[k:k + 4]
+        del texts[depth:]
+        segment_text = (texts[-1] if depth else text)[start:end]
+        texts.append(segment_text)
+        leaf = k + 4 == num_nodes or nodes[k + 4] <= depth
+        flat.append((depth, name, segment_text if leaf else None))
+    return flat
+
+
+def flatten_node(node : Node, depth : int) -> Flat:
+    '''
+    Return the flat tree of a parse tree, with its root at the given depth.
+    '''
+    flat : Flat = []
+    stack = [(node, depth)]
+    while stack:
+        node, depth = stack.pop()
+        if node.children:
+            flat.append((depth, node.expr.name, None))
+            stack.extend((child, depth + 1) for child in reversed(node.children))
+        else:
+            flat.append((depth, node.expr.name, node.text))
+    return flat
+
+
+def record_from_flat(flat : Flat) -> list:
+    '''
+    Return the record (see records.fact_to_record) of a flat tree, computing
+    the text of the fact and the offsets of its segments from the texts of
+    its leaves.
+    '''
+    parts : List[str] = []
+    nodes : list = []
+    starts : List[int] = []
+    opened : List[Tuple[int, int]] = []
+    pos = 0
+    for depth, name, text in flat:
+        while opened and opened[-1][0] >= depth:
+            d, i = opened.pop()
+            nodes[i] = pos - (starts[d - 1] if d else 0)
+        del starts[depth:]
+        parent_start = starts[-1] if depth else 0
+        starts.append(pos)
+        nodes.extend((depth, name, pos - parent_start, 0))
+        if text is None:
+            opened.append((depth, len(nodes) - 1))
+        else:
+            parts.append(text)
+            pos += len(text)
+            nodes[-1] = pos - parent_start
+    while opened:
+        d, i = opened.pop()
+        nodes[i] = pos - (starts[d - 1] if d else 0)
+    return [''.join(parts), nodes]
+
+
+@dataclass
+class Template:
+    '''
+    A fact with variables, parsed once, from which to build facts with the
+    same structure given values for its variables, with no parsing of the
+    facts built.
+
+    The values can be strings, that are matched against the productions
+    that the grammar allows in place of the variable (only the value is
+    parsed, and each value is matched once while there are less than
+    cache_size in the cache). For productions that are facts themselves,
+    they can also be facts, or tuples with a template and the values for
+    it, that are built along with the outer fact.
+    '''
+    kb : Any
+    pattern : Fact
+    cache_size : int = 10000
+    flat : Flat = field(init=False)
+    variables : Tuple[str, ...] = field(init=False)
+    slots : Dict[int, Tuple[str, Tuple[str, ...]]] = field(init=False)
+    cache : Dict[tuple, Flat] = field(init=False, default_factory=dict)
+
+    def __post_init__(self) -> None:
+        self.flat = flatten_record(fact_to_record(self.pattern))
+        self.slots = {}
+        variables : List[str] = []
+        parents : List[str] = []
+        for i, (depth, name, text) in enumerate(self.flat):
+            del parents[depth:]
+            parents.append(name)
+            if name == '__var__':
+                text = str(text)
+                if text not in variables:
+                    variables.append(text)
+                allowed = self._allowed(parents[-2])
+                if not allowed:
+                    raise ValueError(f'Variable {text} in {self.pattern} is not '
+                                     'in place of a logical production')
+                self.slots[i] = (text, allowed)
+        self.variables = tuple(variables)
+
+    def _allowed(self, name : str) -> Tuple[str, ...]:
+        '''
+        Return the names of the logical productions that can take the place
+        of a variable within the production with the given name.
+        '''
+        expr = self.kb.grammar[name]
+        if not isinstance(expr, OneOf):
+            return ()
+        in_range = self.kb.name_in_var_range
+        return tuple(m.name for m in expr.members if m.name and in_range(m.name))
+
+    def __call__(self, *args : Value, **kwargs : Value) -> Fact:
+        '''
+        Build a fact giving values to the variables of the template, either
+        positionally, in the order in which they first appear in it, or by
+        name.
+        '''
+        record = record_from_flat(self._build(args, kwargs, 0))
+        return fact_from_record(record, self.kb)
+
+    def _build(self, args : tuple, kwargs : Dict[str, Value],
+               depth : int) -> Flat:
+        '''
+        Return the flat tree of the fact with the given values, with its
+        root at the given depth.
+        '''
+        if len(args) > len(self.variables):
+            raise ValueError(f'Too many values for {self.pattern}')
+        values = dict(zip(self.variables, args))
+        values.update(kwargs)
+        if len(values) != len(self.variables) or not all(
+                v in values for v in self.variables):
+            raise ValueError(f'Wrong variables for {self.pattern}: '
+                             f'{", ".join(values)}')
+        flat : Flat = []
+        start = 0
+        for i, (var, allowed) in self.slots.items():
+            if depth:
+                flat.extend((d + depth, name, text)
+                            for d, name, text in self.flat[start:i])
+            else:
+                flat.extend(self.flat[start:i])
+            flat.extend(self._value(values[var], allowed, self.flat[i][0] + depth))
+            start = i + 1
+        if depth:
+            flat.extend((d + depth, name, text)
+                        for d, name, text in self.flat[start:])
+        else:
+            flat.extend(self.flat[start:])
+        return flat
+
+    def _value(self, value : Value, allowed : Tuple[str, ...],
+               depth : int) -> Flat:
+        '''
+        Return the flat tree of the value, with its root at the given depth.
+        '''
+        if isinstance(value, tuple):
+            template = cast(Template, value[0])
+            self._check(template.flat[0][1], allowed, value)
+            return template._build(value[1:], {}, depth)
+        if isinstance(value, Fact):
+            flat = flatten_record(fact_to_record(value))
+            self._check(flat[0][1], allowed, value)
+            return [(d + depth, name, text) for d, name, text in flat]
+        key = (allowed, depth, value)
+        cached = self.cache.get(key)
+        if cached is None:
+            cached = self._match(value, allowed, depth)
+            if len(self.cache) >= self.cache_size:
+                self.cache.clear()
+            self.cache[key] = cached
+        flat = cached
+        return flat
+
+    def _check(self, name : str, allowed : Tuple[str, ...], value : Any):
+        if name not in allowed:
+            raise ValueError(f'{value} is not one of {", ".join(allowed)}')
+
+    def _match(self, value : str, allowed : Tuple[str, ...],
+               depth : int) -> Flat:
+        '''
+        Match the value against the allowed productions, in order, as the
+        grammar would, and return its flat tree.
+        '''
+        for name in allowed:
+            try:
+                node = self.kb.grammar[name].match(value)
+            except ParseError:
+                continue
+            if node.end == len(value):
+                return flatten_node(node, depth)
+            break
+        raise ValueError(f'{value!r} is not one of {", ".join(allowed)}')
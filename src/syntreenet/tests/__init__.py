@@ -19,8 +19,10 @@
 
 
 import os
+from typing import Optional, Union
 from unittest import TestCase
 from syntreenet.kbase import KnowledgeBase
+from syntreenet.logic import Logic
 from parsimonious.grammar  import Grammar
 
 
@@ -31,10 +33,25 @@ class GrammarTestCase(TestCase):
 
     grammar_file = ''
     var_range_expr = '^v_'
+    indexed : tuple = ()
+    db : Optional[str] = None
+    compile_queries = False
 
     def setUp(self):
-        fn = os.path.join(HERE, '../../grammars', self.grammar_file)
-        with open(fn, 'r') as fh:
-            self.kb = KnowledgeBase(fh.read(),
-                                    var_range_expr=self.var_range_expr)
-            self.grammar = self.kb.grammar
+        self.kb = self.make_kb()
+        self.grammar = self.kb.grammar
+
+    def make_kb(self, logic : Optional[Logic] = None, **kwargs) -> KnowledgeBase:
+        grammar : Union[str, Logic]
+        if logic is None:
+            fn = os.path.join(HERE, '../../grammars', self.grammar_file)
+            with open(fn, 'r') as fh:
+                grammar = fh.read()
+        else:
+            grammar = logic
+        return KnowledgeBase(grammar,
+                             var_range_expr=self.var_range_expr,
+                             indexed=self.indexed,
+                             db=self.db,
+                             compile_queries=self.compile_queries,
+                             **kwargs)
@@ -162,6 +162,35 @@ class PairsTests(GrammarTestCase):
         self.assertEquals(resp[1].mapping[1][0].text, 'X2')
         self.assertEquals(resp[1].mapping[1][1].text, '(hullo : gbye)')
 
+    def test_counts_and_removal(self):
+        tree1 = self.kb.parse('(es : (hola : adios), en : (hello : bye))')
+        f1 = self.kb.from_parse_tree(tree1)
+        tree2 = self.kb.parse('(es : (hola : adios), en : (hullo : gbye))')
+        f2 = self.kb.from_parse_tree(tree2)
+        self.kb.fset.add_fact(f1)
+        self.kb.fset.add_fact(f2)
+        self.kb.fset.add_fact(f2)
+        self.assertEquals(self.kb.fset.count, 2)
+        self.assertEquals(self.kb.count('(es : X1, en : X2)'), 2)
+        self.kb.fset.rm_fact(f2, self.kb)
+        self.assertEquals(self.kb.fset.count, 1)
+        resp = self.kb.query('(es : X1, en : X2)')
+        self.assertEquals(resp, [{'X1': '(hola : adios)', 'X2': '(hello : bye)'}])
+        self.kb.fset.rm_fact(f1, self.kb)
+        self.assertEmpty()
+
+    def assertEmpty(self):
+        self.assertFalse(self.kb.fset.logic_children)
+        self.assertFalse(self.kb.fset.nonlogic_children)
+
+    def test_deeply_nested_fact(self):
+        from ..scripts.nested_bench import nested
+        fact = nested(1, 100)
+        self.kb.tell(fact)
+        self.assertTrue(self.kb.query(fact))
+        resp = self.kb.query(fact.replace('v1', 'X1'))
+        self.assertEquals(resp, [{'X1': 'v1'}])
+
     def test_nested_fact_with_repeated_var(self):
         tree1 = self.kb.parse('(es : (hola : adios), en : (hello : adios))')
         f1 = self.kb.from_parse_tree(tree1)
@@ -216,9 +245,158 @@ class ClassesTests(GrammarTestCase):
             self.kb.tell(fact)
         self.assertEquals(self.kb.counter, 2385)
 
+    def test_plan(self):
+        for i in range(20):
+            self.kb.tell(f'human{i} isa human')
+        self.kb.tell('human is animal')
+        facts = self.kb.parse_facts('X1 isa X2 ; X2 is animal')
+        paths = facts[0].get_leaf_paths()
+        self.assertEquals(self.kb.fset.estimate(paths, set()), 20)
+        plan = self.kb.fset.plan(facts)
+        self.assertEquals(str(plan[0]), 'X2 is animal')
+        resp = list(self.kb.fset.ask_facts(facts))
+        self.assertEquals(len(resp), 20)
+
+    def test_count(self):
+        self.kb.tell("X1 isa X2 ; X2 is X3 -> X1 isa X3")
+        self.kb.tell('human is animal')
+        for i in range(10):
+            self.kb.tell(f'human{i} isa human')
+        self.kb.tell('rock isa mineral')
+        self.assertEquals(self.kb.fset.count, 22)
+        self.assertEquals(self.kb.count('X1 isa human'), 10)
+        self.assertEquals(self.kb.count('X1 isa X2'), 21)
+        self.assertEquals(self.kb.count('X1 isa X1'), 0)
+        self.assertEquals(self.kb.count('rock isa mineral'), 1)
+        self.assertEquals(self.kb.count('X1 isa human ; X1 isa animal'), 10)
+        self.kb.tell('rm human3 isa human')
+        self.assertEquals(self.kb.count('X1 isa human'), 9)
+        self.assertEquals(self.kb.fset.count, 21)
+
     def test_one_hundred(self):
         from ..ruleset import RuleSet
         with self.assertRaises(NotImplementedError):
             RuleSet().get_cons(rule=None)
         with self.assertRaises(NotImplementedError):
             RuleSet().add_activation(act=None)
+
+
+class WordsTests(GrammarTestCase):
+    grammar_file = 'words.peg'
+
+    def test_remove_prefix_fact(self):
+        self.kb.tell('aa bb cc')
+        self.kb.tell('rm aa bb')
+        self.assertEquals(self.kb.fset.count, 1)
+        self.assertEquals(self.kb.count('aa bb cc'), 1)
+        self.kb.tell('rm aa bb cc')
+        self.assertEquals(self.kb.fset.count, 0)
+        self.assertEmpty()
+
+    def test_add_prefix_fact(self):
+        self.kb.tell('aa bb cc')
+        self.assertFalse(self.kb.query('aa bb'))
+        self.assertEquals(self.kb.count('aa bb'), 0)
+        self.kb.tell('aa bb')
+        self.assertTrue(self.kb.query('aa bb'))
+        self.assertEquals(self.kb.count('aa bb'), 1)
+        self.assertEquals(self.kb.fset.count, 2)
+        self.assertEquals(sorted(str(f) for f in self.kb.fset.iter_facts()),
+                          ['aa bb', 'aa bb cc'])
+        self.kb.tell('rm aa bb cc')
+        self.assertTrue(self.kb.query('aa bb'))
+        self.assertFalse(self.kb.query('aa bb cc'))
+        self.assertEquals([str(f) for f in self.kb.fset.iter_facts()],
+                          ['aa bb'])
+
+    def assertEmpty(self):
+        self.assertFalse(self.kb.fset.nonlogic_children)
+
+
+class IndexedClassesTests(ClassesTests):
+    indexed = ('v_word',)
+
+    def test_index(self):
+        for i in range(20):
+            self.kb.tell(f'human{i} isa human')
+        self.kb.tell('susan isa woman')
+        resp = self.kb.query('X1 isa woman')
+        self.assertEquals(resp, [{'X1': 'susan'}])
+        resp = self.kb.query('X1 isa X2')
+        self.assertEquals(len(resp), 21)
+        path = self.kb.parse_facts('susan isa woman')[0].get_leaf_paths()[2]
+        self.assertEquals(len(self.kb.fset.index[path]), 1)
+        self.kb.tell('rm susan isa woman')
+        self.assertNotIn(path, self.kb.fset.index)
+        self.assertFalse(self.kb.query('X1 isa woman'))
+
+    def test_fork_shares_index(self):
+        for i in range(200):
+            self.kb.tell(f'human{i} isa human')
+        fork = self.kb.fork()
+        fork.tell('susan isa human')
+        index, fork_index = self.kb.fset.index, fork.fset.index
+        copied = [path for path, nodes in fork_index.items()
+                  if nodes is not index.get(path)]
+        self.assertEquals(sorted(str(p.value) for p in copied),
+                          ['human', 'susan'])
+        self.assertEquals(len(fork.fset.index_owned), 2)
+        fork.tell('rm human3 isa human')
+        self.assertEquals(fork.count('X1 isa human'), 200)
+        self.assertEquals(self.kb.count('X1 isa human'), 200)
+        self.assertFalse(self.kb.query('susan isa human'))
+
+
+class IndexedPairsTests(PairsTests):
+    indexed = ('word',)
+
+
+class CompiledClassesTests(ClassesTests):
+    compile_queries = True
+
+    def test_walkers(self):
+        for i in range(5):
+            self.kb.tell(f'human{i} isa human')
+        self.kb.tell('human1 isa woman')
+        walkers = self.kb.walkers
+        compiled = walkers.compiled
+        self.assertEquals(len(self.kb.query('X1 isa human')), 5)
+        self.assertEquals(self.kb.query('X2 isa woman'), [{'X2': 'human1'}])
+        self.assertEquals(walkers.compiled, compiled + 1)
+        self.assertEquals(self.kb.query('X1 isa human ; X1 isa woman'),
+                          [{'X1': 'human1'}])
+        self.assertEquals(walkers.compiled, compiled + 2)
+        kb = self.make_kb(logic=self.kb.logic)
+        self.assertIs(kb.walkers, walkers)
+        kb.tell('susan isa woman')
+        self.assertEquals(kb.query('X1 isa woman'), [{'X1': 'susan'}])
+        self.assertEquals(walkers.compiled, compiled + 2)
+
+
+class CompiledPairsTests(PairsTests):
+    compile_queries = True
+
+
+class CompiledIndexedPairsTests(PairsTests):
+    compile_queries = True
+    indexed = ('word',)
+
+
+class SQLClassesTests(ClassesTests):
+    db = ':memory:'
+
+
+class SQLPairsTests(PairsTests):
+    db = ':memory:'
+
+    def assertEmpty(self):
+        rows = self.kb.fset.db.execute('SELECT COUNT(*) FROM nodes')
+        self.assertEquals(rows.fetchone()[0], 0)
+
+
+class SQLWordsTests(WordsTests):
+    db = ':memory:'
+
+    def assertEmpty(self):
+        rows = self.kb.fset.db.execute('SELECT COUNT(*) FROM nodes')
+        self.assertEquals(rows.fetchone()[0], 0)
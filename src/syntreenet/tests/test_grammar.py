@@ -17,7 +17,10 @@
 # along with any part of the terms project.
 # If not, see <http://www.gnu.org/licenses/>.
 
+import json
+
 import syntreenet.grammar as g
+from syntreenet.records import fact_to_record, fact_from_record
 from . import GrammarTestCase
 
 
@@ -124,3 +127,52 @@ class BoldTextTests(GrammarTestCase):
         paths = f.normalize(self.kb)
 
         self.assertTrue(f.get_all_paths()[1].value.text, '__X1')
+
+
+class PairsTests(GrammarTestCase):
+    grammar_file = 'pairs.peg'
+    var_range_expr = '^(word|fact)$'
+
+    def test_layout(self):
+        tree = self.kb.parse('(aa : (bb : cc) , dd : ee)')
+        f = self.kb.from_parse_tree(tree)
+        layout = f.layout
+        self.assertEquals(layout.paths, f.all_paths)
+        self.assertEquals(layout.leaves, f.leaf_paths)
+        texts = [p.value.text for p in layout.paths]
+        inner = texts.index('(bb : cc)')
+        self.assertEquals(texts[layout.skips[inner]], ',')
+        leaves = [p.value.text for p in layout.leaves]
+        b = leaves.index('bb')
+        depth = len(layout.paths[inner]) - 1
+        self.assertEquals(leaves[layout.leaf_end(b, depth)], ',')
+        self.assertEquals(layout.leaf_end(b, len(layout.leaves[b]) - 1), b + 1)
+        self.assertEquals(layout.leaf_end(b, 0), len(leaves))
+
+    def test_record(self):
+        tree = self.kb.parse('(aa : (bb : cc) , dd : (bb : cc))')
+        f1 = self.kb.from_parse_tree(tree)
+        record = json.loads(json.dumps(fact_to_record(f1)))
+        f2 = fact_from_record(record, self.kb)
+        self.assertEquals(f2.text, f1.text)
+        segments = lambda f: [[(s.text, s.name, s.start, s.end, s.leaf)
+                               for s in p.segments] for p in f.paths]
+        self.assertEquals(segments(f2), segments(f1))
+        self.assertEquals(list(f2.layout.skips), list(f1.layout.skips))
+
+    def test_template(self):
+        tree = self.kb.parse('(aa : (bb : cc , dd : ee) , ff : gg)')
+        f1 = self.kb.from_parse_tree(tree)
+        inner = self.kb.template('(bb : X1 , dd : X2)')
+        outer = self.kb.template('(aa : X1 , ff : X2)')
+        f2 = outer(inner('cc', 'ee'), X2='gg')
+        self.assertEquals(f2.text, f1.text)
+        segments = lambda f: [[(s.text, s.name, s.start, s.end, s.leaf)
+                               for s in p.segments] for p in f.paths]
+        self.assertEquals(segments(f2), segments(f1))
+        f3 = outer((inner, 'cc', 'ee'), 'gg')
+        self.assertEquals(segments(f3), segments(f1))
+        with self.assertRaises(ValueError):
+            outer('Cc', 'gg')
+        with self.assertRaises(ValueError):
+            outer('cc')
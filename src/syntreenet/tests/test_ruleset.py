@@ -17,7 +17,15 @@
 # along with any part of the terms project.
 # If not, see <http://www.gnu.org/licenses/>.
 
+import os
+import json
+import tempfile
+from unittest import skip
+
+from parsimonious.exceptions import ParseError
+
 import syntreenet.grammar as g
+from syntreenet.kbase import KnowledgeBase
 from . import GrammarTestCase
 
 
@@ -134,6 +142,609 @@ class ClassesTests(GrammarTestCase):
         resp = self.kb.goal("human isa thing")
         self.assertEquals(len(resp), 4)
 
+    def test_conjunctive_query(self):
+        self.kb.tell("X1 is X2 ; X2 is X3 -> X1 is X3")
+        self.kb.tell('animal is thing')
+        self.kb.tell('mammal is animal')
+        self.kb.tell('susan isa mammal')
+        self.kb.tell('rock isa mineral')
+        resp = self.kb.query('X1 isa X2 ; X2 is thing')
+        self.assertEquals(resp, [{'X1': 'susan', 'X2': 'mammal'}])
+        resp = self.kb.query('susan isa X2 ; X2 is X3')
+        self.assertEquals(len(resp), 2)
+        resp = self.kb.query('susan isa mammal ; mammal is thing')
+        self.assertTrue(resp)
+        resp = self.kb.query('rock isa X1 ; X1 is thing')
+        self.assertFalse(resp)
+
+    def test_conjunctive_query_limit(self):
+        for i in range(10):
+            self.kb.tell(f'thing{i} isa thing')
+        self.kb.tell('thing is thing')
+        resp = self.kb.query('X1 isa X2 ; X2 is thing', limit=3)
+        self.assertEquals(len(resp), 3)
+        resp = self.kb.query_iter('X1 isa X2 ; X2 is thing')
+        self.assertEquals(next(resp), {'X1': 'thing0', 'X2': 'thing'})
+
+    def test_recursive_goal(self):
+        self.kb.tell("X1 is X2 ; X2 is X3 -> X1 is X3")
+        self.kb.tell('a is b')
+        self.kb.tell('c is d')
+        resp = list(self.kb.goal('a is d', recursive=True, max_depth=1))
+        self.assertEquals(len(resp), 2)
+        resp = self.kb.goal('a is d', recursive=True, max_depth=2)
+        needs = set(str(f[0]) for f in resp)
+        self.assertEquals(needs, {'b is d', 'a is c', 'b is c'})
+
+    def test_recursive_goal_tables(self):
+        self.kb.tell("X1 is X2 ; X2 is X3 -> X1 is X3")
+        self.kb.tell("X1 isa X2 ; X2 is X3 -> X1 isa X3")
+        self.kb.tell('animal is thing')
+        self.kb.tell('human is animal')
+        resp = list(self.kb.goal('human isa thing', recursive=True))
+        self.assertEquals(len(resp), 3)
+        self.assertTrue(self.kb.goal_tables)
+        self.kb.tell('susan isa human')
+        self.assertFalse(self.kb.goal_tables)
+        resp = list(self.kb.goal('susan isa thing', recursive=True))
+        self.assertEquals(resp, [[]])
+
+    def test_trace(self):
+        fd, fn = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            self.kb.start_trace(fn)
+            self.kb.tell("X1 is X2 -> X1 isa X2")
+            self.kb.tell('animal is thing')
+            self.kb.stop_trace()
+            self.kb.tell('human is animal')
+            with open(fn) as fh:
+                records = [json.loads(line) for line in fh]
+        finally:
+            os.remove(fn)
+        kinds = [r[1] for r in records]
+        self.assertEquals(kinds, ['rule', 'fact', 'rule', 'fact'])
+        self.assertEquals(records[-1][2], 'animal isa thing')
+        self.assertTrue(all(r[5] >= 0 for r in records))
+
+    def test_subscribe(self):
+        found = []
+        self.kb.tell("X1 is X2 ; X2 is X3 -> X1 is X3")
+        self.kb.tell('animal is thing')
+        self.kb.subscribe('X1 is thing', found.append)
+        self.kb.tell('human is animal')
+        self.kb.tell('human is animal')
+        self.assertEquals(found, [{'X1': 'human'}])
+
+    def test_subscribe_iter(self):
+        sub = self.kb.subscribe('X1 isa X2')
+        self.kb.tell("X1 is X2 -> X1 isa X2")
+        self.kb.tell('animal is thing')
+        self.kb.tell('human is animal')
+        self.assertEquals(list(sub), [{'X1': 'animal', 'X2': 'thing'},
+                                      {'X1': 'human', 'X2': 'animal'}])
+        self.assertEquals(list(sub), [])
+        self.kb.unsubscribe(sub)
+        self.kb.tell('susan is human')
+        self.assertEquals(list(sub), [])
+        self.assertTrue(self.kb.query('susan isa human'))
+
+    def test_fork(self):
+        self.kb.tell("X1 is X2 ; X2 is X3 -> X1 is X3")
+        self.kb.tell('animal is thing')
+        fork = self.kb.fork()
+        fork.tell('human is animal')
+        fork.tell("X1 is X2 -> X1 isa X2")
+        self.assertTrue(fork.query('human is thing'))
+        self.assertTrue(fork.query('human isa animal'))
+        self.assertFalse(self.kb.query('human is thing'))
+        self.assertFalse(self.kb.query('human is animal'))
+        self.kb.tell('susan is human')
+        self.assertFalse(self.kb.query('susan isa human'))
+        self.assertFalse(fork.query('susan is human'))
+        self.assertEquals(self.kb.count('X1 is X2'), 2)
+        self.assertEquals(fork.count('X1 is X2'), 3)
+        fork.tell('rm animal is thing')
+        self.assertFalse(fork.query('animal is thing'))
+        self.assertTrue(self.kb.query('animal is thing'))
+        self.assertEquals(self.kb.query('X1 is thing'), [{'X1': 'animal'}])
+        self.assertEquals(fork.query('X1 is thing'), [{'X1': 'human'}])
+
+    def test_fork_subscriptions(self):
+        found = []
+        self.kb.subscribe('X1 is thing', found.append)
+        fork = self.kb.fork()
+        fork.tell('animal is thing')
+        self.assertEquals(found, [])
+        self.kb.tell('human is thing')
+        self.assertEquals(found, [{'X1': 'human'}])
+
+    def test_fork_ttl_explain(self):
+        now = [0.0]
+        kb = self.make_kb(clock=lambda: now[0], justify=True)
+        kb.tell('X1 isa X2 ; X2 is X3 -> X1 isa X3')
+        kb.tell('human is animal')
+        kb.tell('animal is thing', ttl=60)
+        fork = kb.fork()
+        self.assertIs(fork.timers.levels, kb.timers.levels)
+        self.assertIs(fork.justifications.reasons, kb.justifications.reasons)
+        fork.tell('susan isa human')
+        fork.tell('plant is thing', ttl=30)
+        self.assertIsNot(fork.timers.levels, kb.timers.levels)
+        self.assertEquals(fork.explain('susan isa animal')['rule'],
+                          'X1 isa X2 ; X2 is X3 -> X1 isa X3')
+        self.assertIsNone(kb.explain('susan isa animal'))
+        self.assertNotIn('susan isa animal', kb.justifications.fact_numbers)
+        self.assertEquals(kb.tick(30), 0)
+        self.assertEquals(fork.tick(30), 1)
+        self.assertEquals(kb.tick(60), 1)
+        self.assertTrue(fork.query('animal is thing'))
+        self.assertEquals(fork.tick(60), 1)
+        self.assertFalse(fork.query('animal is thing'))
+
+    def test_transaction(self):
+        self.kb.tell("X1 is X2 ; X2 is X3 -> X1 is X3")
+        self.kb.tell('animal is thing')
+        with self.kb.transaction():
+            self.kb.tell('human is animal')
+        self.assertTrue(self.kb.query('human is thing'))
+        with self.assertRaises(ParseError):
+            with self.kb.transaction():
+                self.kb.tell('susan is human')
+                self.kb.tell("X1 is X2 -> X1 isa X2")
+                self.kb.tell('rm animal is thing')
+                self.assertTrue(self.kb.query('susan is thing'))
+                self.kb.tell('not a fact')
+        self.assertFalse(self.kb.query('susan is human'))
+        self.assertFalse(self.kb.query('susan is thing'))
+        self.assertTrue(self.kb.query('animal is thing'))
+        self.assertEquals(self.kb.count('X1 is X2'), 3)
+        self.kb.tell('susan is human')
+        self.assertTrue(self.kb.query('susan is thing'))
+        self.assertFalse(self.kb.query('susan isa human'))
+
+    def test_savepoint(self):
+        self.kb.tell("X1 is X2 ; X2 is X3 -> X1 is X3")
+        with self.kb.transaction() as tx:
+            self.kb.tell('animal is thing')
+            savepoint = tx.savepoint()
+            self.kb.tell('human is animal')
+            self.assertTrue(self.kb.query('human is thing'))
+            tx.rollback(savepoint)
+            self.assertFalse(self.kb.query('human is thing'))
+            self.kb.tell('plant is thing')
+            tx.rollback(savepoint)
+            self.kb.tell('cat is animal')
+        self.assertEquals(self.kb.query('X1 is thing'),
+                          [{'X1': 'animal'}, {'X1': 'cat'}])
+
+    def test_ttl(self):
+        now = [0.0]
+        self.kb = self.make_kb(clock=lambda: now[0])
+        self.kb.tell("X1 is X2 -> X1 isa X2")
+        self.kb.tell('animal is thing', ttl=60)
+        self.kb.tell('human is animal', ttl=120)
+        self.kb.tell('plant is thing', ttl=60)
+        self.kb.tell('plant is thing')
+        self.kb.tell('cat is animal', ttl=60)
+        self.kb.tell('cat is animal', ttl=200)
+        now[0] = 59.5
+        self.assertEquals(self.kb.tick(), 0)
+        now[0] = 60
+        self.assertEquals(self.kb.tick(), 1)
+        self.assertFalse(self.kb.query('animal is thing'))
+        self.assertTrue(self.kb.query('animal isa thing'))
+        self.assertTrue(self.kb.query('plant is thing'))
+        self.kb.tell('dog is animal', ttl=100000)
+        self.assertEquals(self.kb.tick(1000), 2)
+        self.assertEquals(self.kb.tick(100059), 0)
+        self.assertEquals(self.kb.tick(100060), 1)
+        self.assertEquals(self.kb.query('X1 is X2'),
+                          [{'X1': 'plant', 'X2': 'thing'}])
+
+    def test_ttl_tenants(self):
+        now = [0.0]
+        kb1 = self.make_kb(clock=lambda: now[0])
+        kb2 = self.make_kb(clock=lambda: now[0])
+        self.assertIs(kb1.timers.levels, kb2.timers.levels)
+        kb1.tell('animal is thing', ttl=60)
+        kb2.tell('plant is thing')
+        self.assertIsNot(kb1.timers.levels, kb2.timers.levels)
+        self.assertEquals(len(kb2.timers), 0)
+        self.assertEquals(kb2.tick(60), 0)
+        self.assertEquals(kb1.tick(60), 1)
+        self.assertTrue(kb2.query('plant is thing'))
+        self.assertFalse(kb1.query('animal is thing'))
+        kb3 = self.make_kb(clock=lambda: now[0])
+        self.assertEquals(len(kb3.timers), 0)
+
+    def test_rollback_ttl(self):
+        now = [0.0]
+        kb = self.make_kb(clock=lambda: now[0])
+        kb.tell('animal is thing', ttl=60)
+        kb.tell('plant is thing', ttl=60)
+        with kb.transaction() as tx:
+            kb.tell('human is animal', ttl=30)
+            kb.tell('plant is thing')
+            self.assertEquals(kb.tick(60), 2)
+            self.assertFalse(kb.query('animal is thing'))
+            tx.rollback()
+        self.assertTrue(kb.query('animal is thing'))
+        self.assertFalse(kb.query('human is animal'))
+        self.assertEquals(kb.tick(59), 0)
+        self.assertEquals(kb.tick(60), 2)
+        self.assertFalse(kb.query('X1 is X2'))
+
+    def test_rollback_explain(self):
+        kb = self.make_kb(justify=True)
+        kb.tell("X1 isa X2 ; X2 is X3 -> X1 isa X3")
+        kb.tell('human is animal')
+        kb.tell('susan isa human')
+        why = kb.explain('susan isa animal')
+        with kb.transaction() as tx:
+            kb.tell('rm susan isa animal')
+            kb.tell('susan isa animal')
+            kb.tell('pete isa human')
+            self.assertIsNone(kb.explain('susan isa animal')['rule'])
+            self.assertTrue(kb.explain('pete isa animal'))
+            tx.rollback()
+        self.assertEquals(kb.explain('susan isa animal'), why)
+        self.assertIsNone(kb.explain('pete isa animal'))
+        self.assertNotIn('pete isa human', kb.justifications.fact_numbers)
+        self.assertIsNone(kb.justifications.changes)
+
+    def test_nested_rollback_explain(self):
+        kb = self.make_kb(justify=True)
+        kb.tell("X1 isa X2 ; X2 is X3 -> X1 isa X3")
+        kb.tell('human is animal')
+        kb.tell('susan isa human')
+        why = kb.explain('susan isa animal')
+        with self.assertRaises(KeyError):
+            with kb.transaction():
+                with kb.transaction():
+                    kb.tell('pete isa human')
+                self.assertEquals(kb.transactions, 1)
+                self.assertIsNotNone(kb.justifications.changes)
+                kb.tell('rm susan isa animal')
+                kb.tell('susan isa animal')
+                self.assertIsNone(kb.explain('susan isa animal')['rule'])
+                raise KeyError()
+        self.assertEquals(kb.transactions, 0)
+        self.assertEquals(kb.explain('susan isa animal'), why)
+        self.assertEquals(why['rule'], 'X1 isa X2 ; X2 is X3 -> X1 isa X3')
+        self.assertIsNone(kb.explain('pete isa animal'))
+        self.assertIsNone(kb.justifications.changes)
+
+    def test_rollback_partial_rules(self):
+        kb = self.make_kb(compact_after=10)
+        kb.tell("X1 isa X2 ; X2 is X3 -> X1 isa X3")
+        kb.tell('susan isa human')
+        kb.tell('rm susan isa human')
+        kb.tell('john isa human')
+        rules = dict(kb.partial_rules.rules)
+        with kb.transaction() as tx:
+            kb.tell('pete isa human')
+            self.assertEquals(len(kb.partial_rules.rules), 2)
+            kb.tell('rm john isa human')
+            self.assertEquals(kb.removed, 2)
+            self.assertEquals(len(kb.partial_rules.rules), 1)
+            tx.rollback()
+        self.assertEquals(kb.partial_rules.rules, rules)
+        self.assertEquals(kb.removed, 1)
+        kb.tell('human is animal')
+        self.assertTrue(kb.query('john isa animal'))
+        self.assertFalse(kb.query('pete isa animal'))
+        self.assertEquals(kb.compact(), 0)
+
+    def test_repeated_value(self):
+        self.kb.tell("X1 is X1 -> X1 isa X1")
+        self.kb.tell('animal is animal')
+        self.kb.tell('animal is thing')
+        self.assertTrue(self.kb.query('animal isa animal'))
+        self.assertFalse(self.kb.query('animal isa thing'))
+
+    def test_export_import(self):
+        self.kb.tell("X1 is X2 ; X2 is X3 -> X1 is X3")
+        self.kb.tell('animal is thing')
+        self.kb.tell('human is animal')
+        self.kb.tell('rm animal is thing')
+        fd, fn = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            self.assertEquals(self.kb.export_facts(fn), 2)
+            kb = self.make_kb()
+            kb.tell("X1 is X2 ; X2 is X3 -> X1 is X3")
+            kb.tell('thing is entity')
+            self.assertEquals(kb.import_facts(fn), 2)
+        finally:
+            os.remove(fn)
+        self.assertTrue(kb.query('human is entity'))
+        self.assertFalse(kb.query('animal is thing'))
+        self.assertEquals(kb.count('X1 is X2'), 4)
+
+    def test_template(self):
+        self.kb.tell("X1 is X2 ; X2 is X3 -> X1 is X3")
+        is_ = self.kb.template('X1 is X2')
+        self.kb.tell_fact(is_('animal', 'thing'))
+        self.kb.tell_fact(is_(X2='animal', X1='human'))
+        self.assertTrue(self.kb.query('human is thing'))
+        with self.assertRaises(ValueError):
+            is_('human', 'a thing')
+        with self.assertRaises(ValueError):
+            self.kb.template('X1 is X2 -> X1 isa X2')
+
+    def test_tell_many(self):
+        rules = ["X1 is X2 ; X2 is X3 -> X1 is X3",
+                 "X1 isa X2 ; X2 is X3 -> X1 isa X3"]
+        facts = ['animal is thing', 'human is animal', 'susan isa human',
+                 'human is animal']
+        kb = self.make_kb()
+        for s in rules + facts:
+            kb.tell(s)
+        expected = sorted(str(f) for f in kb.fset.iter_facts())
+        for processes in (1, 2):
+            kb = self.make_kb()
+            for s in rules:
+                kb.tell(s)
+            kb.tell_many(facts, processes=processes)
+            self.assertEquals(sorted(str(f) for f in kb.fset.iter_facts()),
+                              expected)
+        self.assertTrue(kb.query('susan isa thing'))
+        pool = kb.pool
+        kb.tell_many(['pete isa human', 'plant is thing'], processes=2)
+        self.assertIs(kb.pool, pool)
+        self.assertTrue(kb.query('pete isa thing'))
+        kb.tell_many(['john isa human'], processes=2)
+        shipped = pool.shipped
+        kb.tell_many(['ann isa human'], processes=2)
+        self.assertEquals(pool.shipped, shipped)
+        self.assertTrue(kb.query('ann isa thing'))
+        kb.tell('X1 isa thing ; X1 isa human -> X1 is human')
+        kb.tell_many(['bob isa human'], processes=2)
+        self.assertEquals(pool.shipped, shipped + 1)
+        self.assertTrue(kb.query('bob is human'))
+        kb.close_pool()
+        self.assertIsNone(kb.pool)
+
+    def test_explain(self):
+        kb = self.make_kb(justify=True)
+        kb.tell("X1 is X2 ; X2 is X3 -> X1 is X3")
+        kb.tell("X1 isa X2 ; X2 is X3 -> X1 isa X3")
+        kb.tell('animal is thing')
+        kb.tell('human is animal')
+        kb.tell('susan isa human')
+        told = {'fact': 'human is animal', 'rule': None, 'supports': []}
+        self.assertEquals(kb.explain('human is animal'), told)
+        why = kb.explain('susan isa animal')
+        self.assertEquals(why['rule'], "X1 isa X2 ; X2 is X3 -> X1 isa X3")
+        self.assertEquals([s['fact'] for s in why['supports']],
+                          ['human is animal', 'susan isa human'])
+        self.assertEquals(why['supports'][0], told)
+        why = kb.explain('susan isa thing')
+        self.assertIn(sorted(s['fact'] for s in why['supports']),
+                      [['animal is thing', 'susan isa animal'],
+                       ['human is thing', 'susan isa human']])
+        self.assertIsNone(kb.explain('susan isa plant'))
+        with self.assertRaises(RuntimeError):
+            self.kb.explain('human is animal')
+
+    def test_negation(self):
+        self.kb.tell('X1 isa X2 ; X2 is animal ; not X1 isa dead -> X1 isa alive')
+        self.kb.tell('X1 is thing ; not X2 isa X1 -> X1 is empty')
+        self.kb.tell('animal is thing')
+        self.assertTrue(self.kb.query('animal is empty'))
+        self.kb.tell('pete isa dead')
+        self.kb.tell('primate is animal')
+        self.kb.tell('susan isa primate')
+        self.kb.tell('pete isa primate')
+        self.assertEquals(self.kb.query('X1 isa alive'), [{'X1': 'susan'}])
+        self.kb.tell('susan isa dead')
+        self.assertFalse(self.kb.query('X1 isa alive'))
+        self.kb.tell('rm pete isa dead')
+        self.assertEquals(self.kb.query('X1 isa alive'), [{'X1': 'pete'}])
+        self.kb.tell('susan isa animal')
+        self.assertFalse(self.kb.query('animal is empty'))
+        with self.kb.transaction() as tx:
+            self.kb.tell('rm susan isa dead')
+            self.assertTrue(self.kb.query('susan isa alive'))
+            tx.rollback()
+        self.assertFalse(self.kb.query('susan isa alive'))
+        self.kb.tell('rm susan isa dead')
+        self.assertTrue(self.kb.query('susan isa alive'))
+
+    def test_negation_goal(self):
+        self.kb.tell('X1 isa animal ; not X1 isa dead -> X1 isa alive')
+        self.kb.tell('pete isa animal')
+        self.kb.tell('pete isa dead')
+        self.kb.tell('susan isa animal')
+        self.assertEquals(self.kb.goal('pete isa alive'), [])
+        self.assertEquals(list(self.kb.goal('pete isa alive', recursive=True)),
+                          [])
+        self.assertEquals(self.kb.goal('susan isa alive'), [[]])
+        self.assertEquals(list(self.kb.goal('susan isa alive', recursive=True)),
+                          [[]])
+        resp = self.kb.goal('john isa alive')
+        self.assertEquals([[str(f) for f in fs] for fs in resp],
+                          [['john isa animal']])
+        self.kb.tell('X1 isa animal ; not X2 isa dead -> X1 isa doomed')
+        self.assertEquals(self.kb.goal('susan isa doomed'), [])
+        self.assertEquals(list(self.kb.goal('susan isa doomed', recursive=True)),
+                          [])
+
+    def test_compact(self):
+        self.kb = self.make_kb(record_rules=True)
+        self.kb.tell('X1 isa X2 ; X2 is X3 -> X1 isa X3')
+        self.kb.tell('susan isa human')
+        self.kb.tell('pete isa human')
+        self.assertEquals(len(self.kb.partial_rules.rules), 2)
+        self.kb.tell('rm susan isa human')
+        self.assertEquals(len(self.kb.partial_rules.rules), 1)
+        self.assertEquals(self.kb.compact(), 0)
+        self.kb.tell('human is animal')
+        self.kb.tell('human is primate')
+        self.kb.tell('rm human is primate')
+        self.assertEquals(self.kb.compact(), 0)
+        self.assertFalse(self.kb.query('susan isa animal'))
+        self.assertTrue(self.kb.query('pete isa animal'))
+        self.kb.tell('susan isa human')
+        self.assertTrue(self.kb.query('susan isa animal'))
+        self.assertFalse(self.kb.query('susan isa primate'))
+
+    def test_compact_results(self):
+        for compact in (False, True):
+            kb = self.make_kb(record_rules=True)
+            kb.tell('X1 isa X2 ; X2 is X3 -> X1 isa X3')
+            kb.tell('susan isa human')
+            kb.tell('rm susan isa human')
+            if compact:
+                kb.compact()
+            kb.tell('human is animal')
+            self.assertFalse(kb.query('susan isa animal'))
+
+    def test_compact_after(self):
+        kb = self.make_kb(compact_after=1)
+        kb.tell('X1 isa X2 ; X1 is thing -> X1 is alive')
+        kb.tell('susan isa human')
+        kb.tell('susan isa woman')
+        kb.tell('rm susan isa human')
+        self.assertEquals(len(kb.partial_rules.rules), 1)
+        kb.tell('rm susan isa woman')
+        self.assertFalse(kb.partial_rules.rules)
+        self.assertFalse(kb.dset.children)
+        kb.tell('susan is thing')
+        self.assertFalse(kb.query('susan is alive'))
+        kb = self.make_kb(compact_after=2)
+        kb.tell('X1 isa X2 ; X1 is thing -> X1 is alive')
+        kb.tell('susan isa human')
+        kb.tell('rm susan isa human')
+        kb.tell('rm susan isa human')
+        kb.tell('rm susan isa woman')
+        self.assertEquals(kb.removed, 1)
+        self.assertFalse(kb.partial_rules.rules)
+
+    def test_retract_rule(self):
+        self.kb = self.make_kb(record_rules=True)
+        self.kb.tell('X1 isa X2 ; X2 is X3 -> X1 isa X3')
+        self.kb.tell('X1 is X2 ; X2 is X3 -> X1 is X3')
+        self.kb.tell('susan isa human')
+        self.kb.tell('human is animal')
+        self.assertTrue(self.kb.query('susan isa animal'))
+        self.assertEquals(
+                self.kb.retract_rule('X1 isa X2 ; X2 is X3 -> X1 isa X3'), 4)
+        self.assertEquals(
+                self.kb.retract_rule('X1 isa X2 ; X2 is X3 -> X1 isa X3'), 0)
+        self.kb.tell('animal is thing')
+        self.assertTrue(self.kb.query('human is thing'))
+        self.assertTrue(self.kb.query('susan isa animal'))
+        self.assertFalse(self.kb.query('susan isa thing'))
+        self.kb.retract_rule('X1 is X2 ; X2 is X3 -> X1 is X3')
+        for tree in (self.kb.dset, self.kb.sset):
+            self.assertIsNone(tree.var_child)
+            self.assertFalse(tree.children)
+        self.assertFalse(self.kb.partial_rules.rules)
+        with self.assertRaises(ValueError):
+            self.kb.retract_rule('susan isa human')
+        kb = self.make_kb()
+        kb.tell('X1 isa X2 ; X2 is X3 -> X1 isa X3')
+        kb.tell('susan isa human')
+        self.assertFalse(kb.partial_rules.rules)
+        with self.assertRaises(RuntimeError):
+            kb.retract_rule('X1 isa X2 ; X2 is X3 -> X1 isa X3')
+        with self.assertRaises(RuntimeError):
+            kb.compact()
+
+    def test_retract_rule_negation(self):
+        self.kb = self.make_kb(record_rules=True)
+        self.kb.tell('X1 isa animal ; not X1 isa dead -> X1 isa alive')
+        self.kb.tell('pete isa animal')
+        self.kb.tell('pete isa dead')
+        self.assertEquals(self.kb.retract_rule(
+            'X1 isa animal ; not X1 isa dead -> X1 isa alive'), 1)
+        self.assertFalse(self.kb.negations.instances)
+        self.assertFalse(self.kb.negations.by_rule)
+        self.kb.tell('rm pete isa dead')
+        self.assertFalse(self.kb.query('pete isa alive'))
+
+    def test_negation_fork(self):
+        self.kb.tell('X1 isa animal ; not X1 isa dead -> X1 isa alive')
+        self.kb.tell('pete isa animal')
+        self.kb.tell('susan isa animal')
+        fork = self.kb.fork()
+        fork.tell('pete isa dead')
+        self.assertEquals(fork.query('X1 isa alive'), [{'X1': 'susan'}])
+        self.assertEquals(len(self.kb.query('X1 isa alive')), 2)
+        negations = self.kb.negations.negations
+        fork_negations = fork.negations.negations
+        self.assertEquals(negations['pete isa dead'].count, 0)
+        self.assertEquals(fork_negations['pete isa dead'].count, 1)
+        self.assertIs(negations['susan isa dead'],
+                      fork_negations['susan isa dead'])
+        self.kb.tell('susan isa dead')
+        self.assertFalse(fork.query('susan isa dead'))
+        self.assertEquals(fork.query('X1 isa alive'), [{'X1': 'susan'}])
+        self.assertEquals(self.kb.query('X1 isa alive'), [{'X1': 'pete'}])
+
+    def test_shared_logic(self):
+        kb = self.make_kb(logic=self.kb.logic)
+        self.assertIs(kb.grammar, self.kb.grammar)
+        self.kb.tell('X1 isa X2 ; X2 is X3 -> X1 isa X3')
+        self.kb.tell('human is animal')
+        self.kb.tell('susan isa human')
+        kb.tell('susan isa human')
+        self.assertTrue(self.kb.query('susan isa animal'))
+        self.assertFalse(kb.query('susan isa animal'))
+        fact1 = self.kb.parse_facts('susan isa human')[0]
+        fact2 = kb.parse_facts('susan isa human')[0]
+        self.assertIs(fact1.paths[0][-1], fact2.paths[0][-1])
+
+    def test_query_cache(self):
+        kb = self.make_kb(query_cache=100)
+        kb.tell("X1 is X2 ; X2 is X3 -> X1 is X3")
+        kb.tell('animal is thing')
+        kb.tell('susan isa human')
+        self.assertEquals(kb.query('animal is X1'), [{'X1': 'thing'}])
+        self.assertEquals(kb.query('animal is X2'), [{'X2': 'thing'}])
+        self.assertTrue(kb.query('susan isa human'))
+        self.assertEquals(kb.query_cache.hits, 1)
+        self.assertEquals(kb.query_cache.misses, 2)
+        kb.tell('human is animal')
+        self.assertEquals(kb.query_cache.invalidations, 0)
+        self.assertTrue(kb.query('susan isa human'))
+        kb.tell('animal is alive')
+        self.assertEquals(kb.query_cache.invalidations, 1)
+        self.assertEquals(kb.query_cache.hits, 2)
+        self.assertEquals(sorted(d['X3'] for d in kb.query('animal is X3')),
+                          ['alive', 'thing'])
+        kb.tell('rm susan isa human')
+        self.assertFalse(kb.query('susan isa human'))
+        self.assertEquals(kb.query_cache.hit_rate, 2 / 6)
+
+    def test_query_cache_registrations(self):
+        kb = self.make_kb(query_cache=100)
+        kb.tell('animal is thing')
+        kb.tell('susan isa animal')
+        for i in range(3):
+            self.assertTrue(kb.query('susan isa X1 ; X1 is thing'))
+            kb.tell(f'pete{i} isa animal')
+            kb.tell(f'plant{i} is thing')
+        cache = kb.query_cache
+        self.assertEquals(cache.invalidations, 3)
+        self.assertFalse(cache.entries)
+        self.assertFalse(cache.registered)
+        stack = [cache.prefixes]
+        while stack:
+            node = stack.pop()
+            self.assertNotIn(None, node)
+            stack.extend(node.values())
+
+    def test_recursive_goal_timeout(self):
+        self.kb.tell("X1 is X2 ; X2 is X3 -> X1 is X3")
+        self.kb.tell('a is b')
+        resp = list(self.kb.goal('a is d', recursive=True, max_depth=100,
+                                 timeout=0))
+        self.assertEquals(resp, [])
+        self.assertFalse(self.kb.goal_tables)
+
 
 class PairsTests(GrammarTestCase):
     grammar_file = 'pairs.peg'
@@ -206,6 +817,26 @@ class PairsTests(GrammarTestCase):
         resp = self.kb.query("(puts : she , what : (thing : every , when : always))")
         self.assertTrue(resp)
 
+    def test_fork_nested(self):
+        self.kb.tell('(wants : X1 , gets : X1) -> (happy : X1)')
+        self.kb.tell('(wants : (thing : every) , gets : (thing : some))')
+        fork = self.kb.fork()
+        fork.tell('(wants : (thing : some) , gets : (thing : some))')
+        self.assertTrue(fork.query('(happy : (thing : some))'))
+        self.assertFalse(self.kb.query('(happy : (thing : some))'))
+        self.assertEquals(fork.count('(wants : X1 , gets : X2)'), 2)
+        self.assertEquals(self.kb.count('(wants : X1 , gets : X2)'), 1)
+
+    def test_repeated_sub_fact(self):
+        self.kb.tell('(wants : X1 , gets : X1) -> (happy : X1)')
+        self.kb.tell('(wants : (thing : every) , gets : (thing : every))')
+        self.kb.tell('(wants : (thing : some) , gets : (thing : every))')
+        self.assertTrue(self.kb.query('(happy : (thing : every))'))
+        self.assertFalse(self.kb.query('(happy : (thing : some))'))
+
+
+class IndexedClassesTests(ClassesTests):
+    indexed = ('v_word',)
 
 class ScoreTests(GrammarTestCase):
     grammar_file = 'score.peg'
@@ -259,6 +890,86 @@ class ScoreTests(GrammarTestCase):
         resp = self.kb.query('mean X1 X2 X3')
         self.assertTrue(resp)
 
+    def test_calc_rule(self):
+        self.kb.tell('''score X1 X2 ;
+                        {{logic}max-score X3 X4} ;
+                        {{calc}X2 > X4}
+                        ->
+                        rm max-score X3 X4 ;
+                        max-score X1 X2''')
+        self.kb.tell('max-score nobody 0')
+        self.kb.tell('score susan 19')
+        self.kb.tell('score john 9')
+        self.assertTrue(self.kb.query('max-score susan 19'))
+        self.kb.tell('score lil 29')
+        self.assertTrue(self.kb.query('max-score lil 29'))
+        self.assertFalse(self.kb.query('max-score susan 19'))
+
+    def test_calc_rule_2(self):
+        self.kb.tell('''score X1 X2 ;
+                        {{logic}mean X3 X4 X5} ;
+                        {{calc}X6 = X3 + 1; X7 = X4 + X2; X8 = X7 / X6 ; X8 != 0}
+                        ->
+                        rm mean X3 X4 X5 ;
+                        mean X6 X7 X8''')
+        self.kb.tell('mean 0 0 0')
+        self.kb.tell('score susan 19')
+        self.kb.tell('score john 9')
+        self.kb.tell('score paul 1')
+        self.kb.tell('score lil 29')
+        self.assertTrue(self.kb.query('mean 4.0 58.0 14.5'))
+        self.kb.tell('score ann 0')
+        self.assertTrue(self.kb.query('mean 5.0 58.0 11.6'))
+
+    def test_calc_fails(self):
+        self.kb.tell('score X1 X2 {{calc}X2 / (X2 - 3) >= 2} -> max-score X1 X2')
+        self.kb.tell('score X1 X2 {{calc}X3 > 1} -> max-score X1 0')
+        self.kb.tell('score susan 3')
+        self.kb.tell('score john 5')
+        self.kb.tell('score paul 9')
+        self.assertEquals(self.kb.query('max-score X1 X2'),
+                          [{'X1': 'john', 'X2': '5'}])
+
+    def test_aggregate(self):
+        self.kb.tell('score susan 19')
+        best = self.kb.aggregate('score X1 X2', 'max', 'X2')
+        total = self.kb.aggregate('score X1 X2', 'sum', 'X2', group_by=['X1'])
+        count = self.kb.aggregate('score X1 X2', 'count')
+        self.kb.tell('score john 9')
+        self.kb.tell('score susan 29')
+        self.kb.tell('score paul 1')
+        self.assertEquals(best.get(), 29)
+        self.assertEquals(total.get('susan'), 48)
+        self.assertEquals(total.to_dict(), {('susan',): 48, ('john',): 9,
+                                            ('paul',): 1})
+        self.assertEquals(count.get(), 4)
+        self.kb.tell('rm score susan 29')
+        self.kb.tell('rm score susan 29')
+        self.assertEquals(best.get(), 19)
+        self.assertEquals(total.get('susan'), 19)
+        self.assertEquals(count.get(), 3)
+        with self.kb.transaction() as tx:
+            groups = total.groups
+            self.kb.tell('rm score susan 19')
+            self.kb.tell('score john 30')
+            self.assertIsNone(total.get('susan'))
+            self.assertEquals(best.get(), 30)
+            late = self.kb.aggregate('score X1 X2', 'min', 'X2')
+            self.assertEquals(late.get(), 1)
+            self.assertEquals(groups[('susan',)].total, 19)
+            tx.rollback()
+        self.assertIs(total.groups, groups)
+        self.assertEquals(best.get(), 19)
+        self.assertEquals(total.get('john'), 9)
+        self.assertEquals(late.get(), 1)
+        self.kb.drop_aggregate(count)
+        self.kb.tell('score lil 0')
+        self.assertEquals(count.get(), 3)
+        with self.assertRaises(ValueError):
+            self.kb.aggregate('score X1 X2', 'max')
+        with self.assertRaises(ValueError):
+            self.kb.aggregate('score X1 X2', 'count', group_by=['X3'])
+
     def test_simple_rule_both(self):
         self.kb.tell('''score X1 X2 ;
                         {{logic}mean X3 X4 X5} ;
@@ -309,3 +1020,41 @@ permission protects action for status
 ->
 action document
 '''
+
+
+class CompiledClassesTests(ClassesTests):
+    compile_queries = True
+
+
+class CompiledPairsTests(PairsTests):
+    compile_queries = True
+
+
+class SQLClassesTests(ClassesTests):
+    db = ':memory:'
+
+    def test_fork(self):
+        with self.assertRaises(TypeError):
+            self.kb.fork()
+        with self.assertRaises(ValueError):
+            KnowledgeBase(self.kb.logic, indexed=('v_word',), db=self.db)
+
+    @skip('SQLite fact sets cannot be forked')
+    def test_fork_subscriptions(self):
+        pass
+
+    @skip('SQLite fact sets cannot be forked')
+    def test_negation_fork(self):
+        pass
+
+    @skip('SQLite fact sets cannot be forked')
+    def test_fork_ttl_explain(self):
+        pass
+
+
+class SQLPairsTests(PairsTests):
+    db = ':memory:'
+
+    @skip('SQLite fact sets cannot be forked')
+    def test_fork_nested(self):
+        pass
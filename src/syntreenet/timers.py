@@ -0,0 +1,172 @@
+# Copyright (c) 2019 by Enrique Pérez Arnaud <enrique@cazalla.net>
+#
+# This file is part of the syntreenet project.
+# https://syntree.net
+#
+# The syntreenet project is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The syntreenet project is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with any part of the terms project.
+# If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from typing import List, Set, Tuple, Any
+
+SLOT_BITS = 6
+SLOTS = 1 << SLOT_BITS
+SLOT_MASK = SLOTS - 1
+LEVELS = 4
+
+
+# The levels of a new wheel, shared by all of them until they add a timer.
+EMPTY_LEVELS : List[List[list]] = [[[] for _ in range(SLOTS)]
+                                   for _ in range(LEVELS)]
+EMPTY_COUNTS : List[int] = [0] * LEVELS
+
+
+@dataclass
+class TimerWheel:
+    '''
+    A hierarchical timer wheel, counting in integer ticks.
+
+    Each level has 64 slots, and each slot in a level spans 64 times the
+    ticks of a slot in the level below. A timer is kept in the lowest level
+    that can hold its deadline, and, as the wheel advances, the timers in
+    the slots of the upper levels are cascaded down to the lower levels,
+    until they are due. Timers with deadlines beyond the range of the top
+    level are kept apart, in overflow, and looked at once per turn of the
+    top level.
+
+    The wheel can be shared with forks of the knowledge base: owner is the
+    token of the wheel that can change the levels in place. Otherwise, the
+    levels and the lists of counts, overflow and due are copied (but not
+    their slots) on the first change, and each slot the first time a timer
+    is added to it (owned has the slots already copied). A new wheel starts
+    with the levels of EMPTY_LEVELS, not owned, so that the knowledge bases
+    that never tell facts with a ttl do not pay for a wheel of their own.
+    '''
+    current : int = 0
+    levels : List[List[list]] = field(default_factory=lambda: EMPTY_LEVELS)
+    counts : List[int] = field(default_factory=lambda: EMPTY_COUNTS)
+    overflow : List[Tuple[int, Any]] = field(default_factory=list)
+    due : List[Any] = field(default_factory=list)
+    owned : Set[Tuple[int, int]] = field(default_factory=set)
+    token : Any = field(default_factory=object)
+    owner : Any = None
+
+    def __len__(self) -> int:
+        return sum(self.counts) + len(self.overflow) + len(self.due)
+
+    def add(self, deadline : int, item : Any):
+        '''
+        Add a timer for the item, that will be due at the deadline tick.
+        '''
+        self._own()
+        delta = deadline - self.current
+        if delta <= 0:
+            self.due.append(item)
+            return
+        for level in range(LEVELS):
+            if delta < 1 << (SLOT_BITS * (level + 1)):
+                slot = (deadline >> (SLOT_BITS * level)) & SLOT_MASK
+                self._own_slot(level, slot).append((deadline, item))
+                self.counts[level] += 1
+                return
+        self.overflow.append((deadline, item))
+
+    def advance(self, now : int) -> List[Any]:
+        '''
+        Advance the wheel up to the tick now, and return the items whose
+        timers are due.
+        '''
+        if not len(self):
+            self.current = max(self.current, now)
+            return []
+        self._own()
+        while self.current < now:
+            if not any(self.counts) and not self.overflow:
+                self.current = now
+                break
+            if not self.counts[0]:
+                # nothing to expire in the lowest level before the next
+                # cascade, so jump to the end of its turn.
+                self.current = min(now - 1, self.current | SLOT_MASK)
+            self.current += 1
+            tick = self.current
+            # cascade from the highest level whose turn of slot starts now,
+            # down to the first level.
+            top = 0
+            while (top < LEVELS and
+                   not tick & ((1 << (SLOT_BITS * (top + 1))) - 1)):
+                top += 1
+            if top == LEVELS:
+                overflow, self.overflow = self.overflow, []
+                for deadline, item in overflow:
+                    self.add(deadline, item)
+                top -= 1
+            for level in range(top, 0, -1):
+                self._cascade(level, (tick >> (SLOT_BITS * level)) & SLOT_MASK)
+            slot = self.levels[0][tick & SLOT_MASK]
+            if slot:
+                self.levels[0][tick & SLOT_MASK] = []
+                self.counts[0] -= len(slot)
+                self.due.extend(item for _, item in slot)
+        due, self.due = self.due, []
+        return due
+
+    def _cascade(self, level : int, index : int):
+        slot = self.levels[level][index]
+        if slot:
+            self.levels[level][index] = []
+            self.counts[level] -= len(slot)
+            for deadline, item in slot:
+                self.add(deadline, item)
+
+    def _own(self):
+        if self.owner is not self.token:
+            self.levels = [list(level) for level in self.levels]
+            self.counts = list(self.counts)
+            self.overflow = list(self.overflow)
+            self.due = list(self.due)
+            self.owned = set()
+            self.owner = self.token
+
+    def _own_slot(self, level : int, index : int) -> list:
+        slot = self.levels[level][index]
+        if (level, index) not in self.owned:
+            slot = self.levels[level][index] = list(slot)
+            self.owned.add((level, index))
+        return slot
+
+    def fork(self) -> TimerWheel:
+        '''
+        Return a wheel that shares all its timers with this one. Both get
+        new tokens, so from then on each of them copies what it changes.
+        '''
+        self.token = object()
+        return TimerWheel(self.current, self.levels, self.counts,
+                          self.overflow, self.due)
+
+    def snapshot(self) -> tuple:
+        '''
+        Return the current state of the wheel, which can later be restored.
+        The wheel gets a new token, so that from then on what is in the
+        snapshot is copied before being changed.
+        '''
+        self.token = object()
+        return self.current, self.levels, self.counts, self.overflow, self.due
+
+    def restore(self, snapshot : tuple):
+        self.current, self.levels, self.counts, self.overflow, self.due = snapshot
+        self.token = object()
+        self.owner = None
@@ -0,0 +1,147 @@
+# Copyright (c) 2019 by Enrique Pérez Arnaud <enrique@cazalla.net>
+#
+# This file is part of the syntreenet project.
+# https://syntree.net
+#
+# The syntreenet project is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The syntreenet project is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with any part of the terms project.
+# If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from typing import List, Dict, Optional, Any
+
+
+@dataclass(frozen=True)
+class Savepoint:
+    '''
+    The state of a knowledge base at some point of a transaction: that of
+    its trees, of the record of partial rules, of the justifications and of
+    the aggregates, the pending timers of the facts told with a ttl, and the
+    number of facts removed since it was last compacted.
+    '''
+    fset : tuple
+    dset : tuple
+    sset : tuple
+    negations : Optional[tuple]
+    partial_rules : tuple
+    justifications : Optional[tuple]
+    aggregates : Optional[dict]
+    timers : tuple
+    deadlines : Dict[str, int]
+    removed : int
+
+
+@dataclass
+class Transaction:
+    '''
+    A transaction on a knowledge base. Taking a savepoint gives new tokens to
+    the fact set and to the trees of conditions and consecuences, so all
+    their nodes are copied before being changed, and the nodes reachable from
+    the savepoint are kept unchanged. The copies made are thus the undo log
+    of the transaction: rolling back to a savepoint just restores the roots
+    of the trees, and committing needs nothing else than dropping the
+    savepoints. The record of partial rules, the groups of the aggregates
+    and the timer wheel (with the deadlines of the facts told with a ttl)
+    are shared in the same way, and the justifications keep a log of their
+    changes while the outermost transaction lasts; the number of
+    transactions open on the knowledge base is kept in kb.transactions.
+    '''
+    kb : Any
+    savepoints : List[Savepoint] = field(default_factory=list)
+
+    def __post_init__(self):
+        self.kb.transactions += 1
+        self.savepoint()
+
+    def savepoint(self) -> Savepoint:
+        '''
+        Return a savepoint with the current state of the knowledge base.
+        '''
+        kb = self.kb
+        negations = None
+        if kb.negations is not None:
+            negations = kb.negations.snapshot()
+        justifications = None
+        if kb.justifications is not None:
+            justifications = kb.justifications.snapshot()
+        aggregates = None
+        if kb.aggregates is not None:
+            aggregates = kb.aggregates.snapshot_groups()
+        savepoint = Savepoint(kb.fset.snapshot(),
+                              kb.dset.snapshot(),
+                              kb.sset.snapshot(),
+                              negations,
+                              kb.partial_rules.snapshot(),
+                              justifications,
+                              aggregates,
+                              kb.timers.snapshot(),
+                              kb.deadlines,
+                              kb.removed)
+        self.savepoints.append(savepoint)
+        return savepoint
+
+    def rollback(self, savepoint : Optional[Savepoint] = None):
+        '''
+        Undo the changes made since the savepoint, or since the start of the
+        transaction if no savepoint is given. Savepoints taken after the
+        given one are dropped.
+        '''
+        if savepoint is None:
+            savepoint = self.savepoints[0]
+        index = self.savepoints.index(savepoint)
+        del self.savepoints[index + 1:]
+        kb = self.kb
+        kb.fset.restore(savepoint.fset)
+        kb.dset.restore(savepoint.dset)
+        kb.sset.restore(savepoint.sset)
+        if savepoint.negations is None:
+            kb.negations = None
+        else:
+            kb.negations.restore(savepoint.negations)
+        kb.partial_rules.restore(savepoint.partial_rules)
+        if savepoint.justifications is not None:
+            kb.justifications.restore(savepoint.justifications)
+        if kb.aggregates is not None:
+            kb.aggregates.restore_groups(savepoint.aggregates or {}, kb)
+        kb.timers.restore(savepoint.timers)
+        kb.deadlines = savepoint.deadlines
+        kb.deadlines_owner = None
+        kb.removed = savepoint.removed
+        kb.goal_tables.clear()
+        if kb.query_cache is not None:
+            kb.query_cache.clear()
+        kb.activations = []
+        kb.processing = False
+
+    def commit(self):
+        '''
+        Keep the changes made in the transaction. The justifications stop
+        logging their changes once the outermost transaction ends.
+        '''
+        kb = self.kb
+        if not self.savepoints:
+            return
+        kb.fset.release(self.savepoints[0].fset)
+        self.savepoints = []
+        kb.transactions -= 1
+        if kb.transactions == 0 and kb.justifications is not None:
+            kb.justifications.release()
+
+    def abort(self):
+        '''
+        Undo the changes made in the transaction, and end it.
+        '''
+        self.rollback()
+        self.commit()